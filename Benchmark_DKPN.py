@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path
+
+import dkpn.core as dkcore
+import dkpn.train as dktrain
+import dkpn.benchmark as dkbench
+import dkpn.inference as dkinfer
+
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description=(
+                                "Script for benchmarking the CPU inference latency of DKPN. "
+                                "It compares the eager model with its inference-optimized "
+                                "(BN-fused, TorchScript) version and, optionally, with ONNX Runtime. "
+                                "With --variants it reports size and latency of several DKPN "
+                                "architectures (and their TEST F1 if trained models are given). "
+                                "It needs to have the 'dkpn' folder in the working path."))
+
+parser.add_argument('-k', '--dkpn_model_name', type=str, default=None, help='DKPN model path (random weights if missing)')
+parser.add_argument('-b', '--batch_sizes', type=int, nargs="+", default=[1, 8, 32, 64], help='Batch sizes to test')
+parser.add_argument('-t', '--threads', type=int, default=None, help='Number of CPU threads for torch')
+parser.add_argument('-n', '--repeat', type=int, default=20, help='Number of timed forward passes per batch size')
+parser.add_argument('--onnx', type=str, default=None, help='Export the model to this ONNX file and benchmark ONNX Runtime as well')
+parser.add_argument('--intra_op_threads', type=int, default=1, help='ONNX Runtime intra-op threads')
+parser.add_argument('--inter_op_threads', type=int, default=1, help='ONNX Runtime inter-op threads')
+#
+parser.add_argument('--variants', action="store_true", help='Benchmark the architecture variants instead of a single model')
+parser.add_argument('--filters_root', type=int, nargs="+", default=[4, 8, 16], help='Variants filters_root (untrained matrix)')
+parser.add_argument('--depth', type=int, nargs="+", default=[4, 5], help='Variants depth (untrained matrix)')
+parser.add_argument('--variant_models', type=str, nargs="+", default=None, help='Trained DKPN model paths to benchmark and score on TEST')
+parser.add_argument('-d', '--dataset_name', type=str, default='INSTANCE', help='Dataset name for the variants TEST F1')
+parser.add_argument('-s', '--dataset_size', type=str, default='Nano', help='Dataset size for the variants TEST F1')
+parser.add_argument('-r', '--random_seed', type=int, default=42, help='Random seed')
+parser.add_argument('--test_samples', type=int, default=5000, help='Number of TEST samples for the variants F1')
+#
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+
+if args.variants:
+    SCORES = None
+    if args.variant_models:
+        VARIANTS = []
+        for xx in args.variant_models:
+            print("Loading DKPN ... %s" % Path(xx).name)
+            VARIANTS.append(dkcore.load_dkpn(xx).eval())
+
+        (train, dev, test) = dktrain.select_database_and_size(
+                                    args.dataset_name, args.dataset_size,
+                                    RANDOM_SEED=args.random_seed)
+        TRAIN_CLASS_DKPN = dktrain.TrainHelp_DomainKnowledgePhaseNet(
+                        VARIANTS[0], train, dev, test,
+                        batch_size=64, num_workers=4,
+                        random_seed=args.random_seed)
+        (_, _, test_generator_dkpn) = TRAIN_CLASS_DKPN.get_generator()
+
+        print("Scoring %d variants on %d TEST samples" % (len(VARIANTS),
+                                                          args.test_samples))
+        SCORES = dkbench.evaluate_pickers(
+                        {dkbench.variant_label(vv): vv for vv in VARIANTS},
+                        test_generator_dkpn,
+                        nsamples=args.test_samples,
+                        random_seed=args.random_seed)
+    else:
+        VARIANTS = [dkcore.DKPN(filters_root=fr, depth=dd)
+                    for dd in args.depth for fr in args.filters_root]
+    print("")
+
+    RESULTS = dkbench.benchmark_variants(
+                        VARIANTS, batch_sizes=args.batch_sizes,
+                        repeat=args.repeat, num_threads=args.threads)
+    dkbench.print_variants_table(RESULTS, scores=SCORES)
+
+else:
+    if args.dkpn_model_name:
+        print("Loading DKPN ... %s" % Path(args.dkpn_model_name).name)
+        mydkpn = dkcore.load_dkpn(args.dkpn_model_name)
+    else:
+        mydkpn = dkcore.DKPN()
+    mydkpn.eval()
+
+    print("Optimizing DKPN for inference (fused Conv+BN, TorchScript)")
+    fused_dkpn = mydkpn.optimize_for_inference()
+
+    print("Max. abs. difference eager/fused:  %.3e" % dkbench.compare_outputs(mydkpn, fused_dkpn))
+
+    if args.onnx:
+        print("Exporting DKPN to ONNX ... %s" % args.onnx)
+        onnx_dkpn = dkinfer.DKPN_ONNX.from_dkpn(
+                        mydkpn, args.onnx,
+                        intra_op_threads=args.intra_op_threads,
+                        inter_op_threads=args.inter_op_threads)
+        print("Max. abs. difference eager/onnx:   %.3e" % dkbench.compare_outputs(mydkpn, onnx_dkpn))
+    print("")
+
+    RESULTS = {}
+    RESULTS["DKPN_eager"] = dkbench.benchmark_latency(
+                                mydkpn, batch_sizes=args.batch_sizes,
+                                repeat=args.repeat, num_threads=args.threads)
+    RESULTS["DKPN_fused"] = dkbench.benchmark_latency(
+                                fused_dkpn, batch_sizes=args.batch_sizes,
+                                repeat=args.repeat, num_threads=args.threads)
+    if args.onnx:
+        RESULTS["DKPN_onnx"] = dkbench.benchmark_latency(
+                                    onnx_dkpn, batch_sizes=args.batch_sizes,
+                                    repeat=args.repeat)
+
+    dkbench.print_latency_table(RESULTS)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import argparse
+
+import torch
+
+import dkpn.core as dkcore
+import dkpn.train as dktrain
+import dkpn.benchmark as dkbench
+
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description=(
+                                "Script for comparing the DataLoader workers seeding schemes: "
+                                "'fixed' (every worker seeded with RANDOM_SEED, all replaying the same "
+                                "augmentation offsets) and 'stream' (independent stream per worker and epoch). "
+                                "It reports the effective augmentation diversity and, optionally, "
+                                "the time needed to reach a target DEV loss. "
+                                "It needs to have the 'dkpn' folder in the working path."))
+
+parser.add_argument('-d', '--dataset_name', type=str, default='ETHZ', help='Dataset name')
+parser.add_argument('-s', '--dataset_size', type=str, default='Nano', help='Dataset size')
+parser.add_argument('-r', '--random_seed', type=int, default=42, help='Random seed')
+parser.add_argument('-n', '--samples', type=int, default=256, help='Number of TRAIN samples for the diversity')
+parser.add_argument('-e', '--epochs', type=int, default=5, help='Number of draws (epochs) per sample for the diversity')
+parser.add_argument('-b', '--batch_size', type=int, default=32, help='Batch-Size')
+parser.add_argument('-w', '--num_workers', type=int, default=8, help='DataLoader workers')
+#
+parser.add_argument('-t', '--target_loss', type=float, default=None, help='Also train until this DEV loss is reached')
+parser.add_argument('-m', '--max_epochs', type=int, default=25, help='Max. Num. Epochs for the target DEV loss')
+parser.add_argument('-l', '--learning_rate', type=float, default=1e-3, help='Learning Rate for training')
+#
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+
+(train, dev, test) = dktrain.select_database_and_size(
+                            args.dataset_name, args.dataset_size,
+                            RANDOM_SEED=args.random_seed)
+
+RESULTS = {}
+for seeding in ("fixed", "stream"):
+    print("---> Seeding:  %s" % seeding)
+    torch.manual_seed(args.random_seed)   # same initial weights
+    mydkpn = dkcore.DKPN()
+    if torch.cuda.is_available():
+        mydkpn.cuda();
+
+    TRAIN_CLASS = dktrain.TrainHelp_DomainKnowledgePhaseNet(
+                    mydkpn, train, dev, test,
+                    batch_size=args.batch_size,
+                    num_workers=args.num_workers,
+                    random_seed=args.random_seed,
+                    worker_seeding=seeding)
+
+    DIVERSITY = dkbench.augmentation_diversity(
+                    TRAIN_CLASS.train_generator, seeding=seeding,
+                    nsamples=args.samples, epochs=args.epochs,
+                    batch_size=args.batch_size,
+                    num_workers=args.num_workers,
+                    random_seed=args.random_seed)
+
+    TARGET = None
+    if args.target_loss:
+        TARGET = dkbench.time_to_target_loss(
+                    TRAIN_CLASS, args.target_loss,
+                    max_epochs=args.max_epochs,
+                    learning_rate=args.learning_rate)
+    RESULTS[seeding] = (DIVERSITY, TARGET)
+
+print("")
+dkbench.print_seeding_table(RESULTS)
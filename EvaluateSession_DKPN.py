@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import argparse
+
+import obspy
+import seisbench as sb
+
+import dkpn.session as dksession
+
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description=(
+                                "Session mode of LoadEvaluate_DKPN.py: evaluate all the DKPN / PN "
+                                "models pairs of a JSON manifest on its TEST datasets and thresholds "
+                                "(see 'dkpn/session.py'), with datasets and models loaded once per "
+                                "worker process. Results folders as LoadEvaluate_DKPN.py. "
+                                "It needs to have the 'dkpn' folder in the working path. "
+                                "Requires Python >= 3.9"))
+
+parser.add_argument('manifest', type=str, help='Session manifest (JSON)')
+parser.add_argument('-j', '--workers', type=int, default=1, help='Worker processes (one models pair at a time each)')
+parser.add_argument('--devices', type=str, nargs="+", default=None, help='Devices of the workers, round-robin (default: all GPUs, or CPU)')
+parser.add_argument('--plot_workers', type=int, default=2, help='Processes drawing the figures, per worker (0: only write the plot jobs, see RenderPlots.py)')
+
+
+# Workers are spawned: they import this script, keep it import-safe
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    print(" SB version:  %s" % sb.__version__)
+    print("OBS version:  %s" % obspy.__version__)
+    print("")
+    print(f"MANIFEST: {args.manifest}")
+    print(f"WORKERS: {args.workers}")
+    print(f"DEVICES: {args.devices}")
+    print(f"PLOT_WORKERS: {args.plot_workers}")
+    print("")
+
+    SESSION = dksession.run_session(dksession.read_manifest(args.manifest),
+                                    workers=args.workers,
+                                    devices=args.devices,
+                                    plot_workers=args.plot_workers)
+
+    failed = [folder for (folder, outcome) in SESSION.items() if outcome]
+    print("")
+    print("DONE:  %d evaluations, %d failed" % (len(SESSION), len(failed)))
+    for folder in failed:
+        print("   FAILED:  %s" % folder)
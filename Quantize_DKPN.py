@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader
+
+import dkpn.core as dkcore
+import dkpn.train as dktrain
+import dkpn.inference as dkinfer
+import dkpn.benchmark as dkbench
+
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description=(
+                                "Script for the post-training int8 quantization of a DKPN model. "
+                                "The activation ranges are calibrated on the DEV split, "
+                                "while the float and int8 models are scored against each other on the TEST split. "
+                                "It needs to have the 'dkpn' folder in the working path."))
+
+parser.add_argument('-k', '--dkpn_model_name', type=str, required=True, help='DKPN model path')
+parser.add_argument('-d', '--dataset_name', type=str, default='INSTANCE', help='Dataset name for calibration and TEST')
+parser.add_argument('-s', '--dataset_size', type=str, default='Nano', help='Dataset size')
+parser.add_argument('-r', '--random_seed', type=int, default=42, help='Random seed')
+parser.add_argument('-c', '--calibration_batches', type=int, default=20, help='Number of DEV batches for calibration')
+parser.add_argument('-n', '--test_samples', type=int, default=5000, help='Number of test samples')
+parser.add_argument('-x', '--pickthreshold_p', type=float, default=0.2, help='Pick threshold P')
+parser.add_argument('-y', '--pickthreshold_s', type=float, default=0.2, help='Pick threshold S')
+parser.add_argument('-a', '--truepositive_p', type=int, default=10, help='Delta for declare True Positive P (samples)')
+parser.add_argument('-b', '--truepositive_s', type=int, default=20, help='Delta for declare True Positive S (samples)')
+parser.add_argument('-t', '--threads', type=int, default=None, help='Number of CPU threads for torch')
+parser.add_argument('-o', '--store_file', type=str, default=None, help='Store the int8 TorchScript network here')
+#
+args = parser.parse_args()
+
+if args.threads:
+    torch.set_num_threads(args.threads)
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+
+(train, dev, test) = dktrain.select_database_and_size(
+                            args.dataset_name, args.dataset_size,
+                            RANDOM_SEED=args.random_seed)
+
+print("Loading DKPN ... %s" % Path(args.dkpn_model_name).name)
+mydkpn = dkcore.load_dkpn(args.dkpn_model_name)
+mydkpn.eval()
+
+TRAIN_CLASS_DKPN = dktrain.TrainHelp_DomainKnowledgePhaseNet(
+                mydkpn, train, dev, test,
+                batch_size=64, num_workers=4,
+                random_seed=args.random_seed)
+(_, dev_generator_dkpn, test_generator_dkpn) = TRAIN_CLASS_DKPN.get_generator()
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+
+print("Calibrating int8 DKPN on %d DEV batches" % args.calibration_batches)
+calibration_loader = DataLoader(dev_generator_dkpn, batch_size=64,
+                                shuffle=True, num_workers=4)
+int8_dkpn = dkinfer.DKPN_Quantized.from_dkpn(
+                    mydkpn, calibration_loader,
+                    max_batches=args.calibration_batches)
+
+if args.store_file:
+    int8_dkpn.save_quantized(args.store_file)
+
+print("Scoring float32 and int8 DKPN on %d TEST samples" % args.test_samples)
+SCORES = dkbench.evaluate_pickers(
+                {"DKPN_fp32": mydkpn, "DKPN_int8": int8_dkpn},
+                test_generator_dkpn,
+                nsamples=args.test_samples,
+                thr_p=args.pickthreshold_p, thr_s=args.pickthreshold_s,
+                tp_p=args.truepositive_p, tp_s=args.truepositive_s,
+                random_seed=args.random_seed)
+print("")
+dkbench.print_score_deltas(SCORES, "DKPN_fp32")
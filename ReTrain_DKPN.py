@@ -2,11 +2,13 @@
 
 import os
 import pickle
+import functools
 import argparse
 from pprint import pprint
 import matplotlib.pyplot as plt
 from pathlib import Path
 
+import torch
 import obspy
 import seisbench as sb
 
@@ -24,6 +26,11 @@ print("")
 parser = argparse.ArgumentParser(description=(
                                 "Script for training DKPN using full SeisBench APIs and Augmentations. "
                                 "It needs to have the 'dkpn' folder in the working path. "
+                                "With --distributed it runs data-parallel on several processes/nodes and must be "
+                                "launched by torchrun, e.g. 'torchrun --nproc_per_node=4 ReTrain_DKPN.py --distributed ...' "
+                                "(multi-node: add --nnodes, --node_rank, --master_addr, --master_port). "
+                                "In that case BATCH_SIZE is per process (global batch = BATCH_SIZE * WORLD_SIZE) "
+                                "and only rank 0 writes the outputs. "
                                 "Requires Python >= 3.9"))
 
 parser.add_argument('-d', '--dataset_name', type=str, default='ETHZ', help='Dataset name')
@@ -34,11 +41,38 @@ parser.add_argument('-o', '--store_folder', type=str, default=None, help='Store
 parser.add_argument('-e', '--epochs', type=int, default=25, help='Max. Num. Epochs for training')
 parser.add_argument('-l', '--learning_rate', type=float, default=1e-3, help='Learning Rate for training')
 parser.add_argument('-b', '--batch_size', type=int, default=32, help='Batch-Size for training')
+parser.add_argument('-w', '--num_workers', type=int, default=24, help='DataLoader workers (per process)')
+parser.add_argument('--autotune_loaders', action="store_true", help='Probe and pick the fastest DataLoader workers/prefetch/pinning (persistent workers)')
+#
+parser.add_argument('--filters_root', type=int, default=8, help='DKPN architecture: number of filters of the first level')
+parser.add_argument('--depth', type=int, default=5, help='DKPN architecture: number of U-net levels')
+parser.add_argument('--kernel_size', type=int, default=7, help='DKPN architecture: convolution kernel size')
+parser.add_argument('--stride', type=int, default=4, help='DKPN architecture: down/up-sampling stride')
+#
+parser.add_argument('--teacher', type=str, default=None, help='Pretrained DKPN model path: distill it into the (student) DKPN')
+parser.add_argument('--distill_alpha', type=float, default=0.5, help='Weight of the teacher soft-target loss')
+parser.add_argument('--distill_temperature', type=float, default=2.0, help='Distillation temperature')
+parser.add_argument('--distill_cache', type=str, default=None, help='Folder for caching TRAIN windows and teacher logits')
+parser.add_argument('--distill_refresh', type=int, default=0, help='Re-draw the cached windows every N epochs (0 = never)')
 #
 parser.add_argument("--early_stop", action="store_true", help="Adopt early-stop regulation for epochs")
 parser.add_argument('-x', '--patience', type=int, default=5, help='Num. Epochs to evaluate for early stop')
 parser.add_argument('-y', '--delta', type=float, default=0.001, help='Mean dev_loss improvement over the latest patience epochs')
 #
+parser.add_argument('--checkpoint_folder', type=str, default=None, help='Store the early-stop weights and the training state here (instead of RAM)')
+parser.add_argument("--resume", action="store_true", help="Resume an interrupted training from the CHECKPOINT_FOLDER")
+#
+parser.add_argument('--frozen_dev', type=str, default=None, help='Materialize the DEV windows once in this folder and reuse them every epoch')
+parser.add_argument('--dev_batch_size', type=int, default=512, help='Batch-Size for the frozen DEV evaluation')
+#
+parser.add_argument("--timing", action="store_true", help="Record the per-batch data-wait/copy/forward/backward/step timings (TRAIN_TIMING.csv/.json)")
+parser.add_argument('--profile', type=str, default=None, help='Write a torch.profiler trace of some training batches in this folder (implies --timing)')
+parser.add_argument('--profile_wait', type=int, default=5, help='Batches to skip before the profiler trace')
+parser.add_argument('--profile_steps', type=int, default=10, help='Batches in the profiler trace')
+#
+parser.add_argument("--distributed", action="store_true", help="Data-parallel training over the torchrun processes")
+parser.add_argument('--backend', type=str, default="gloo", help='torch.distributed backend (gloo, nccl)')
+#
 args = parser.parse_args()
 
 print("---> Training: DKPN")
@@ -52,10 +86,39 @@ print(f"MAX. EPOCHS: {args.epochs}")
 print(f"LEARNING_RATE: {args.learning_rate}")
 print(f"BATCH_SIZE: {args.batch_size}")
 print("")
+print(f"FILTERS_ROOT: {args.filters_root}")
+print(f"DEPTH: {args.depth}")
+print(f"KERNEL_SIZE: {args.kernel_size}")
+print(f"STRIDE: {args.stride}")
+print("")
+if args.teacher:
+    print(f"TEACHER: {args.teacher}")
+    print(f"  ALPHA: {args.distill_alpha}")
+    print(f"  TEMPERATURE: {args.distill_temperature}")
+    print(f"  CACHE: {args.distill_cache}")
+    print(f"  REFRESH: {args.distill_refresh}")
+    print("")
 print(f"EARLY STOP: {args.early_stop}")
 print(f"  PATIENCE: {args.patience}")
 print(f"     DELTA: {args.delta}")
 print("")
+print(f"CHECKPOINT_FOLDER: {args.checkpoint_folder}")
+print(f"RESUME: {args.resume}")
+print("")
+print(f"FROZEN_DEV: {args.frozen_dev}")
+print(f"DEV_BATCH_SIZE: {args.dev_batch_size}")
+print("")
+print(f"TIMING: {args.timing}")
+print(f"PROFILE: {args.profile}")
+print("")
+print(f"NUM_WORKERS: {args.num_workers}")
+print(f"AUTOTUNE_LOADERS: {args.autotune_loaders}")
+print(f"DISTRIBUTED: {args.distributed}")
+if args.distributed:
+    print(f"  BACKEND: {args.backend}")
+    print(f"  WORLD_SIZE: {os.environ.get('WORLD_SIZE')}")
+    print(f"  RANK: {os.environ.get('RANK')}")
+print("")
 
 # ----------------------------------------------------------------------------
 # ----------------------------------------------------------------------------
@@ -74,15 +137,44 @@ print(" TEST samples %s:  %d" % (args.dataset_name, len(test)))
 # ----------------------------------------------------------------------------
 # INITIALIZE DKPN
 
-mydkpn = dkcore.DKPN()  # Instantiate
-mydkpn.cuda();
+if args.distributed:
+    # Same initial weights on every rank (DDP broadcasts rank 0 anyway)
+    torch.manual_seed(args.random_seed)
+mydkpn = dkcore.DKPN(filters_root=args.filters_root, depth=args.depth,
+                     kernel_size=args.kernel_size, stride=args.stride)  # Instantiate
+if args.distributed:
+    if torch.cuda.is_available():
+        mydkpn.to(torch.device("cuda:%d" % int(os.environ.get("LOCAL_RANK", 0))))
+else:
+    mydkpn.cuda();
 print("")
 print("CFs parameters:")
 pprint(mydkpn.get_defaults())   # This are the parameter that will be used!
 print("")
 
+if args.teacher and args.distributed:
+    raise ValueError("Distillation (--teacher) is not supported with --distributed")
+
+if args.teacher:
+    print("Loading TEACHER ... %s" % Path(args.teacher).name)
+    myteacher = dkcore.load_dkpn(args.teacher)
+    myteacher.cuda();
+    TRAIN_HELPER = functools.partial(
+                    dktrain.TrainHelp_DistillDKPN,
+                    teacher=myteacher,
+                    alpha=args.distill_alpha,
+                    temperature=args.distill_temperature,
+                    cache_folder=args.distill_cache,
+                    refresh_every=args.distill_refresh)
+elif args.distributed:
+    TRAIN_HELPER = functools.partial(
+                    dktrain.TrainHelp_DistributedDKPN,
+                    backend=args.backend)
+else:
+    TRAIN_HELPER = dktrain.TrainHelp_DomainKnowledgePhaseNet
+
 
-TRAIN_CLASS = dktrain.TrainHelp_DomainKnowledgePhaseNet(
+TRAIN_CLASS = TRAIN_HELPER(
                 mydkpn,  # It will contains the default args for StreamCF calculations!!!
                 train,
                 dev,
@@ -111,11 +203,23 @@ TRAIN_CLASS = dktrain.TrainHelp_DomainKnowledgePhaseNet(
                     },
                 },
                 batch_size=args.batch_size,
-                num_workers=24,
+                num_workers=args.num_workers,
                 random_seed=args.random_seed,
 )
 
 
+if args.autotune_loaders:
+    TRAIN_CLASS.autotune_loaders()
+
+if args.timing or args.profile:
+    TRAIN_CLASS.enable_timing(profile_dir=args.profile,
+                              profile_wait=args.profile_wait,
+                              profile_steps=args.profile_steps)
+
+if args.frozen_dev:
+    TRAIN_CLASS.freeze_dev(args.frozen_dev, batch_size=args.dev_batch_size)
+
+
 # ----------------------------------------------------------------------------
 # --------------->    ACTUAL TRAINING  <---------------
 
@@ -124,13 +228,22 @@ if args.early_stop:
      dev_loss_epochs, dev_loss_epochs_batches) = TRAIN_CLASS.train_me_early_stop(
         epochs=args.epochs, optimizer_type="adam",
         learning_rate=args.learning_rate,
-        patience=args.patience, delta=args.delta)
+        patience=args.patience, delta=args.delta,
+        checkpoint_folder=args.checkpoint_folder, resume=args.resume)
 
 else:
     (train_loss_epochs, train_loss_epochs_batches,
      dev_loss_epochs, dev_loss_epochs_batches) = TRAIN_CLASS.train_me(
         epochs=args.epochs, optimizer_type="adam",
-        learning_rate=args.learning_rate)
+        learning_rate=args.learning_rate,
+        checkpoint_folder=args.checkpoint_folder, resume=args.resume)
+
+if args.distributed:
+    _is_master = TRAIN_CLASS.is_master()
+    TRAIN_CLASS.finalize()
+    if not _is_master:
+        # Only rank 0 stores the outputs
+        raise SystemExit(0)
 
 # ----------------------------------------------------------------------------
 # --------------->    STORE   MODEL    <---------------
@@ -149,6 +262,7 @@ if not STORE_DIR_MODEL.is_dir():
     STORE_DIR_MODEL.mkdir(parents=True, exist_ok=True)
 
 TRAIN_CLASS.store_weigths(STORE_DIR_MODEL, MODEL_NAME, MODEL_NAME, version="1")
+TRAIN_CLASS.store_loader_config(STORE_DIR_MODEL)
 
 # ----------------------------------------------------------------------------
 # --------------->    STORE   LOSS  TABLE    <---------------
@@ -158,6 +272,10 @@ with open(str(STORE_DIR_MODEL / "TRAIN_TEST_loss.csv"), "w") as OUT:
     for xx, (trn, tst) in enumerate(zip(train_loss_epochs, dev_loss_epochs)):
         OUT.write(("%d, %.4f, %.4f"+os.linesep) % (xx, trn, tst))
 
+# --------------->    STORE   TIMINGS  (--timing)
+
+TRAIN_CLASS.store_timing(STORE_DIR_MODEL)
+
 # ----------------------------------------------------------------------------
 # --------------->    STORE   LOSS  PICKLE    <---------------
 
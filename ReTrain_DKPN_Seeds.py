@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import os
+import pickle
+import argparse
+from pprint import pprint
+import matplotlib.pyplot as plt
+from pathlib import Path
+
+import obspy
+import seisbench as sb
+import torch
+
+import dkpn.core as dkcore
+import dkpn.train as dktrain
+
+
+print(" SB version:  %s" % sb.__version__)
+print("OBS version:  %s" % obspy.__version__)
+print("")
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description=(
+                                "Script for training several DKPN replicas (one per initialization seed) "
+                                "in a single process, on the same batches and with a single batched forward pass. "
+                                "The RANDOM_SEED selects the data split, the SEEDS the initializations. "
+                                "It needs to have the 'dkpn' folder in the working path. "
+                                "Requires Python >= 3.9"))
+
+parser.add_argument('-d', '--dataset_name', type=str, default='ETHZ', help='Dataset name')
+parser.add_argument('-s', '--dataset_size', type=str, default='Nano', help='Dataset size')
+parser.add_argument('-r', '--random_seed', type=int, default=42, help='Random seed')
+parser.add_argument('-i', '--seeds', type=int, nargs="+", default=[17, 36, 50, 142, 234, 777, 987], help='Initialization seeds (one replica each)')
+parser.add_argument('-o', '--store_folder', type=str, default=None, help='Store folder (one sub-folder per replica)')
+#
+parser.add_argument('-e', '--epochs', type=int, default=25, help='Max. Num. Epochs for training')
+parser.add_argument('-l', '--learning_rate', type=float, default=1e-3, help='Learning Rate for training')
+parser.add_argument('-b', '--batch_size', type=int, default=32, help='Batch-Size for training')
+parser.add_argument('-w', '--num_workers', type=int, default=24, help='DataLoader workers')
+parser.add_argument('--autotune_loaders', action="store_true", help='Probe and pick the fastest DataLoader workers/prefetch/pinning (persistent workers)')
+#
+parser.add_argument('--filters_root', type=int, default=8, help='DKPN architecture: number of filters of the first level')
+parser.add_argument('--depth', type=int, default=5, help='DKPN architecture: number of U-net levels')
+parser.add_argument('--kernel_size', type=int, default=7, help='DKPN architecture: convolution kernel size')
+parser.add_argument('--stride', type=int, default=4, help='DKPN architecture: down/up-sampling stride')
+#
+parser.add_argument("--early_stop", action="store_true", help="Adopt early-stop regulation for epochs")
+parser.add_argument('-x', '--patience', type=int, default=5, help='Num. Epochs to evaluate for early stop')
+parser.add_argument('-y', '--delta', type=float, default=0.001, help='Mean dev_loss improvement over the latest patience epochs')
+parser.add_argument('--checkpoint_folder', type=str, default=None, help='Store the early-stop weights here (instead of RAM)')
+#
+parser.add_argument('--frozen_dev', type=str, default=None, help='Materialize the DEV windows once in this folder and reuse them every epoch')
+parser.add_argument('--dev_batch_size', type=int, default=512, help='Batch-Size for the frozen DEV evaluation')
+#
+args = parser.parse_args()
+
+print("---> Training: DKPN replicas")
+print("")
+print(f"DATASET_NAME: {args.dataset_name}")
+print(f"DATASET_SIZE: {args.dataset_size}")
+print(f"RANDOM_SEED: {args.random_seed}")
+print(f"SEEDS: {args.seeds}")
+print(f"STORE_FOLDER: {args.store_folder}")
+print("")
+print(f"MAX. EPOCHS: {args.epochs}")
+print(f"LEARNING_RATE: {args.learning_rate}")
+print(f"BATCH_SIZE: {args.batch_size}")
+print(f"NUM_WORKERS: {args.num_workers}")
+print(f"AUTOTUNE_LOADERS: {args.autotune_loaders}")
+print("")
+print(f"FILTERS_ROOT: {args.filters_root}")
+print(f"DEPTH: {args.depth}")
+print(f"KERNEL_SIZE: {args.kernel_size}")
+print(f"STRIDE: {args.stride}")
+print("")
+print(f"EARLY STOP: {args.early_stop}")
+print(f"  PATIENCE: {args.patience}")
+print(f"     DELTA: {args.delta}")
+print("")
+print(f"CHECKPOINT_FOLDER: {args.checkpoint_folder}")
+print(f"FROZEN_DEV: {args.frozen_dev}")
+print("")
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# SELECT DATASET and SIZE
+
+(train, dev, test) = dktrain.select_database_and_size(
+                            args.dataset_name, args.dataset_size,
+                            RANDOM_SEED=args.random_seed)
+
+print("TRAIN samples %s:  %d" % (args.dataset_name, len(train)))
+print("  DEV samples %s:  %d" % (args.dataset_name, len(dev)))
+print(" TEST samples %s:  %d" % (args.dataset_name, len(test)))
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# INITIALIZE DKPN replicas
+
+DKPN_LIST = []
+for seed in args.seeds:
+    torch.manual_seed(seed)
+    DKPN_LIST.append(dkcore.DKPN(filters_root=args.filters_root, depth=args.depth,
+                                 kernel_size=args.kernel_size, stride=args.stride))
+    DKPN_LIST[-1].cuda();
+print("")
+print("CFs parameters:")
+pprint(DKPN_LIST[0].get_defaults())   # This are the parameter that will be used!
+print("")
+
+TRAIN_CLASS = dktrain.TrainHelp_MultiSeedDKPN(
+                DKPN_LIST,  # They contain the default args for StreamCF calculations!!!
+                train,
+                dev,
+                test,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                random_seed=args.random_seed,
+)
+
+if args.autotune_loaders:
+    TRAIN_CLASS.autotune_loaders()
+
+if args.frozen_dev:
+    TRAIN_CLASS.freeze_dev(args.frozen_dev, batch_size=args.dev_batch_size)
+
+
+# ----------------------------------------------------------------------------
+# --------------->    ACTUAL TRAINING  <---------------
+
+HISTORY = TRAIN_CLASS.train_me_replicas(
+                epochs=args.epochs, optimizer_type="adam",
+                learning_rate=args.learning_rate,
+                early_stop=args.early_stop,
+                patience=args.patience, delta=args.delta,
+                checkpoint_folder=args.checkpoint_folder)
+
+# ----------------------------------------------------------------------------
+# --------------->    STORE  (one folder per replica, as ReTrain_DKPN.py)
+
+for (rep, seed) in enumerate(args.seeds):
+    (train_loss_epochs, train_loss_epochs_batches,
+     dev_loss_epochs, dev_loss_epochs_batches) = HISTORY[rep]
+
+    _actual_epochs = TRAIN_CLASS.__training_epochs__[rep]
+    MODEL_NAME = "DKPN_TrainDataset_%s_Size_%s_Rnd_%d_Epochs_%d_LR_%06.4f_Batch_%d" % (
+                        args.dataset_name, args.dataset_size, seed,
+                        _actual_epochs, args.learning_rate, args.batch_size)
+
+    if not args.store_folder:
+        STORE_DIR_MODEL = Path(MODEL_NAME)
+    else:
+        STORE_DIR_MODEL = Path(args.store_folder) / MODEL_NAME
+    #
+    if not STORE_DIR_MODEL.is_dir():
+        STORE_DIR_MODEL.mkdir(parents=True, exist_ok=True)
+
+    TRAIN_CLASS.store_weigths_replica(rep, STORE_DIR_MODEL, MODEL_NAME, MODEL_NAME, version="1")
+    TRAIN_CLASS.store_loader_config(STORE_DIR_MODEL)
+
+    # --------------->    STORE   LOSS  TABLE    <---------------
+
+    with open(str(STORE_DIR_MODEL / "TRAIN_TEST_loss.csv"), "w") as OUT:
+        OUT.write("EPOCH, TRAIN_LOSS, TEST_LOSS"+os.linesep)
+        for xx, (trn, tst) in enumerate(zip(train_loss_epochs, dev_loss_epochs)):
+            OUT.write(("%d, %.4f, %.4f"+os.linesep) % (xx, trn, tst))
+
+    # --------------->    STORE   LOSS  PICKLE    <---------------
+
+    TRAIN_LOSSES = []
+    for xx, (av_loss, batch_loss) in enumerate(zip(train_loss_epochs, train_loss_epochs_batches)):
+        TRAIN_LOSSES.append((av_loss, batch_loss))
+    with open(str(STORE_DIR_MODEL / 'TRAIN_loss_batches.pickle'), 'wb') as file:
+        pickle.dump(TRAIN_LOSSES, file)
+
+    DEV_LOSSES = []
+    for xx, (av_loss, batch_loss) in enumerate(zip(dev_loss_epochs, dev_loss_epochs_batches)):
+        DEV_LOSSES.append((av_loss, batch_loss))
+    with open(str(STORE_DIR_MODEL / 'DEV_loss_batches.pickle'), 'wb') as file:
+        pickle.dump(DEV_LOSSES, file)
+
+    # --------------->    STORE   PARAMETERS    <---------------
+
+    with open(str(STORE_DIR_MODEL / "TRAIN_ARGS.py"), "w") as OUT:
+        OUT.write("TRAINARGS=%s" % args)
+
+    # Store DATABASE INFO
+    with open(str(STORE_DIR_MODEL / "TRAIN_DATA_INFO.txt"), "w") as OUT:
+        OUT.write(("TRAIN samples %s:  %d"+os.linesep) % (args.dataset_name,
+                                                          len(train)))
+        OUT.write(("  DEV samples %s:  %d"+os.linesep) % (args.dataset_name,
+                                                          len(dev)))
+        OUT.write((" TEST samples %s:  %d"+os.linesep) % (args.dataset_name,
+                                                          len(test)))
+
+    # ------------------------------------------------------------------------
+    fig = plt.figure(figsize=(10, 7))
+    plt.plot(train_loss_epochs, label="TRAIN_Loss", color="red", lw=2)
+    plt.plot(dev_loss_epochs, label="DEV_Loss", color="teal", lw=2)
+    plt.xlabel("epochs")
+    plt.ylabel("cross-entropy loss")
+    plt.legend()
+    plt.tight_layout()
+    fig.savefig(str(STORE_DIR_MODEL / "TrainTest_LOSS.pdf"))
+    plt.close(fig)
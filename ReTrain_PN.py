@@ -34,11 +34,24 @@ parser.add_argument('-o', '--store_folder', type=str, default=None, help='Store
 parser.add_argument('-e', '--epochs', type=int, default=25, help='Max. Num. Epochs for training')
 parser.add_argument('-l', '--learning_rate', type=float, default=1e-3, help='Learning Rate for training')
 parser.add_argument('-b', '--batch_size', type=int, default=32, help='Batch-Size for training')
+parser.add_argument('-w', '--num_workers', type=int, default=24, help='DataLoader workers')
+parser.add_argument('--autotune_loaders', action="store_true", help='Probe and pick the fastest DataLoader workers/prefetch/pinning (persistent workers)')
 #
 parser.add_argument("--early_stop", action="store_true", help="Adopt early-stop regulation for epochs")
 parser.add_argument('-x', '--patience', type=int, default=5, help='Num. Epochs to evaluate for early stop')
 parser.add_argument('-y', '--delta', type=float, default=0.001, help='Mean dev_loss improvement over the latest patience epochs')
 #
+parser.add_argument('--checkpoint_folder', type=str, default=None, help='Store the early-stop weights and the training state here (instead of RAM)')
+parser.add_argument("--resume", action="store_true", help="Resume an interrupted training from the CHECKPOINT_FOLDER")
+#
+parser.add_argument('--frozen_dev', type=str, default=None, help='Materialize the DEV windows once in this folder and reuse them every epoch')
+parser.add_argument('--dev_batch_size', type=int, default=512, help='Batch-Size for the frozen DEV evaluation')
+#
+parser.add_argument("--timing", action="store_true", help="Record the per-batch data-wait/copy/forward/backward/step timings (TRAIN_TIMING.csv/.json)")
+parser.add_argument('--profile', type=str, default=None, help='Write a torch.profiler trace of some training batches in this folder (implies --timing)')
+parser.add_argument('--profile_wait', type=int, default=5, help='Batches to skip before the profiler trace')
+parser.add_argument('--profile_steps', type=int, default=10, help='Batches in the profiler trace')
+#
 args = parser.parse_args()
 
 print("---> Training: PhaseNet")
@@ -51,11 +64,22 @@ print("")
 print(f"MAX. EPOCHS: {args.epochs}")
 print(f"LEARNING_RATE: {args.learning_rate}")
 print(f"BATCH_SIZE: {args.batch_size}")
+print(f"NUM_WORKERS: {args.num_workers}")
+print(f"AUTOTUNE_LOADERS: {args.autotune_loaders}")
 print("")
 print(f"EARLY STOP: {args.early_stop}")
 print(f"  PATIENCE: {args.patience}")
 print(f"     DELTA: {args.delta}")
 print("")
+print(f"CHECKPOINT_FOLDER: {args.checkpoint_folder}")
+print(f"RESUME: {args.resume}")
+print("")
+print(f"FROZEN_DEV: {args.frozen_dev}")
+print(f"DEV_BATCH_SIZE: {args.dev_batch_size}")
+print("")
+print(f"TIMING: {args.timing}")
+print(f"PROFILE: {args.profile}")
+print("")
 
 # ----------------------------------------------------------------------------
 # ----------------------------------------------------------------------------
@@ -107,11 +131,23 @@ TRAIN_CLASS = dktrain.TrainHelp_PhaseNet(
                     },
                 },
                 batch_size=args.batch_size,
-                num_workers=24,
+                num_workers=args.num_workers,
                 random_seed=args.random_seed,
 )
 
 
+if args.autotune_loaders:
+    TRAIN_CLASS.autotune_loaders()
+
+if args.timing or args.profile:
+    TRAIN_CLASS.enable_timing(profile_dir=args.profile,
+                              profile_wait=args.profile_wait,
+                              profile_steps=args.profile_steps)
+
+if args.frozen_dev:
+    TRAIN_CLASS.freeze_dev(args.frozen_dev, batch_size=args.dev_batch_size)
+
+
 # ----------------------------------------------------------------------------
 # --------------->    ACTUAL TRAINING  <---------------
 
@@ -120,13 +156,15 @@ if args.early_stop:
      dev_loss_epochs, dev_loss_epochs_batches) = TRAIN_CLASS.train_me_early_stop(
         epochs=args.epochs, optimizer_type="adam",
         learning_rate=args.learning_rate,
-        patience=args.patience, delta=args.delta)
+        patience=args.patience, delta=args.delta,
+        checkpoint_folder=args.checkpoint_folder, resume=args.resume)
 
 else:
     (train_loss_epochs, train_loss_epochs_batches,
      dev_loss_epochs, dev_loss_epochs_batches) = TRAIN_CLASS.train_me(
         epochs=args.epochs, optimizer_type="adam",
-        learning_rate=args.learning_rate)
+        learning_rate=args.learning_rate,
+        checkpoint_folder=args.checkpoint_folder, resume=args.resume)
 
 # ----------------------------------------------------------------------------
 # --------------->    STORE   MODEL    <---------------
@@ -145,6 +183,7 @@ if not STORE_DIR_MODEL.is_dir():
     STORE_DIR_MODEL.mkdir(parents=True, exist_ok=True)
 
 TRAIN_CLASS.store_weigths(STORE_DIR_MODEL, MODEL_NAME, MODEL_NAME, version="1")
+TRAIN_CLASS.store_loader_config(STORE_DIR_MODEL)
 
 # ----------------------------------------------------------------------------
 # --------------->    STORE   LOSS  TABLE    <---------------
@@ -154,6 +193,10 @@ with open(str(STORE_DIR_MODEL / "TRAIN_TEST_loss.csv"), "w") as OUT:
     for xx, (trn, tst) in enumerate(zip(train_loss_epochs, dev_loss_epochs)):
         OUT.write(("%d, %.4f, %.4f"+os.linesep) % (xx, trn, tst))
 
+# --------------->    STORE   TIMINGS  (--timing)
+
+TRAIN_CLASS.store_timing(STORE_DIR_MODEL)
+
 # ----------------------------------------------------------------------------
 # --------------->    STORE   LOSS  PICKLE    <---------------
 
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path
+
+import dkpn.eval_utils as EV
+
+
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+# ----------------------------------------------------------------------------
+parser = argparse.ArgumentParser(description=(
+                                "Draw the pending figures of LoadEvaluate_DKPN.py results folders "
+                                "(run with '--plot_workers 0', or interrupted before the end). "
+                                "It needs to have the 'dkpn' folder in the working path. "
+                                "Requires Python >= 3.9"))
+
+parser.add_argument('folders', type=str, nargs="+", help='Results folders')
+parser.add_argument('-w', '--plot_workers', type=int, default=4, help='Processes drawing the figures')
+#
+args = parser.parse_args()
+
+PLOTS = EV.PlotPool(processes=args.plot_workers)
+for folder in args.folders:
+    print("%s:  %d pending figures" % (folder, PLOTS.resume(Path(folder))))
+
+print("... %d figures saved" % PLOTS.close())
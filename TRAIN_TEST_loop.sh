@@ -7,6 +7,8 @@ LR="0.0010"   # Must be a %.04f FORMAT!
 PATIENCE="5"
 IMPROVEMENT="0.0005"
 
+JOINT="0"   # 1: train DKPN and PN together on the same data pipeline
+
 # =================================================================
 # =================================================================
 # =================================================================
@@ -43,18 +45,28 @@ for ((i=0; i<length; i++)); do
   echo ""
   echo ""
   echo "... Working with ---> ${TRAINDATA}  /  ${DATASIZE} - ${EPOCHSNUM} Epochs"
-  echo ""
-  echo "... Training DKPN"
-  ./ReTrain_DKPN.py -d ${TRAINDATA} -s ${DATASIZE} -r ${RND} \
+  if [ "${JOINT}" == "1" ]; then
+    echo ""
+    echo "... Training DKPN + PhaseNet"
+    ./ReTrain_DKPN_PN.py -d ${TRAINDATA} -s ${DATASIZE} -r ${RND} \
+                         -e ${EPOCHSNUM} -b ${BATCH} -l ${LR} \
+                         -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
+                         -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
+                         --early_stop -x ${PATIENCE} -y ${IMPROVEMENT}
+  else
+    echo ""
+    echo "... Training DKPN"
+    ./ReTrain_DKPN.py -d ${TRAINDATA} -s ${DATASIZE} -r ${RND} \
+                      -e ${EPOCHSNUM} -b ${BATCH} -l ${LR} \
+                      -o DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
+                      --early_stop -x ${PATIENCE} -y ${IMPROVEMENT}
+    echo ""
+    echo "... Training PhaseNet"
+    ./ReTrain_PN.py -d ${TRAINDATA} -s ${DATASIZE} -r ${RND} \
                     -e ${EPOCHSNUM} -b ${BATCH} -l ${LR} \
-                    -o DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
+                    -o PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                     --early_stop -x ${PATIENCE} -y ${IMPROVEMENT}
-  echo ""
-  echo "... Training PhaseNet"
-  ./ReTrain_PN.py -d ${TRAINDATA} -s ${DATASIZE} -r ${RND} \
-                  -e ${EPOCHSNUM} -b ${BATCH} -l ${LR} \
-                  -o PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
-                  --early_stop -x ${PATIENCE} -y ${IMPROVEMENT}
+  fi
 
   # --- In-Domain  TEST
   echo ""
@@ -62,12 +74,12 @@ for ((i=0; i<length; i++)); do
   ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -d ${TESTDATA_INDOMAIN} -s ${DATASIZE} \
-                         -x 0.2 -y 0.2 -n 5000 -f 10 -a 10 -b 20 \
+                         -x 0.2 -y 0.2 -n 5000 -f 10 -a 10 -b 20 --store_residuals \
                          -o Results_${TRAINDATA}_${TRAINDATA}_${DATASIZE}_02
   ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -d ${TESTDATA_INDOMAIN} -s ${DATASIZE} \
-                         -x 0.5 -y 0.5 -n 5000 -f 10 -a 10 -b 20 \
+                         -x 0.5 -y 0.5 -n 5000 -f 10 -a 10 -b 20 --store_residuals \
                          -o Results_${TRAINDATA}_${TRAINDATA}_${DATASIZE}_05
 
   # --- Cross-Domain  TEST
@@ -76,12 +88,12 @@ for ((i=0; i<length; i++)); do
   ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -d ${TESTDATA_CROSSDOMAIN} -s ${DATASIZE} \
-                         -x 0.2 -y 0.2 -n 5000 -f 10 -a 10 -b 20 \
+                         -x 0.2 -y 0.2 -n 5000 -f 10 -a 10 -b 20 --store_residuals \
                          -o Results_${TRAINDATA}_${TESTDATA_CROSSDOMAIN}_${DATASIZE}_02
   ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                          -d ${TESTDATA_CROSSDOMAIN} -s ${DATASIZE} \
-                         -x 0.5 -y 0.5 -n 5000 -f 10 -a 10 -b 20 \
+                         -x 0.5 -y 0.5 -n 5000 -f 10 -a 10 -b 20 --store_residuals \
                          -o Results_${TRAINDATA}_${TESTDATA_CROSSDOMAIN}_${DATASIZE}_05
 
 done
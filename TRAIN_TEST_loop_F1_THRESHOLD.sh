@@ -31,7 +31,6 @@ TESTDATACROSSDOMAIN=("ETHZ" "PNW" "AQUILA")
 
 # Loop over the array
 length=${#SIZES[@]}  # Get the length of the array
-length_thr=${#THRESHOLDS[@]}
 length_test_data=${#TESTDATACROSSDOMAIN[@]}
 
 for ((a=0; a<length; a++)); do
@@ -53,32 +52,30 @@ for ((a=0; a<length; a++)); do
   #                 -o PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
   #                 --early_stop -x ${PATIENCE} -y ${IMPROVEMENT}
 
-  for ((b=0; b<length_thr; b++)); do
-    THR=${THRESHOLDS[b]}
+  # --- All the THRESHOLDS are scored on the same predictions:
+  #     one Results_..._${THR} folder each
+  echo "...    Thresholds ---> ${THRESHOLDS[@]}"
 
-    echo "...    Threshold ---> ${THR}"
+  # --- In-Domain  TEST
+  echo ""
+  echo "... Test IN-DOMAIN"
+  ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
+                         -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
+                         -d ${TRAINDATA} -s ${DATASIZE} \
+                         -t ${THRESHOLDS[@]} -n 5000 -f 100 -a 10 -b 20 --store_residuals \
+                         -o Results_${TRAINDATA}_${TRAINDATA}_${DATASIZE}
+
+  for ((c=0; c<length_test_data; c++)); do
+    CROSS=${TESTDATACROSSDOMAIN[c]}
 
-    # --- In-Domain  TEST
+    # --- Cross-Domain  TEST
     echo ""
-    echo "... Test IN-DOMAIN"
+    echo "... Test CROSS-DOMAIN"
     ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
                            -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
-                           -d ${TRAINDATA} -s ${DATASIZE} \
-                           -x ${THR} -y ${THR} -n 5000 -f 100 -a 10 -b 20 \
-                           -o Results_${TRAINDATA}_${TRAINDATA}_${DATASIZE}_${THR}
-
-    for ((c=0; c<length_test_data; c++)); do
-      CROSS=${TESTDATACROSSDOMAIN[c]}
-
-      # --- Cross-Domain  TEST
-      echo ""
-      echo "... Test CROSS-DOMAIN"
-      ./LoadEvaluate_DKPN.py -k DKPN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
-                             -p PN_TrainDataset_${TRAINDATA}_Size_${DATASIZE}_Rnd_${RND}_LR_${LR}_Batch_${BATCH} \
-                             -d ${CROSS} -s ${DATASIZE} \
-                             -x ${THR} -y ${THR} -n 5000 -f 100 -a 10 -b 20 \
-                             -o Results_${TRAINDATA}_${CROSS}_${DATASIZE}_${THR}
-    done
+                           -d ${CROSS} -s ${DATASIZE} \
+                           -t ${THRESHOLDS[@]} -n 5000 -f 100 -a 10 -b 20 --store_residuals \
+                           -o Results_${TRAINDATA}_${CROSS}_${DATASIZE}
   done
 done
 
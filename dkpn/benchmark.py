@@ -0,0 +1,293 @@
+import time
+import hashlib
+import functools
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+
+import dkpn.eval_utils as EV
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+def __random_batch__(batch_size, in_channels=5, in_samples=3001, seed=42):
+    rng = np.random.default_rng(seed)
+    return torch.tensor(
+            rng.standard_normal((batch_size, in_channels, in_samples)),
+            dtype=torch.float32)
+
+
+def benchmark_latency(model, batch_sizes=(1, 8, 32, 64),
+                      in_channels=5, in_samples=3001,
+                      repeat=20, warmup=3, num_threads=None):
+    """ Measure the CPU forward latency of MODEL for every batch size.
+        MODEL can be anything callable on a (batch, channels, samples)
+        tensor (eager, TorchScript, ...).
+        Returns a dict {batch_size: (mean_ms, std_ms, samples_per_sec)}
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    outdict = {}
+    for bs in batch_sizes:
+        xx = __random_batch__(bs, in_channels, in_samples)
+        with torch.no_grad():
+            for _ in range(warmup):
+                model(xx)
+            timings = []
+            for _ in range(repeat):
+                _t0 = time.perf_counter()
+                model(xx)
+                timings.append(time.perf_counter() - _t0)
+        timings = np.array(timings) * 1000.0
+        outdict[bs] = (np.mean(timings), np.std(timings),
+                       bs / (np.mean(timings) / 1000.0))
+    return outdict
+
+
+def compare_outputs(model_ref, model_test, batch_size=8,
+                    in_channels=5, in_samples=3001):
+    """ Return the max. absolute difference between the two models'
+        output on the same random batch """
+    xx = __random_batch__(batch_size, in_channels, in_samples)
+    with torch.no_grad():
+        ref = model_ref(xx)
+        tst = model_test(xx)
+    return float((ref - tst).abs().max())
+
+
+def print_latency_table(results_dict, out=print):
+    """ RESULTS_DICT is a {name: benchmark_latency-output} dict """
+    out("%-20s %7s %12s %12s %14s" % ("MODEL", "BATCH", "MEAN (ms)",
+                                      "STD (ms)", "SAMPLES/s"))
+    for name, res in results_dict.items():
+        for bs, (mean_ms, std_ms, sps) in res.items():
+            out("%-20s %7d %12.3f %12.3f %14.1f" % (name, bs, mean_ms,
+                                                    std_ms, sps))
+
+
+def count_parameters(model):
+    return sum(pp.numel() for pp in model.parameters())
+
+
+def variant_label(model):
+    """ Short architecture tag of a DKPN model """
+    return "FR%d_D%d_K%d_S%d" % (model.filters_root, model.depth,
+                                 model.kernel_size, model.stride)
+
+
+def benchmark_variants(models, batch_sizes=(1, 32), repeat=20,
+                       num_threads=None, fused=True):
+    """ Latency and size of several DKPN architectures.
+        MODELS is a list of DKPN instances (trained or not).
+        Returns {label: (n_parameters, benchmark_latency-output)}
+    """
+    outdict = {}
+    for model in models:
+        model.eval()
+        if fused:
+            net = model.optimize_for_inference()
+        else:
+            net = model
+        outdict[variant_label(model)] = (
+                count_parameters(model),
+                benchmark_latency(net, batch_sizes=batch_sizes,
+                                  in_channels=model.in_channels,
+                                  in_samples=model.in_samples,
+                                  repeat=repeat, num_threads=num_threads))
+    return outdict
+
+
+def print_variants_table(variants_dict, scores=None, out=print):
+    """ VARIANTS_DICT is the `benchmark_variants` output, SCORES the
+        optional `evaluate_pickers` output keyed by the same labels """
+    out("%-20s %10s %7s %12s %8s %8s" % ("VARIANT", "PARAMS", "BATCH",
+                                         "MEAN (ms)", "P_F1", "S_F1"))
+    for name, (nparams, res) in variants_dict.items():
+        for bs, (mean_ms, _, _) in res.items():
+            if scores and name in scores:
+                (p_f1, s_f1) = (scores[name]["P"][0], scores[name]["S"][0])
+                out("%-20s %10d %7d %12.3f %8.4f %8.4f" % (
+                        name, nparams, bs, mean_ms, p_f1, s_f1))
+            else:
+                out("%-20s %10d %7d %12.3f %8s %8s" % (
+                        name, nparams, bs, mean_ms, "-", "-"))
+
+
+def evaluate_pickers(models_dict, generator, nsamples=1000,
+                     batch_size=64, num_workers=0,
+                     thr_p=0.2, thr_s=0.2, tp_p=10, tp_s=20,
+                     random_seed=42):
+    """ Score several pickers on the SAME augmented windows of GENERATOR
+        (e.g. the DKPN test generator of a `TrainHelp` class), using the
+        `eval_utils.extract_picks` / `eval_utils.compare_picks` statistics.
+        MODELS_DICT is a {name: model} dict.
+        Returns {name: {"P": (f1, precision, recall),
+                        "S": (f1, precision, recall),
+                        "time": forward-seconds}}
+    """
+    rng = np.random.default_rng(seed=random_seed)
+    rnidx = rng.choice(np.arange(len(generator)),
+                       size=min(nsamples, len(generator)),
+                       replace=False)
+    loader = DataLoader(Subset(generator, rnidx), batch_size=batch_size,
+                        shuffle=False, num_workers=num_workers)
+
+    stats = {}
+    for name in models_dict.keys():
+        stats[name] = {"P": EV.__reset_stats_dict__(),
+                       "S": EV.__reset_stats_dict__(),
+                       "time": 0.0}
+
+    for batch in loader:
+        labels = batch["y"].numpy()
+        for name, model in models_dict.items():
+            _t0 = time.perf_counter()
+            with torch.no_grad():
+                preds = model(batch["X"]).cpu().numpy()
+            stats[name]["time"] += time.perf_counter() - _t0
+
+            for (_ch, _phase, _thr, _tp) in ((0, "P", thr_p, tp_p),
+                                             (1, "S", thr_s, tp_s)):
+                (picks_model, _, _, offs_model, _) = EV.extract_picks_batch(
+                                            preds[:, _ch], smooth=True, thr=_thr)
+                (picks_label, _, _, offs_label, _) = EV.extract_picks_batch(
+                                            labels[:, _ch], smooth=True, thr=_thr)
+                (stats[name][_phase], _, _) = EV.compare_picks_batch(
+                                            EV.pad_picks(picks_model, offsets=offs_model),
+                                            EV.pad_picks(picks_label, offsets=offs_label),
+                                            stats[name][_phase], thr=_tp)
+
+    scores = {}
+    for name in models_dict.keys():
+        scores[name] = {"P": EV.calculate_scores(stats[name]["P"]),
+                        "S": EV.calculate_scores(stats[name]["S"]),
+                        "time": stats[name]["time"]}
+    return scores
+
+
+def print_score_deltas(scores, reference, out=print):
+    """ Print F1/precision/recall and speed-up of every picker in SCORES
+        (output of `evaluate_pickers`) with respect to the REFERENCE one """
+    ref = scores[reference]
+    out("%-20s %6s %8s %8s %8s %10s %10s %10s %9s" % (
+            "MODEL", "PHASE", "F1", "PREC", "REC",
+            "dF1", "dPREC", "dREC", "SPEEDUP"))
+    for name, res in scores.items():
+        for phase in ("P", "S"):
+            (f1, prec, rec) = res[phase]
+            (rf1, rprec, rrec) = ref[phase]
+            out("%-20s %6s %8.4f %8.4f %8.4f %+10.4f %+10.4f %+10.4f %8.2fx" % (
+                    name, phase, f1, prec, rec,
+                    f1 - rf1, prec - rprec, rec - rrec,
+                    ref["time"] / (res["time"] + 1e-12)))
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+def __fixed_seed_worker__(wid, seed):
+    np.random.seed(seed)
+
+
+class __IndexedSubset__(Dataset):
+    """ Subset of a generator whose items carry their index """
+
+    def __init__(self, generator, indices):
+        self.generator = generator
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        item = dict(self.generator[self.indices[idx]])
+        item["idx"] = idx
+        return item
+
+
+def augmentation_diversity(generator, seeding="stream", nsamples=256,
+                           epochs=5, batch_size=32, num_workers=4,
+                           random_seed=42):
+    """ Effective diversity of the augmented views of GENERATOR (e.g. the
+        DKPN train generator of a `TrainHelp` class): the same NSAMPLES
+        are drawn for EPOCHS epochs and every view 'X' is hashed.
+        SEEDING is 'fixed' (every worker seeded with RANDOM_SEED, the old
+        scheme) or 'stream' (`train.seed_worker_stream`).
+        Returns {"unique_views": distinct views / drawn views,
+                 "views_per_sample": mean distinct views of a sample
+                                     (at most EPOCHS),
+                 "time": seconds}
+    """
+    from dkpn.train import seed_worker_stream, loader_generator
+
+    if seeding == "fixed":
+        worker_init_fn = functools.partial(__fixed_seed_worker__,
+                                           seed=random_seed)
+    elif seeding == "stream":
+        worker_init_fn = seed_worker_stream
+    else:
+        raise ValueError("SEEDING must be 'fixed' or 'stream'")
+
+    rng = np.random.default_rng(seed=random_seed)
+    rnidx = rng.choice(np.arange(len(generator)),
+                       size=min(nsamples, len(generator)),
+                       replace=False)
+    loader = DataLoader(__IndexedSubset__(generator, rnidx),
+                        batch_size=batch_size, shuffle=True,
+                        num_workers=num_workers,
+                        worker_init_fn=worker_init_fn,
+                        generator=loader_generator(random_seed))
+
+    views = [set() for _ in rnidx]
+    _t0 = time.perf_counter()
+    for _ in range(epochs):
+        for batch in loader:
+            for (_idx, _x) in zip(batch["idx"].tolist(), batch["X"].numpy()):
+                views[_idx].add(hashlib.sha1(_x.tobytes()).hexdigest())
+    _time = time.perf_counter() - _t0
+
+    nviews = np.array([len(vv) for vv in views])
+    return {"unique_views": float(nviews.sum() / (len(rnidx) * epochs)),
+            "views_per_sample": float(nviews.mean()),
+            "time": _time}
+
+
+def time_to_target_loss(train_help, target_loss, max_epochs=25,
+                        learning_rate=1e-3):
+    """ Train the model of TRAIN_HELP (a `TrainHelp` class) with Adam
+        until its DEV loss reaches TARGET_LOSS, or for MAX_EPOCHS.
+        Returns (epochs or None if not reached, seconds, dev losses)
+    """
+    optim = torch.optim.Adam(train_help.trainmod.parameters(),
+                             lr=learning_rate)
+    dev_losses = []
+    _t0 = time.perf_counter()
+    for tt in range(max_epochs):
+        train_help.__train_loop__(optim)
+        (_dev_loss, _) = train_help.__test_loop__()
+        dev_losses.append(_dev_loss)
+        if _dev_loss <= target_loss:
+            return (tt + 1, time.perf_counter() - _t0, dev_losses)
+    return (None, time.perf_counter() - _t0, dev_losses)
+
+
+def print_seeding_table(results_dict, out=print):
+    """ RESULTS_DICT is {seeding: (augmentation_diversity-output,
+                                   time_to_target_loss-output or None)} """
+    out("%-10s %12s %12s %10s %8s %12s %10s" % (
+            "SEEDING", "UNIQUE_VIEWS", "VIEWS/SMP", "DRAW (s)",
+            "EPOCHS", "TARGET (s)", "LAST_DEV"))
+    for name, (div, ttt) in results_dict.items():
+        if ttt:
+            (_ep, _sec, _dev) = ttt
+            out("%-10s %12.4f %12.2f %10.2f %8s %12.1f %10.4f" % (
+                    name, div["unique_views"], div["views_per_sample"],
+                    div["time"], _ep if _ep else "-", _sec, _dev[-1]))
+        else:
+            out("%-10s %12.4f %12.2f %10.2f %8s %12s %10s" % (
+                    name, div["unique_views"], div["views_per_sample"],
+                    div["time"], "-", "-", "-"))
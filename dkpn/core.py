@@ -2,6 +2,7 @@
 
 # ---------  For SeisBench DKPN
 import json
+from pathlib import Path
 
 import numpy as np
 import torch
@@ -51,6 +52,10 @@ class DKPN(WaveformModel):
         phases="PSN",
         sampling_rate=100,
         norm="peak",
+        depth=5,
+        kernel_size=7,
+        stride=4,
+        filters_root=8,
         **kwargs,
     ):
         citation = (
@@ -95,16 +100,22 @@ class DKPN(WaveformModel):
         self.in_channels = in_channels
         self.classes = classes
         self.norm = norm
-        self.depth = 5
-        self.kernel_size = 7
-        self.stride = 4
-        self.filters_root = 8
+        self.depth = depth
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.filters_root = filters_root
         self.activation = torch.relu
 
+        # Pads of the strided convolutions (TF-like 'same') and crops of the
+        # transposed ones are derived from the window length
+        (self._down_pads, self._up_crop) = self.__compute_pads_crops__(
+                                                self.in_samples, self.depth,
+                                                self.kernel_size, self.stride)
+
         self.inc = nn.Conv1d(
             self.in_channels, self.filters_root, self.kernel_size, padding="same"
         )
-        self.in_bn = nn.BatchNorm1d(8, eps=1e-3)
+        self.in_bn = nn.BatchNorm1d(self.filters_root, eps=1e-3)
 
         self.down_branch = nn.ModuleList()
         self.up_branch = nn.ModuleList()
@@ -121,10 +132,12 @@ class DKPN(WaveformModel):
                 conv_down = None
                 bn2 = None
             else:
-                if i in [1, 2, 3]:
-                    padding = 0  # Pad manually
+                (_left, _right) = self._down_pads[i]
+                if _left == _right:
+                    padding = _left
+                    self._down_pads[i] = None
                 else:
-                    padding = self.kernel_size // 2
+                    padding = 0  # Pad manually
                 conv_down = nn.Conv1d(
                     filters,
                     filters,
@@ -138,7 +151,7 @@ class DKPN(WaveformModel):
             self.down_branch.append(nn.ModuleList([conv_same, bn1, conv_down, bn2]))
 
         for i in range(self.depth - 1):
-            filters = int(2 ** (3 - i) * self.filters_root)
+            filters = int(2 ** (self.depth - 2 - i) * self.filters_root)
             conv_up = nn.ConvTranspose1d(
                 last_filters, filters, self.kernel_size, self.stride, bias=False
             )
@@ -160,6 +173,29 @@ class DKPN(WaveformModel):
         self.windows_probs = []
         self.stream_cfs = None
 
+    @staticmethod
+    def __compute_pads_crops__(in_samples, depth, kernel_size, stride):
+        """ Return the (left, right) pads of each strided convolution,
+            reproducing the TF 'same' padding of the original PhaseNet
+            (None for the bottom level), and the (left, right) crop applied
+            after each transposed convolution, so that the up-sampled
+            length is exactly STRIDE times the input one.
+        """
+        assert kernel_size >= stride
+        pads = []
+        npts = in_samples
+        for i in range(depth):
+            if i == depth - 1:
+                pads.append(None)
+                continue
+            nout = int(np.ceil(npts / stride))
+            total = max((nout - 1) * stride + kernel_size - npts, 0)
+            pads.append((total // 2, total - total // 2))
+            npts = nout
+        crop_left = (kernel_size - stride) // 2
+        crop = (crop_left, kernel_size - stride - crop_left)
+        return (pads, crop)
+
     def __reset_predict(self):
         self.windows_ = []
         self.windows_cfs = []
@@ -175,12 +211,8 @@ class DKPN(WaveformModel):
 
             if conv_down is not None:
                 skips.append(x)
-                if i == 1:
-                    x = F.pad(x, (2, 3), "constant", 0)
-                elif i == 2:
-                    x = F.pad(x, (1, 3), "constant", 0)
-                elif i == 3:
-                    x = F.pad(x, (2, 3), "constant", 0)
+                if self._down_pads[i] is not None:
+                    x = F.pad(x, self._down_pads[i], "constant", 0)
 
                 x = self.activation(bn2(conv_down(x)))
 
@@ -188,7 +220,7 @@ class DKPN(WaveformModel):
             zip(self.up_branch, skips[::-1])
         ):
             x = self.activation(bn1(conv_up(x)))
-            x = x[:, :, 1:-2]
+            x = x[:, :, self._up_crop[0]:x.shape[-1] - self._up_crop[1]]
 
             x = self._merge_skip(skip, x)
             x = self.activation(bn2(conv_same(x)))
@@ -365,9 +397,31 @@ class DKPN(WaveformModel):
         model_args["classes"] = self.classes
         model_args["phases"] = self.labels
         model_args["sampling_rate"] = self.sampling_rate
+        model_args["depth"] = self.depth
+        model_args["kernel_size"] = self.kernel_size
+        model_args["stride"] = self.stride
+        model_args["filters_root"] = self.filters_root
 
         return model_args
 
+    def optimize_for_inference(self, example_input=None):
+        """ Return a TorchScript-traced copy of the network for inference.
+            All the BatchNorm layers are folded into the preceding
+            convolution weights and the manual pads are moved into the
+            convolution padding where possible (see `FusedDKPN`).
+            The returned module takes the same (batch, channels, samples)
+            input of `forward` and returns the softmax probabilities.
+            The batch dimension stays dynamic.
+        """
+        fused = FusedDKPN(self)
+        if example_input is None:
+            example_input = torch.zeros(
+                        1, self.in_channels, self.in_samples,
+                        device=next(fused.parameters()).device)
+        with torch.no_grad():
+            traced = torch.jit.trace(fused, example_input)
+        return torch.jit.freeze(traced)
+
     def get_defaults(self):
         return self.default_args
 
@@ -446,6 +500,273 @@ class DKPN(WaveformModel):
         return model
 
 
+def load_dkpn(model_path, map_location="cpu"):
+    """ Load a DKPN stored by `TrainHelp_DomainKnowledgePhaseNet.store_weigths`.
+        MODEL_PATH is either the '*.pt' file or a folder containing it
+        (the first one found is used, as in the evaluation scripts).
+        The architecture is read from the 'model_args' of the '*.json'
+        sibling file: if missing, the default DKPN architecture is used.
+    """
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        model_path = [xx for xx in model_path.glob("*.pt")][0]
+
+    model_args = {}
+    json_path = model_path.with_suffix(".json")
+    if json_path.is_file():
+        with open(str(json_path), "r") as IN:
+            model_args = json.load(IN).get("model_args", {})
+    # Keep the component order of a plain DKPN(), as the scripts always did
+    model_args.pop("component_order", None)
+
+    model = DKPN(**model_args)
+    model.load_state_dict(torch.load(str(model_path),
+                                     map_location=torch.device(map_location)))
+    return model
+
+
+def __fuse_conv_bn__(conv, bn):
+    """ Fold an (eval-mode) BatchNorm1d into the preceding Conv1d or
+        ConvTranspose1d. Returns a new convolution with bias.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    if conv.bias is not None:
+        shift = shift + conv.bias * scale
+
+    fused = copy.deepcopy(conv)
+    with torch.no_grad():
+        if isinstance(conv, nn.ConvTranspose1d):
+            # weight: [in_channels, out_channels, kernel]
+            fused.weight.mul_(scale.view(1, -1, 1))
+        else:
+            # weight: [out_channels, in_channels, kernel]
+            fused.weight.mul_(scale.view(-1, 1, 1))
+    fused.bias = nn.Parameter(shift.detach().clone())
+    __resolve_same_padding__(fused)
+    return fused
+
+
+def __resolve_same_padding__(conv):
+    """ Replace the 'same' padding string with the explicit (symmetric)
+        padding. Only odd kernels are supported, as used in DKPN.
+    """
+    if conv.padding == "same":
+        assert conv.kernel_size[0] % 2 == 1
+        conv.padding = ((conv.kernel_size[0] - 1) // 2,)
+    return conv
+
+
+class FusedDKPN(nn.Module):
+    """ Inference-only twin of a DKPN network.
+        Every Conv+BatchNorm couple of the U-net is folded into a single
+        convolution, and the asymmetric manual pads of the down branch are
+        reduced to the conv padding plus a single right-pad ('same'
+        paddings are made explicit as well).
+        The forward output matches `DKPN.forward` (in eval mode).
+    """
+
+    def __init__(self, dkpn):
+        super().__init__()
+        # functional relu, so that conv+relu can be fused by the quantizer
+        self.activation = F.relu
+
+        self.inc = __fuse_conv_bn__(dkpn.inc, dkpn.in_bn)
+
+        self.down_convs = nn.ModuleList()
+        self.down_pads = nn.ModuleList()
+        self.down_strided = nn.ModuleList()
+        for i, (conv_same, bn1, conv_down, bn2) in enumerate(dkpn.down_branch):
+            self.down_convs.append(__fuse_conv_bn__(conv_same, bn1))
+            if conv_down is None:
+                continue
+            _conv = __fuse_conv_bn__(conv_down, bn2)
+            if dkpn._down_pads[i] is None:
+                (_left, _right) = (_conv.padding[0], _conv.padding[0])
+            else:
+                (_left, _right) = dkpn._down_pads[i]
+            _conv.padding = (min(_left, _right),)
+            if _left == _right:
+                self.down_pads.append(nn.Identity())
+            else:
+                self.down_pads.append(nn.ConstantPad1d(
+                            (_left - _conv.padding[0], _right - _conv.padding[0]), 0.0))
+            self.down_strided.append(_conv)
+
+        self.up_convs = nn.ModuleList()
+        self.up_merges = nn.ModuleList()
+        for (conv_up, bn1, conv_same, bn2) in dkpn.up_branch:
+            self.up_convs.append(__fuse_conv_bn__(conv_up, bn1))
+            self.up_merges.append(__fuse_conv_bn__(conv_same, bn2))
+
+        self.up_crop = dkpn._up_crop
+        self.out = __resolve_same_padding__(copy.deepcopy(dkpn.out))
+        self.softmax = nn.Softmax(dim=1)
+        self.eval()
+
+    def forward(self, x):
+        x = self.activation(self.inc(x))
+
+        skips = []
+        for i, conv_same in enumerate(self.down_convs):
+            x = self.activation(conv_same(x))
+            if i < len(self.down_strided):
+                skips.append(x)
+                x = self.activation(self.down_strided[i](self.down_pads[i](x)))
+
+        for conv_up, conv_same, skip in zip(self.up_convs, self.up_merges,
+                                            skips[::-1]):
+            x = self.activation(conv_up(x))
+            x = x[:, :, self.up_crop[0]:x.shape[-1] - self.up_crop[1]]
+            x = DKPN._merge_skip(skip, x)
+            x = self.activation(conv_same(x))
+
+        return self.softmax(self.out(x))
+
+
+def __stack_module__(modules, grouped=True):
+    """ Pack the same Conv1d/ConvTranspose1d/BatchNorm1d layer of several
+        replicas into a single layer: the output channels (and, if GROUPED,
+        the input ones, with one group per replica) are concatenated.
+    """
+    nrep = len(modules)
+    stacked = copy.deepcopy(modules[0])
+    if isinstance(stacked, nn.BatchNorm1d):
+        stacked.num_features *= nrep
+        for name in ("weight", "bias"):
+            setattr(stacked, name, nn.Parameter(torch.cat(
+                        [getattr(mm, name).detach() for mm in modules]).clone()))
+        for name in ("running_mean", "running_var"):
+            setattr(stacked, name, torch.cat(
+                        [getattr(mm, name) for mm in modules]).clone())
+        return stacked
+    #
+    stacked.out_channels *= nrep
+    if grouped:
+        stacked.in_channels *= nrep
+        stacked.groups *= nrep
+    # Conv1d weight: [out, in/groups, k]  ConvTranspose1d: [in, out/groups, k]
+    stacked.weight = nn.Parameter(torch.cat(
+                        [mm.weight.detach() for mm in modules]).clone())
+    if stacked.bias is not None:
+        stacked.bias = nn.Parameter(torch.cat(
+                        [mm.bias.detach() for mm in modules]).clone())
+    return stacked
+
+
+class StackedDKPN(nn.Module):
+    """ N DKPN replicas (same architecture, different weights) packed in a
+        single network with grouped convolutions: replica k owns the
+        channel group k of every layer (BatchNorm included), so that a
+        single forward pass evaluates all of them on the same input.
+        The forward returns (batch, N, classes, samples).
+        The layers and the `state_dict` keys are the DKPN ones, with every
+        tensor being the concatenation of the replicas' tensors along the
+        first dimension: `get_replica_state` / `set_replica_state` move
+        the weights of a single replica in and out.
+    """
+
+    def __init__(self, dkpn_list):
+        super().__init__()
+        ref = dkpn_list[0]
+        self.nrep = len(dkpn_list)
+        self.activation = torch.relu
+        self.model_args = ref.get_model_args()
+        self.model_defaults = copy.deepcopy(ref.get_defaults())
+        self._down_pads = ref._down_pads
+        self._up_crop = ref._up_crop
+
+        # The input is shared: the first convolution is not grouped
+        self.inc = __stack_module__([mm.inc for mm in dkpn_list], grouped=False)
+        self.in_bn = __stack_module__([mm.in_bn for mm in dkpn_list])
+
+        self.down_branch = nn.ModuleList()
+        for i, layers in enumerate(ref.down_branch):
+            self.down_branch.append(nn.ModuleList([
+                    None if layers[xx] is None else __stack_module__(
+                            [mm.down_branch[i][xx] for mm in dkpn_list])
+                    for xx in range(len(layers))]))
+
+        self.up_branch = nn.ModuleList()
+        for i, layers in enumerate(ref.up_branch):
+            self.up_branch.append(nn.ModuleList([
+                    __stack_module__([mm.up_branch[i][xx] for mm in dkpn_list])
+                    for xx in range(len(layers))]))
+
+        self.out = __stack_module__([mm.out for mm in dkpn_list])
+        self.to(ref.device)
+
+    @property
+    def device(self):
+        return self.inc.weight.device
+
+    def __merge_skip__(self, skip, x):
+        """ DKPN skip-merge, done replica by replica """
+        offset = (x.shape[-1] - skip.shape[-1]) // 2
+        x = x[:, :, offset: offset + skip.shape[-1]]
+        (nb, _, npts) = skip.shape
+        return torch.cat([skip.reshape(nb, self.nrep, -1, npts),
+                          x.reshape(nb, self.nrep, -1, npts)],
+                         dim=2).reshape(nb, -1, npts)
+
+    def forward(self, x, logits=False):
+        x = self.activation(self.in_bn(self.inc(x)))
+
+        skips = []
+        for i, (conv_same, bn1, conv_down, bn2) in enumerate(self.down_branch):
+            x = self.activation(bn1(conv_same(x)))
+
+            if conv_down is not None:
+                skips.append(x)
+                if self._down_pads[i] is not None:
+                    x = F.pad(x, self._down_pads[i], "constant", 0)
+
+                x = self.activation(bn2(conv_down(x)))
+
+        for i, ((conv_up, bn1, conv_same, bn2), skip) in enumerate(
+            zip(self.up_branch, skips[::-1])
+        ):
+            x = self.activation(bn1(conv_up(x)))
+            x = x[:, :, self._up_crop[0]:x.shape[-1] - self._up_crop[1]]
+
+            x = self.__merge_skip__(skip, x)
+            x = self.activation(bn2(conv_same(x)))
+
+        x = self.out(x)
+        x = x.reshape(x.shape[0], self.nrep, -1, x.shape[-1])
+        if logits:
+            return x
+        else:
+            return torch.softmax(x, dim=2)
+
+    def get_replica_state(self, k):
+        """ `state_dict` (CPU) of the K-th replica, loadable by DKPN """
+        outdict = {}
+        for name, vv in self.state_dict().items():
+            if vv.ndim == 0:  # num_batches_tracked
+                outdict[name] = vv.detach().cpu().clone()
+            else:
+                _n = vv.shape[0] // self.nrep
+                outdict[name] = vv[k*_n:(k+1)*_n].detach().cpu().clone()
+        return outdict
+
+    def set_replica_state(self, k, state):
+        """ Load a DKPN `state_dict` into the K-th replica """
+        with torch.no_grad():
+            for name, vv in self.state_dict().items():
+                if vv.ndim == 0:
+                    continue
+                _n = vv.shape[0] // self.nrep
+                vv[k*_n:(k+1)*_n].copy_(state[name])
+
+    def get_replica(self, k):
+        """ The K-th replica as a standalone DKPN """
+        model = DKPN(**self.model_args)
+        model.set_dkpn_parameter(self.model_defaults)
+        model.load_state_dict(self.get_replica_state(k))
+        return model.to(self.device)
+
+
 # ====================================================================
 # ====================================================================
 # ====================================================================
@@ -1,6 +1,12 @@
+import os
+import pickle
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
-from scipy.signal import find_peaks, peak_widths
+from scipy.signal import find_peaks, peak_widths, peak_prominences
 
 
 def __reset_stats_dict__():
@@ -30,38 +36,194 @@ def extract_picks(ts, thr=0.2, min_distance=50, smooth=True):
     return (peaks, widths, ampl, ts)
 
 
+def __local_widths__(series, peaks, heights, left_ips, right_ips,
+                     left_bases, right_bases, starts):
+    """ Widths of `peak_widths` with the interpolation points counted
+        from the trace STARTS, as in the single trace: far in a long
+        series the interpolated positions lose their last bits """
+    # sample where the scan of `peak_widths` stopped (the interpolated
+    # position can be rounded onto the next sample)
+    ileft = np.floor(left_ips).astype(np.int64)
+    ileft[(ileft > left_bases) & (series[ileft] > heights)] -= 1
+    iright = np.ceil(right_ips).astype(np.int64)
+    iright[(iright < right_bases) & (series[iright] > heights)] += 1
+
+    left_ips = (ileft - starts).astype(np.float64)
+    _interp = series[ileft] < heights
+    _next = np.minimum(ileft + 1, series.size - 1)
+    left_ips[_interp] += ((heights - series[ileft]) / (series[_next] - series[ileft]))[_interp]
+
+    right_ips = (iright - starts).astype(np.float64)
+    _interp = series[iright] < heights
+    _prev = np.maximum(iright - 1, 0)
+    right_ips[_interp] -= ((heights - series[iright]) / (series[_prev] - series[iright]))[_interp]
+    return right_ips - left_ips
+
+
+def extract_picks_batch(ts, thr=0.2, min_distance=50, smooth=True):
+    """ `extract_picks` on many prediction labels TS at once, (..., time)
+        e.g. (N, 2, 3001). All the traces are laid in one series, each
+        followed by a separator longer than 2*MIN_DISTANCE: zeros for the
+        smoothing, then values above any peak, so that no pick or width
+        crosses (or ends on) a trace boundary. Smoothing, peaks and widths
+        then run on the whole series at once, with results identical to
+        `extract_picks` trace by trace.
+        Returns (peaks, widths, amplitudes, offsets, smoothed ts): the
+        picks of trace k (row-major over the leading axes) are
+        peaks[offsets[k]:offsets[k+1]].
+    """
+    ts = np.asarray(ts)
+    shape = ts.shape
+    ts = ts.reshape(-1, shape[-1])
+    (ntr, nsmp) = ts.shape
+    distance = int(np.ceil(min_distance))
+    stride = nsmp + 2*distance + 1
+    traces = np.zeros((ntr, stride), dtype=np.float64)
+    traces[:, :nsmp] = ts
+    if smooth:
+        smoothing_filter = [1.0 / 3.0, 1.0 / 3.0, 1.0 / 3.0]  # remove rapid oscillations between samples
+        # zero padded like the single traces (np.convolve 'same' mode) ...
+        traces = np.convolve(traces.ravel(), smoothing_filter,
+                             mode='same').reshape(ntr, stride)
+        # ... but the edge samples come from 2-sample dot products there
+        traces[:, [0, nsmp-1]] = [(np.convolve(tt[:3], smoothing_filter, mode='same')[0],
+                                   np.convolve(tt[-3:], smoothing_filter, mode='same')[-1])
+                                  for tt in ts]
+        ts = traces[:, :nsmp]
+    # Before proceeding make sure there are no NaNs, otherwise scipy can lead to erroneous results
+    assert not np.isnan(np.sum(traces))
+    traces[:, nsmp:] = traces[:, :nsmp].max() + 1.0
+    series = traces.ravel()
+
+    # Local maxima over the threshold: below it nothing can be a peak, all
+    # the samples there are flattened to a value lower than their
+    # neighbours to spare `find_peaks` the noise maxima. The separators are
+    # peaks, as wide as they need to be never closer than MIN_DISTANCE to
+    # a real one
+    above = np.where(series >= thr, series, min(thr, 0.0) - 1.0)
+    (candidates, _) = find_peaks(above, thr)
+    candidates = candidates[candidates % stride < nsmp]
+    peaks, _extra_dict = find_peaks(above, thr, distance=min_distance)
+    peaks = peaks[peaks % stride < nsmp]
+
+    # Equal heights closer than MIN_DISTANCE: the peak kept by `find_peaks`
+    # depends on their sorting, that is only the same trace by trace
+    heights = series[candidates]
+    tied = np.zeros(0, dtype=np.int64)
+    for kk in range(1, len(candidates)):
+        close = candidates[kk:] - candidates[:-kk] < distance
+        if not close.any():
+            break
+        tied = np.concatenate((tied, candidates[kk:][
+                                close & (heights[kk:] == heights[:-kk])]))
+    for tr in np.unique(tied // stride):
+        _peaks, _ = find_peaks(traces[tr, :nsmp], thr, distance=min_distance)
+        peaks = np.concatenate((peaks[peaks // stride != tr],
+                                _peaks + tr * stride))
+    peaks = np.sort(peaks)
+
+    ampl = series[peaks]
+    prominence_data = peak_prominences(series, peaks, wlen=None)
+    (_, heights, left_ips, right_ips) = peak_widths(series, peaks, rel_height=0.5,
+                                                    prominence_data=prominence_data)
+    widths = __local_widths__(series, peaks, heights, left_ips, right_ips,
+                              prominence_data[1], prominence_data[2],
+                              (peaks // stride) * stride)
+
+    offsets = np.searchsorted(peaks // stride, np.arange(ntr + 1))
+    #
+    return (peaks % stride, widths, ampl, offsets, ts.reshape(shape))
+
+
 def compare_picks(peaks_model, peaks_ref, stats_dict, thr=25):
+    """ Greedy matching of the (sorted, as from `extract_picks`) model
+        picks with the reference ones: every reference pick, in order,
+        takes the first not-yet-matched model pick within THR samples.
+        Unmatched references are FN, unmatched model picks are FP and
+        get a residual against every reference pick.
+    """
+    peaks_model = np.asarray(peaks_model)
+    peaks_ref = np.asarray(peaks_ref)
     stats_dict["TOTAL"] += len(peaks_ref)
-    matches = []  # ... keeping track of matches
-
-    residuals_tp, residuals_fp = [], []
-
-    # First, we find TP and the corresponding matches
-    matched_model_peaks = set()  # Keep track of model peaks that have been matched
-    for pf in peaks_ref:
-        match_found = False
-        for pm in peaks_model:
-            if pm in matched_model_peaks:
-                continue  # Skip model peaks that have already been matched
-            if abs(pm - pf) <= thr:
-                residuals_tp.append(pm - pf)
-                stats_dict["TP"] += 1
-                matches.append((pm, pf))  # Save the match
-                matched_model_peaks.add(pm)
-                match_found = True
-                break  # Once we found a match, no need to check other pm for this pf
-        if not match_found:
-            stats_dict["FN"] += 1
 
-    # Now, we find FP. If a pm is not in the matches, it's a FP
-    for pm in peaks_model:
-        if pm not in [m[0] for m in matches]:
-            stats_dict["FP"] += 1
-            #
-            for pf in peaks_ref:
-                residuals_fp.append(pm - pf)
+    residuals_tp = []
+    matched = np.zeros(len(peaks_model), dtype=bool)
+
+    # First, we find TP: with sorted picks the first free model pick
+    # in the window is never before the latest match
+    jj = 0
+    lower = np.searchsorted(peaks_model, peaks_ref - thr, side="left")
+    for (pf, lo) in zip(peaks_ref, lower):
+        jj = max(jj, lo)
+        if jj < len(peaks_model) and peaks_model[jj] - pf <= thr:
+            residuals_tp.append(peaks_model[jj] - pf)
+            matched[jj] = True
+            jj += 1
+    stats_dict["TP"] += len(residuals_tp)
+    stats_dict["FN"] += len(peaks_ref) - len(residuals_tp)
 
-    return (stats_dict, residuals_tp, residuals_fp)
+    # Now, we find FP. If a pm is not in the matches, it's a FP
+    peaks_fp = peaks_model[~matched]
+    stats_dict["FP"] += len(peaks_fp)
+    residuals_fp = np.subtract.outer(peaks_fp, peaks_ref).ravel()
+
+    return (stats_dict, residuals_tp, list(residuals_fp))
+
+
+def pad_picks(picks_list, fill=-1, offsets=None):
+    """ Stack the picks of many traces in a (traces, max. picks) array
+        padded with FILL, as needed by `compare_picks_batch`.
+        With OFFSETS, PICKS_LIST is the flat array of `extract_picks_batch` """
+    if offsets is not None:
+        picks_list = np.split(picks_list, offsets[1:-1])
+    width = max([len(pp) for pp in picks_list] + [1])
+    padded = np.full((len(picks_list), width), fill, dtype=np.int64)
+    for (xx, pp) in enumerate(picks_list):
+        padded[xx, :len(pp)] = pp
+    return padded
+
+
+def compare_picks_batch(peaks_model, peaks_ref, stats_dict, thr=25, fill=-1):
+    """ `compare_picks` for many traces at once. PEAKS_MODEL and PEAKS_REF
+        are (traces, picks) arrays, sorted per trace and padded at the
+        end with FILL (see `pad_picks`). The statistics are summed over
+        the traces, the residuals are given trace after trace in the
+        same order as repeated `compare_picks` calls.
+    """
+    peaks_model = np.asarray(peaks_model, dtype=np.int64)
+    peaks_ref = np.asarray(peaks_ref, dtype=np.int64)
+    valid_model = peaks_model != fill
+    valid_ref = peaks_ref != fill
+    # padding after the last pick of every trace, never in a window
+    _model = np.where(valid_model, peaks_model, np.iinfo(np.int64).max // 2)
+
+    (ntr, nmod) = _model.shape
+    rows = np.arange(ntr)
+    jj = np.zeros(ntr, dtype=np.int64)
+    matched = np.zeros(_model.shape, dtype=bool)
+    is_tp = np.zeros(peaks_ref.shape, dtype=bool)
+    residuals_tp = np.zeros(peaks_ref.shape, dtype=np.int64)
+
+    for kk in range(peaks_ref.shape[1]):
+        pf = peaks_ref[:, kk]
+        jj = np.maximum(jj, (_model < (pf - thr)[:, None]).sum(axis=1))
+        pm = _model[rows, np.minimum(jj, nmod - 1)]
+        ok = valid_ref[:, kk] & (jj < nmod) & (pm - pf <= thr)
+        matched[rows[ok], jj[ok]] = True
+        is_tp[:, kk] = ok
+        residuals_tp[:, kk] = pm - pf
+        jj[ok] += 1
+
+    stats_dict["TOTAL"] += int(valid_ref.sum())
+    stats_dict["TP"] += int(is_tp.sum())
+    stats_dict["FN"] += int((valid_ref & ~is_tp).sum())
+    is_fp = valid_model & ~matched
+    stats_dict["FP"] += int(is_fp.sum())
+
+    residuals_fp = (peaks_model[:, :, None] - peaks_ref[:, None, :])[
+                        is_fp[:, :, None] & valid_ref[:, None, :]]
+
+    return (stats_dict, residuals_tp[is_tp], residuals_fp)
 
 
 def calculate_scores(stats_dict):
@@ -75,6 +237,113 @@ def calculate_scores(stats_dict):
     return (f1, precision, recall)
 
 
+class ResidualHistogram(object):
+    """ Constant-memory collection of integer residuals (samples):
+        one bin per sample in [-MAX_LAG, MAX_LAG] (residuals outside
+        are counted apart) plus the running sums for mean and std.
+        Histograms of different processes are summed with `merge` / `+=`.
+    """
+    def __init__(self, max_lag=3000):
+        self.max_lag = int(max_lag)
+        self.counts = np.zeros(2*self.max_lag + 1, dtype=np.int64)
+        self.outside = 0
+        # Python integers: exact and never overflowing
+        self.n = 0
+        self.sum = 0
+        self.sumsq = 0
+
+    def add(self, residuals):
+        residuals = np.asarray(residuals, dtype=np.int64).ravel()
+        if not residuals.size:
+            return self
+        inside = np.abs(residuals) <= self.max_lag
+        self.counts += np.bincount(residuals[inside] + self.max_lag,
+                                   minlength=self.counts.size)
+        self.outside += int(residuals.size - inside.sum())
+        self.n += int(residuals.size)
+        self.sum += int(residuals.sum())
+        self.sumsq += int((residuals*residuals).sum())
+        return self
+
+    def merge(self, other):
+        if other.max_lag != self.max_lag:
+            raise ValueError("Cannot merge histograms with different MAX_LAG: %d / %d" % (
+                                self.max_lag, other.max_lag))
+        self.counts += other.counts
+        self.outside += other.outside
+        self.n += other.n
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __len__(self):
+        return self.n
+
+    def mean(self, delta=0.01):
+        """ Mean residual, in seconds for a DELTA sampling interval """
+        if not self.n:
+            return np.nan
+        return self.sum / self.n * delta
+
+    def std(self, delta=0.01):
+        """ Standard deviation (as `np.std`), in seconds """
+        if not self.n:
+            return np.nan
+        return np.sqrt((self.n*self.sumsq - self.sum**2) / self.n**2) * delta
+
+    def lags(self, delta=0.01):
+        """ Residual of every bin, in seconds """
+        return np.arange(-self.max_lag, self.max_lag + 1) * delta
+
+    def values(self, delta=0.01):
+        """ Expand back to the residuals (sorted, seconds) as the old
+            array dumps. Residuals outside MAX_LAG are lost. """
+        return np.repeat(self.lags(delta=delta), self.counts)
+
+
+class PickMetrics(object):
+    """ Streaming TP / FP / FN statistics of one phase and picker, with the
+        histograms of the TP and FP residuals (see `compare_picks`).
+        The STATS dictionary is the one of `__reset_stats_dict__`.
+    """
+    def __init__(self, max_lag=3000):
+        self.stats = __reset_stats_dict__()
+        self.tp = ResidualHistogram(max_lag=max_lag)
+        self.fp = ResidualHistogram(max_lag=max_lag)
+
+    def compare(self, peaks_model, peaks_ref, thr=25):
+        """ `compare_picks` on one trace, the residuals are returned too """
+        (_, residuals_tp, residuals_fp) = compare_picks(
+                            peaks_model, peaks_ref, self.stats, thr=thr)
+        self.tp.add(residuals_tp)
+        self.fp.add(residuals_fp)
+        return (residuals_tp, residuals_fp)
+
+    def compare_batch(self, peaks_model, peaks_ref, thr=25, fill=-1):
+        """ `compare_picks_batch` on padded (traces, picks) arrays """
+        (_, residuals_tp, residuals_fp) = compare_picks_batch(
+                            peaks_model, peaks_ref, self.stats, thr=thr, fill=fill)
+        self.tp.add(residuals_tp)
+        self.fp.add(residuals_fp)
+        return (residuals_tp, residuals_fp)
+
+    def merge(self, other):
+        for kk in self.stats.keys():
+            self.stats[kk] += other.stats[kk]
+        self.tp.merge(other.tp)
+        self.fp.merge(other.fp)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def scores(self):
+        return calculate_scores(self.stats)
+
+
 def create_AL_plots(wave3c,
                     label3c,
                     dkpn_cfs,
@@ -251,6 +520,14 @@ def create_residuals_plot(resP, resS, binwidth=0.025, save_path="image_residuals
     return fig
 
 
+def __hist_data__(data):
+    """ Values, weights, mean and std of residuals given either as an
+        array (seconds) or as a `ResidualHistogram` """
+    if isinstance(data, ResidualHistogram):
+        return (data.lags(), data.counts, data.mean(), data.std())
+    return (data, None, np.mean(data), np.std(data))
+
+
 def create_residuals_plot_compare(resP_dkpn, resS_dkpn, resP_pn, resS_pn, 
                                   binwidth=0.025, save_path="image_residuals.pdf"):
 
@@ -262,10 +539,12 @@ def create_residuals_plot_compare(resP_dkpn, resS_dkpn, resP_pn, resS_pn,
     for (ax, data, title) in zip(
                     axs, ((resP_dkpn, resP_pn), (resS_dkpn, resS_pn)), ('P', 'S')):
 
-        ax.hist(data[0], bins=bin_edges, color="orange", edgecolor=None,
-                label="DKPN: mean=%.2f\n           std=%.2f" % (np.mean(data[0]), np.std(data[0])))
-        ax.hist(data[1], bins=bin_edges, facecolor=(.0, .0, .0, .0), edgecolor='blue',
-                label="PN: mean=%.2f\n      std=%.2f" % (np.mean(data[1]), np.std(data[1])))
+        (values, weights, mean, std) = __hist_data__(data[0])
+        ax.hist(values, bins=bin_edges, weights=weights, color="orange", edgecolor=None,
+                label="DKPN: mean=%.2f\n           std=%.2f" % (mean, std))
+        (values, weights, mean, std) = __hist_data__(data[1])
+        ax.hist(values, bins=bin_edges, weights=weights, facecolor=(.0, .0, .0, .0), edgecolor='blue',
+                label="PN: mean=%.2f\n      std=%.2f" % (mean, std))
 
         # Set labels and title
         ax.set_xlabel('residuals (s)')
@@ -278,3 +557,107 @@ def create_residuals_plot_compare(resP_dkpn, resS_dkpn, resP_pn, resS_pn,
     plt.tight_layout()
     _ = fig.savefig(str(save_path))
     return fig
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+# Figures off the evaluation loop
+
+PLOT_JOBS_FOLDER = "PLOT_JOBS"
+
+
+def __headless__():
+    """ Initializer of the plotting processes """
+    matplotlib.use("Agg")
+
+
+def render_plot_job(job_path):
+    """ Draw and save the figure of a `PlotPool` job file, then remove it """
+    with open(str(job_path), 'rb') as file:
+        job = pickle.load(file)
+    fig = globals()[job["function"]](*job["args"], save_path=job["save_path"],
+                                     **job["kwargs"])
+    plt.close(fig)
+    os.remove(str(job_path))
+    return job["save_path"]
+
+
+def pending_plot_jobs(folder):
+    """ Job files of FOLDER whose figure has not been saved yet """
+    return sorted((Path(folder) / PLOT_JOBS_FOLDER).glob("*.pickle"))
+
+
+class PlotPool(object):
+    """ Draw the figures in PROCESSES background processes (Agg backend).
+        Every figure is first written as a job file (the name of the
+        plotting function of this module and its arrays) in the
+        PLOT_JOBS folder next to the figure, and the job file is removed
+        once the figure is saved: with PROCESSES=0 the jobs are only
+        written, the pending ones of a folder are drawn later with
+        `resume` (also after an interrupted run).
+        The processes are forked at once (scripts are not importable by
+        spawned ones): create the pool before loading models and data.
+    """
+    def __init__(self, processes=2):
+        self.processes = processes
+        self.pool = None
+        if processes > 0:
+            self.pool = ProcessPoolExecutor(
+                            max_workers=processes,
+                            mp_context=multiprocessing.get_context("fork"),
+                            initializer=__headless__)
+            # one task each, so that all of them start now
+            for _ in range(processes):
+                self.pool.submit(__headless__)
+        self.futures = []
+        self.job_folders = set()
+
+    def __render__(self, job_path):
+        self.job_folders.add(Path(job_path).parent)
+        if self.pool is not None:
+            self.futures.append(self.pool.submit(render_plot_job, str(job_path)))
+
+    def submit(self, function, save_path, *args, **kwargs):
+        """ Queue FUNCTION(*ARGS, save_path=SAVE_PATH, **KWARGS) """
+        save_path = Path(save_path)
+        job_folder = save_path.parent / PLOT_JOBS_FOLDER
+        job_folder.mkdir(parents=True, exist_ok=True)
+        job_path = job_folder / (save_path.name + ".pickle")
+        with open(str(job_path) + ".tmp", 'wb') as file:
+            pickle.dump({"function": function.__name__,
+                         "save_path": str(save_path),
+                         "args": args, "kwargs": kwargs}, file)
+        os.replace(str(job_path) + ".tmp", str(job_path))
+        self.__render__(job_path)
+        return job_path
+
+    def resume(self, folder):
+        """ Queue the pending jobs of FOLDER """
+        jobs = pending_plot_jobs(folder)
+        for job_path in jobs:
+            self.__render__(job_path)
+        return len(jobs)
+
+    def close(self):
+        """ Wait for the queued figures, return how many were saved """
+        if self.pool is None:
+            return 0
+        saved = 0
+        for future in self.futures:
+            try:
+                future.result()
+                saved += 1
+            except Exception as err:
+                print("Plot job failed (kept for a later resume):  %r" % err)
+        self.pool.shutdown()
+        self.pool = None
+        self.futures = []
+        # Only here, with no job left to submit: the empty PLOT_JOBS folders
+        for folder in self.job_folders:
+            try:
+                folder.rmdir()
+            except OSError:
+                pass
+        self.job_folders = set()
+        return saved
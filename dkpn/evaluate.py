@@ -0,0 +1,1005 @@
+import os
+import json
+import pickle
+import argparse
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+from obspy.geodetics.base import locations2degrees, degrees2kilometers
+from torch.utils.data import DataLoader, Dataset
+import seisbench.models as sbm
+
+import dkpn.eval_utils as EV
+from dkpn.core import load_dkpn
+from dkpn.train import (seed_worker_stream, loader_generator,
+                        TrainHelp_DomainKnowledgePhaseNet)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+class __SelectionDataset__(Dataset):
+    """ The INDICES items of a DKPN generator, reduced to the KEYS
+        arrays plus their position in INDICES """
+
+    def __init__(self, generator, indices, keys=("X", "y", "Xorig")):
+        self.generator = generator
+        self.indices = indices
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        sample = self.generator[self.indices[idx]]
+        item = {kk: sample[kk] for kk in self.keys}
+        item["position"] = idx
+        return item
+
+
+def predict_selection(dkpn, pn, generator, indices,
+                      batch_size=64, num_workers=8, random_seed=42):
+    """ Batched predictions of DKPN and PN on the same TEST windows.
+        The INDICES items of GENERATOR (the DKPN test generator of a
+        `TrainHelp` class) are augmented by the DataLoader workers and
+        both pickers run once per batch. PN sees the same window as DKPN,
+        without the first `fp_stabilization` seconds ('Xorig').
+        PN may be None (DKPN only).
+        Yields, in the INDICES order:
+            (position, {"X": dkpn input, "y": labels, "Xpn": pn input},
+             dkpn prediction, pn prediction or None)
+        all numpy arrays.
+    """
+    pn_start = int(dkpn.default_args["fp_stabilization"] * dkpn.sampling_rate)
+    loader = DataLoader(__SelectionDataset__(generator, indices),
+                        batch_size=batch_size, shuffle=False,
+                        num_workers=num_workers,
+                        worker_init_fn=seed_worker_stream,
+                        generator=loader_generator(random_seed),
+                        pin_memory=(dkpn.device.type == "cuda"))
+
+    for batch in loader:
+        X_pn = batch["Xorig"][:, :, pn_start:]
+        with torch.no_grad():
+            dkpn_pred = dkpn(batch["X"].to(dkpn.device,
+                                           non_blocking=True)).cpu().numpy()
+            if pn is not None:
+                pn_pred = pn(X_pn.to(pn.device,
+                                     non_blocking=True)).cpu().numpy()
+
+        X_dkpn = batch["X"].numpy()
+        X_pn = X_pn.numpy()
+        y = batch["y"].numpy()
+        for jj, pos in enumerate(batch["position"].tolist()):
+            yield (pos,
+                   {"X": X_dkpn[jj], "y": y[jj], "Xpn": X_pn[jj]},
+                   dkpn_pred[jj],
+                   pn_pred[jj] if pn is not None else None)
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+# Names of the same metadata in the different SeisBench datasets:
+# when several are there, the LAST one is used
+METADATA_ALIASES = {
+    "station_latitude": ["station_latitude_deg", "stat_lat_deg",
+                         "station_latitude"],
+    "station_longitude": ["station_longitude_deg", "stat_lon_deg",
+                          "station_longitude"],
+    "source_latitude": ["source_latitude_deg", "source_lat_deg",
+                        "source_latitude"],
+    "source_longitude": ["source_longitude_deg", "source_lon_deg",
+                         "source_longitude"],
+    "network": ["station_network_code", "station_network"],
+    "station": ["station_code", "station_name"],
+    "location": ["station_location_code", "station_location"],
+    "channel": ["station_channel_code", "trace_channel",
+                "station_channel", "station_channels"],
+    "start_time": ["trace_start", "trace_start_time", "trace_time"],
+    "magnitude_type": ["preferred_source_magnitude_type",
+                       "source_magnitude_type", "magnitude_type"],
+    "magnitude": ["preferred_source_magnitude", "source_magnitude",
+                  "magnitude"],
+}
+
+
+def resolve_metadata_columns(columns, aliases=METADATA_ALIASES):
+    """ Map every field of ALIASES to its column among COLUMNS.
+        Raise a ValueError if a field has none of its names there """
+    resolved = {}
+    for (field, names) in aliases.items():
+        found = [nn for nn in names if nn in columns]
+        if not found:
+            raise ValueError("couldn't find anything for '%s' (%s)" % (
+                                field, ", ".join(names)))
+        resolved[field] = found[-1]
+    return resolved
+
+
+def __blank_nan__(values):
+    """ Missing values as empty strings (object array) """
+    values = pd.Series(values, dtype=object)
+    return values.where(values.notna(), "").values
+
+
+def metadata_table(metadata, indices):
+    """ Per-sample table of the INDICES rows (positions) of METADATA,
+        indexed by INDICES: 'seedid', 'start_time', 'magnitude_type',
+        'magnitude' and the epicentral distance 'epidist' (km).
+        Missing codes, times and types are empty strings.
+    """
+    columns = resolve_metadata_columns(metadata.columns)
+    rows = metadata.iloc[np.asarray(indices)]
+    _values = {kk: rows[vv].values for (kk, vv) in columns.items()}
+
+    epidist = degrees2kilometers(locations2degrees(
+                *[_values[kk].astype(np.float64) for kk in (
+                    "station_latitude", "station_longitude",
+                    "source_latitude", "source_longitude")]))
+
+    location = __blank_nan__(_values["location"])
+    location = ["00" if ll == 0.0 else "01" if ll == 1.0 else ll
+                for ll in location]
+    seedid = [".".join([str(nn), str(ss), str(ll), str(cc)])
+              for (nn, ss, ll, cc) in zip(__blank_nan__(_values["network"]),
+                                          __blank_nan__(_values["station"]),
+                                          location,
+                                          __blank_nan__(_values["channel"]))]
+
+    return pd.DataFrame({
+                "seedid": seedid,
+                "start_time": __blank_nan__(_values["start_time"]),
+                "magnitude_type": __blank_nan__(_values["magnitude_type"]),
+                "magnitude": _values["magnitude"].astype(np.float64),
+                "epidist": epidist},
+                index=np.asarray(indices))
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+def __checkpoint_hash__(model_path):
+    """ Content fingerprint of a stored model ('*.pt' file or the folder
+        containing it, the first one found as in `load_dkpn`) """
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        model_path = [xx for xx in model_path.glob("*.pt")][0]
+    _hash = hashlib.sha1()
+    with open(str(model_path), "rb") as IN:
+        for chunk in iter(lambda: IN.read(1 << 20), b""):
+            _hash.update(chunk)
+    return _hash.hexdigest()
+
+
+def prediction_store_path(folder, checkpoints, dataset_name, dataset_size,
+                          split, random_seed, nsamples):
+    """ Folder of the stored predictions inside FOLDER: the key covers the
+        CHECKPOINTS content (DKPN, PN model paths), the dataset, size,
+        split, seed and the number of selected samples """
+    _hash = hashlib.sha1()
+    for xx in ([__checkpoint_hash__(cc) for cc in checkpoints] +
+               [dataset_name.upper(), dataset_size.lower(), split,
+                str(random_seed), str(nsamples)]):
+        _hash.update(xx.encode())
+    return Path(folder) / ("PREDICTIONS_%s_%s_%s_Rnd_%d_N_%d_%s" % (
+                    dataset_name.upper(), dataset_size.upper(), split.upper(),
+                    random_seed, nsamples, _hash.hexdigest()[:16]))
+
+
+def stored_predictions(args, pn_model_path, split="TEST_DKPN"):
+    """ (folder, `PredictionStore`) of the ARGS.prediction_store
+        predictions of SPLIT: the store is None until complete, the
+        folder too without ARGS.prediction_store. Nothing is loaded
+        beyond the checkpoints fingerprints: check it before the
+        models and the dataset """
+    if not args.prediction_store:
+        return (None, None)
+    folder = prediction_store_path(
+                    args.prediction_store,
+                    (args.dkpn_model_name, pn_model_path),
+                    args.dataset_name, args.dataset_size, split,
+                    args.random_seed, args.test_samples)
+    if not PredictionStore.is_complete(folder):
+        return (folder, None)
+    return (folder, PredictionStore(folder))
+
+
+class PredictionStore(object):
+    """ Predictions of `predict_selection` stored as '*.npy' memory maps
+        in FOLDER (see `store_predictions`): 'DKPN', 'PN' probabilities,
+        'y' labels and 'index' (the selected generator items), plus the
+        'X', 'Xpn' inputs of the first samples only (for the plots), and
+        their `metadata_table` rows if stored ('metadata.pickle', else None).
+        Iterating gives the same tuples as `predict_selection`
+        (inputs are None when not stored).
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        with open(str(self.folder / "STORE_INFO.json"), "r") as IN:
+            self.info = json.load(IN)
+        self.arrays = {kk: np.load(str(self.folder / (kk + ".npy")),
+                                   mmap_mode="r")
+                       for kk in ("DKPN", "PN", "y", "index", "X", "Xpn")
+                       if (self.folder / (kk + ".npy")).is_file()}
+        self.ninputs = (self.arrays["X"].shape[0]
+                        if "X" in self.arrays else 0)
+        self.metadata = None
+        if (self.folder / "metadata.pickle").is_file():
+            self.metadata = pd.read_pickle(str(self.folder / "metadata.pickle"))
+
+    @staticmethod
+    def is_complete(folder):
+        """ The info file is written last: no info, no (complete) store """
+        return (Path(folder) / "STORE_INFO.json").is_file()
+
+    def __len__(self):
+        return self.arrays["y"].shape[0]
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            if pos < self.ninputs:
+                inputs = (self.arrays["X"][pos], self.arrays["Xpn"][pos])
+            else:
+                inputs = (None, None)
+            yield (pos,
+                   {"X": inputs[0], "y": self.arrays["y"][pos],
+                    "Xpn": inputs[1]},
+                   self.arrays["DKPN"][pos],
+                   self.arrays["PN"][pos] if "PN" in self.arrays else None)
+
+
+def store_predictions(predictions, folder, indices, keep_inputs=0, info=None,
+                      metadata=None):
+    """ Pass-through of the PREDICTIONS of `predict_selection` on
+        INDICES, storing them in FOLDER while they are consumed.
+        The inputs are kept only for the first KEEP_INPUTS samples,
+        METADATA (`metadata_table`, for the figure titles) as it is.
+        INFO (dict) goes into 'STORE_INFO.json', written at the end:
+        a store interrupted halfway is never reused.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    nsmp = len(indices)
+    np.save(str(folder / "index.npy"), np.asarray(indices))
+    arrays = {}
+    for (pos, sample, dkpn_pred, pn_pred) in predictions:
+        if not arrays:
+            _shapes = {"DKPN": (nsmp, ) + dkpn_pred.shape,
+                       "y": (nsmp, ) + sample["y"].shape}
+            if pn_pred is not None:
+                _shapes["PN"] = (nsmp, ) + pn_pred.shape
+            if keep_inputs:
+                _shapes["X"] = (min(keep_inputs, nsmp), ) + sample["X"].shape
+                _shapes["Xpn"] = (min(keep_inputs, nsmp), ) + sample["Xpn"].shape
+            for (kk, shape) in _shapes.items():
+                arrays[kk] = np.lib.format.open_memmap(
+                                str(folder / (kk + ".npy")), mode="w+",
+                                dtype=np.float32, shape=shape)
+        #
+        arrays["DKPN"][pos] = dkpn_pred
+        arrays["y"][pos] = sample["y"]
+        if pn_pred is not None:
+            arrays["PN"][pos] = pn_pred
+        if pos < keep_inputs:
+            arrays["X"][pos] = sample["X"]
+            arrays["Xpn"][pos] = sample["Xpn"]
+        yield (pos, sample, dkpn_pred, pn_pred)
+
+    for vv in arrays.values():
+        vv.flush()
+    del arrays
+    if metadata is not None:
+        metadata.to_pickle(str(folder / "metadata.pickle"))
+    _tmp = folder / ("STORE_INFO_tmp%d.json" % os.getpid())
+    with open(str(_tmp), "w") as OUT:
+        json.dump(dict(info or {}, samples=nsmp, inputs=min(keep_inputs, nsmp)),
+                  OUT, indent=4)
+    os.replace(str(_tmp), str(folder / "STORE_INFO.json"))
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+class PickAccumulator(object):
+    """ Picks table ('Picks.parquet' / 'Picks.csv' in FOLDER) filled trace
+        by trace. Every column is a typed NumPy buffer, written out as a
+        Parquet row group (and appended to the CSV) every CHUNK_SIZE
+        picks, so that the memory stays bounded.
+        PARQUET None: only if `pyarrow` is installed.
+    """
+
+    COLUMNS = ["trace_id", "sample_idx", "phase", "width", "amplitude", "label", "picker"]
+    CATEGORIES = {"phase": ["P", "S"],
+                  "label": ["pred", "ref"],
+                  "picker": ["DKPN", "PN"]}
+
+    def __init__(self, folder, name="Picks", chunk_size=100000,
+                 parquet=None, csv=True):
+        if parquet is None:
+            parquet = pq is not None
+        elif parquet and pq is None:
+            raise ImportError("The 'pyarrow' package is needed for the Parquet picks")
+        if not parquet and not csv:
+            raise ValueError("No output for the picks: no 'pyarrow' and no CSV")
+        self.folder = Path(folder)
+        self.name = name
+        self.chunk_size = chunk_size
+        self.parquet = parquet
+        self.csv = csv
+        self.buffers = {
+            "trace_id": np.zeros(1024, dtype=np.int64),
+            "sample_idx": np.zeros(1024, dtype=np.int64),
+            "width": np.zeros(1024, dtype=np.float64),
+            "amplitude": np.zeros(1024, dtype=np.float64)}
+        for kk in self.CATEGORIES.keys():
+            self.buffers[kk] = np.zeros(1024, dtype=np.int8)
+        self.size = 0
+        self.total = 0
+        self.__writer__ = None
+        self.__written__ = False
+
+    def add(self, trace_idx, picks, widths, amplitudes, phase, label, picker):
+        """ The PICKS (sample indices) of one trace, with their widths and
+            amplitudes as given by `eval_utils.extract_picks` """
+        self.add_batch(trace_idx, picks, widths, amplitudes,
+                       {kk: self.CATEGORIES[kk].index(vv) for (kk, vv) in (
+                            ("phase", phase), ("label", label), ("picker", picker))})
+
+    def add_batch(self, trace_idx, picks, widths, amplitudes, codes):
+        """ Picks of many traces: TRACE_IDX and the CODES ({column: index in
+            `CATEGORIES`}) are given per pick, or once for all of them """
+        npk = len(picks)
+        if not npk:
+            return
+        if self.size + npk > len(self.buffers["trace_id"]):
+            _new = max(2 * len(self.buffers["trace_id"]), self.size + npk)
+            for (kk, vv) in self.buffers.items():
+                self.buffers[kk] = np.resize(vv, _new)
+        _slice = slice(self.size, self.size + npk)
+        self.buffers["trace_id"][_slice] = trace_idx
+        self.buffers["sample_idx"][_slice] = picks
+        self.buffers["width"][_slice] = widths
+        self.buffers["amplitude"][_slice] = amplitudes
+        for (kk, vv) in codes.items():
+            self.buffers[kk][_slice] = vv
+        self.size += npk
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def __frame__(self):
+        _slice = slice(0, self.size)
+        frame = {"trace_id": "trace_" + pd.Series(
+                                self.buffers["trace_id"][_slice]).astype(str)}
+        for kk in self.COLUMNS[1:]:
+            if kk in self.CATEGORIES:
+                frame[kk] = pd.Categorical.from_codes(
+                                self.buffers[kk][_slice],
+                                categories=self.CATEGORIES[kk])
+            else:
+                frame[kk] = self.buffers[kk][_slice]
+        return pd.DataFrame(frame, columns=self.COLUMNS)
+
+    def flush(self):
+        """ Write out the buffered picks """
+        frame = self.__frame__()
+        if self.parquet:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.__writer__ is None:
+                self.__writer__ = pq.ParquetWriter(
+                                    str(self.folder / (self.name + ".parquet")),
+                                    table.schema)
+            self.__writer__.write_table(table)
+        if self.csv:
+            frame.to_csv(
+                str(self.folder / (self.name + ".csv")),
+                sep=',',
+                mode="a" if self.__written__ else "w",
+                header=not self.__written__,
+                index=False,
+                float_format="%.3f",
+                na_rep="NA", encoding='utf-8')
+        self.__written__ = True
+        self.total += self.size
+        self.size = 0
+
+    def close(self):
+        """ Write out the last picks. Returns the total number of picks """
+        if self.size or not self.__written__:
+            self.flush()
+        if self.__writer__ is not None:
+            self.__writer__.close()
+            self.__writer__ = None
+        return self.total
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+# Scoring of DKPN and PN on the same TEST windows
+# (LoadEvaluate_DKPN.py, the session mode). ARGS are the
+# options of LoadEvaluate_DKPN.py (argparse.Namespace)
+
+EVAL_AUGMENTATIONS = {
+    "amp_norm_type": "std",
+    "window_strategy": "move",  # "pad"
+    "final_windowlength": 3001,
+    "sigma": 10,
+    "phase_dict": {
+        "trace_p_arrival_sample": "P",
+        "trace_pP_arrival_sample": "P",
+        "trace_P_arrival_sample": "P",
+        "trace_P1_arrival_sample": "P",
+        "trace_Pg_arrival_sample": "P",
+        "trace_Pn_arrival_sample": "P",
+        "trace_PmP_arrival_sample": "P",
+        "trace_pwP_arrival_sample": "P",
+        "trace_pwPm_arrival_sample": "P",
+        "trace_s_arrival_sample": "S",
+        "trace_S_arrival_sample": "S",
+        "trace_S1_arrival_sample": "S",
+        "trace_Sg_arrival_sample": "S",
+        "trace_SmS_arrival_sample": "S",
+        "trace_Sn_arrival_sample": "S",
+        # For AQUILA
+        "trace_p1_arrival_sample": "P",
+        "trace_p2_arrival_sample": "P",
+        "trace_p3_arrival_sample": "P",
+        "trace_p4_arrival_sample": "P",
+        "trace_p5_arrival_sample": "P",
+        "trace_s1_arrival_sample": "S",
+        "trace_s2_arrival_sample": "S",
+        "trace_s3_arrival_sample": "S",
+        "trace_s4_arrival_sample": "S",
+        "trace_s5_arrival_sample": "S",
+    },
+}
+
+
+def evaluation_parser():
+    """ Options of LoadEvaluate_DKPN.py: the session mode builds the ARGS
+        of every evaluation with them """
+    parser = argparse.ArgumentParser(description=(
+                                    "Script for comparing DKPN and PhaseNet models. "
+                                    "It needs to have the 'dkpn' folder in the working path. "
+                                    "The residuals plot "
+                                    "Requires Python >= 3.9"))
+
+    parser.add_argument('-d', '--dataset_name', type=str, default='ETHZ', help='Dataset name for TEST')
+    parser.add_argument('-s', '--dataset_size', type=str, default='Nano', help='Dataset size')
+    parser.add_argument('-r', '--random_seed', type=int, default=42, help='Random seed')
+    parser.add_argument('-o', '--store_folder', type=str, default='trained_results', help='Comparison Results folder')
+    #
+    parser.add_argument('-k', '--dkpn_model_name', type=str, required=True, help='DKPN model path')
+    parser.add_argument('-p', '--pn_model_name', type=str, required=True, help='PN model path')
+    parser.add_argument('-x', '--pickthreshold_p', type=float, default=0.2, help='Pick threshold P')
+    parser.add_argument('-y', '--pickthreshold_s', type=float, default=0.2, help='Pick threshold S')
+    parser.add_argument('-t', '--thresholds', type=str, nargs="+", default=None,
+                        help='Score all these pick thresholds (P and S) on the same predictions: one STORE_FOLDER_<thr> folder each (overrides -x/-y)')
+    parser.add_argument('-a', '--truepositive_p', type=int, default=10, help='Delta for declare True Positive P (samples)')
+    parser.add_argument('-b', '--truepositive_s', type=int, default=20, help='Delta for declare True Positive S (samples)')
+    parser.add_argument('-n', '--test_samples', type=int, default=5000, help='Number of test samples')
+    parser.add_argument('-f', '--nplots', type=int, default=10, help='Number of examples plots')
+    parser.add_argument('-w', '--num_workers', type=int, default=8, help='DataLoader workers for the TEST windows')
+    parser.add_argument('--eval_batch_size', type=int, default=64, help='Batch-Size of the predictions')
+    parser.add_argument('--picks_chunk_size', type=int, default=100000, help='Picks kept in memory before writing them out')
+    parser.add_argument('--no_picks_csv', action="store_true", help='Store the picks in Parquet only (no Picks.csv)')
+    parser.add_argument('--plot_workers', type=int, default=2, help='Background processes drawing the figures (0: only write the plot jobs, see RenderPlots.py)')
+    parser.add_argument('--store_residuals', action="store_true", help='Dump every TP/FP residual too (*_residuals.pickle), not only their histograms')
+    parser.add_argument('--prediction_store', type=str, default=None, help='Store the predictions in this folder, and re-score the stored ones (same models, dataset, seed, samples) without inference')
+    return parser
+
+
+def load_pickers(dkpn_model_name, pn_model_path, device="cuda"):
+    """ DKPN and PN (eval mode) of the evaluation, on DEVICE """
+    mydkpn = load_dkpn(dkpn_model_name)
+    mydkpn.eval()
+    mydkpn.to(device)
+
+    mypn = sbm.PhaseNet()
+    mypn.load_state_dict(torch.load(str(pn_model_path), map_location=torch.device('cpu')))
+    mypn.eval()
+    mypn.to(device)
+    return (mydkpn, mypn)
+
+
+def eval_generators(dkpn, train, dev, test):
+    """ (train, dev, test) DKPN generators of the evaluation: the
+        augmentations follow the CFs parameters of DKPN """
+    TRAIN_CLASS_DKPN = TrainHelp_DomainKnowledgePhaseNet(
+                            dkpn,  # It will contains the default args for StreamCF calculations!!!
+                            train, dev, test,
+                            augmentations_par=EVAL_AUGMENTATIONS)
+    return TRAIN_CLASS_DKPN.get_generator()
+
+
+def selection_indices(nsamples, random_seed):
+    """ The NSAMPLES unique random items to evaluate ... avoid duplicates """
+    rng = np.random.default_rng(seed=random_seed)
+    return rng.choice(np.arange(nsamples), size=nsamples, replace=False)
+
+
+def pn_checkpoint(model_path):
+    """ The PN '*.pt' file: MODEL_PATH itself or the first one inside """
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        model_path = [xx for xx in model_path.glob("*.pt")][0]
+    return model_path
+
+
+def threshold_runs(args):
+    """ One scoring RUN per threshold: (thr_p, thr_s, results folder).
+        With ARGS.thresholds one STORE_FOLDER_<thr> folder each,
+        else the P and S thresholds in STORE_FOLDER """
+    if args.thresholds:
+        RUNS_THRESHOLDS = [(float(_thr), float(_thr),
+                            Path("%s_%s" % (args.store_folder, _thr)))
+                           for _thr in args.thresholds]
+    else:
+        RUNS_THRESHOLDS = [(args.pickthreshold_p, args.pickthreshold_s,
+                            Path(args.store_folder))]
+
+    for (_, _, STORE_DIR_RESULTS) in RUNS_THRESHOLDS:
+        if not STORE_DIR_RESULTS.is_dir():
+            STORE_DIR_RESULTS.mkdir(parents=True, exist_ok=True)
+    return RUNS_THRESHOLDS
+
+
+def __figure_title__(args, META):
+    """ META is a row of the `dkeval.metadata_table` """
+    return "%s - %s  %s  %s  %s:%.1f  EpiDist:%.1f km" % (
+                        args.dataset_size, args.dataset_name,
+                        META.seedid, META.start_time,
+                        META.magnitude_type, META.magnitude, META.epidist)
+
+
+def __new_run__(args, thr_p, thr_s, store_dir):
+    """ Statistics, residuals histograms and picks of one threshold
+        (the exact residuals are collected with --store_residuals only) """
+    RUN = {"thr_p": thr_p, "thr_s": thr_s, "dir": store_dir,
+           "figureidx": 0,
+           "PICKS": PickAccumulator(store_dir,
+                                    chunk_size=args.picks_chunk_size,
+                                    csv=not args.no_picks_csv)}
+    for kk in ("DKPN_P", "DKPN_S", "PN_P", "PN_S"):
+        RUN[kk] = EV.PickMetrics()
+    if args.store_residuals:
+        for kk in ("dkpn_p_tp", "dkpn_s_tp", "dkpn_p_fp", "dkpn_s_fp",
+                   "pn_p_tp", "pn_s_tp", "pn_p_fp", "pn_s_fp"):
+            RUN[kk] = []
+    return RUN
+
+
+def __score_sample__(args, PLOTS, RUN, rand_num_selection, DKPN_sample,
+                     PN_sample, DKPN_pred, PN_pred, FIGURE_TITLE,
+                     DKPN_gen_name, PN_gen_name):
+    """ Picks and statistics of one sample at the RUN thresholds
+        (the smoothed traces are written back in the given arrays) """
+    # ------------------------------------------------------------
+    # ----------------- Do STATISTICS DKPN
+
+    # P
+    (DKPN_P_picks_model, DKPN_P_widths_model, DKPN_P_amplitude_model, DKPN_pred[0]) = EV.extract_picks(
+                                                    DKPN_pred[0],
+                                                    smooth=True,
+                                                    thr=RUN["thr_p"])
+    (DKPN_P_picks_label, DKPN_P_widths_label, DKPN_P_amplitude_label, DKPN_sample["y"][0]) = (
+                                                   EV.extract_picks(
+                                                    DKPN_sample["y"][0],
+                                                    smooth=True,
+                                                    thr=RUN["thr_p"])
+                                                   )
+
+    (DKPN_residual_TP_P, DKPN_residual_FP_P) = RUN["DKPN_P"].compare(
+                                      DKPN_P_picks_model,
+                                      DKPN_P_picks_label,
+                                      thr=args.truepositive_p)
+
+    # S
+    (DKPN_S_picks_model, DKPN_S_widths_model, DKPN_S_amplitude_model, DKPN_pred[1]) = EV.extract_picks(
+                                                    DKPN_pred[1],
+                                                    smooth=True,
+                                                    thr=RUN["thr_s"])
+    (DKPN_S_picks_label, DKPN_S_widths_label, DKPN_S_amplitude_label, DKPN_sample["y"][1]) = (
+                                                   EV.extract_picks(
+                                                    DKPN_sample["y"][1],
+                                                    smooth=True,
+                                                    thr=RUN["thr_s"])
+                                                   )
+
+    (DKPN_residual_TP_S, DKPN_residual_FP_S) = RUN["DKPN_S"].compare(
+                                      DKPN_S_picks_model,
+                                      DKPN_S_picks_label,
+                                      thr=args.truepositive_s)
+
+    if args.store_residuals:
+        RUN["dkpn_p_tp"].extend(DKPN_residual_TP_P)
+        RUN["dkpn_s_tp"].extend(DKPN_residual_TP_S)
+        RUN["dkpn_p_fp"].extend(DKPN_residual_FP_P)
+        RUN["dkpn_s_fp"].extend(DKPN_residual_FP_S)
+
+    # === Populate Picks
+    RUN["PICKS"].add(rand_num_selection, DKPN_P_picks_model, DKPN_P_widths_model,
+                     DKPN_P_amplitude_model, 'P', 'pred', 'DKPN')
+    RUN["PICKS"].add(rand_num_selection, DKPN_P_picks_label, DKPN_P_widths_label,
+                     DKPN_P_amplitude_label, 'P', 'ref', 'DKPN')
+    RUN["PICKS"].add(rand_num_selection, DKPN_S_picks_model, DKPN_S_widths_model,
+                     DKPN_S_amplitude_model, 'S', 'pred', 'DKPN')
+    RUN["PICKS"].add(rand_num_selection, DKPN_S_picks_label, DKPN_S_widths_label,
+                     DKPN_S_amplitude_label, 'S', 'ref', 'DKPN')
+
+    # ------------------------------------------------------------
+    # ----------------- Do STATISTICS PN
+
+    # P
+    (PN_P_picks_model, PN_P_widths_model, PN_P_amplitude_model, PN_pred[0]) = EV.extract_picks(
+                                                    PN_pred[0],
+                                                    smooth=True,
+                                                    thr=RUN["thr_p"])
+    (PN_P_picks_label, PN_P_widths_label, PN_P_amplitude_label, PN_sample["y"][0]) = (
+                                               EV.extract_picks(
+                                                    PN_sample["y"][0],
+                                                    smooth=True,
+                                                    thr=RUN["thr_p"])
+                                            )
+
+    (PN_residual_TP_P, PN_residual_FP_P) = RUN["PN_P"].compare(
+                                    PN_P_picks_model,
+                                    PN_P_picks_label,
+                                    thr=args.truepositive_p)
+    # S
+    (PN_S_picks_model, PN_S_widths_model, PN_S_amplitude_model, PN_pred[1]) = EV.extract_picks(
+                                                    PN_pred[1],
+                                                    smooth=True,
+                                                    thr=RUN["thr_s"])
+    (PN_S_picks_label, PN_S_widths_label, PN_S_amplitude_label, PN_sample["y"][1]) = (
+                                               EV.extract_picks(
+                                                    PN_sample["y"][1],
+                                                    smooth=True,
+                                                    thr=RUN["thr_s"])
+                                                )
+
+    (PN_residual_TP_S, PN_residual_FP_S) = RUN["PN_S"].compare(
+                                    PN_S_picks_model,
+                                    PN_S_picks_label,
+                                    thr=args.truepositive_s)
+
+    if args.store_residuals:
+        RUN["pn_p_tp"].extend(PN_residual_TP_P)
+        RUN["pn_s_tp"].extend(PN_residual_TP_S)
+        RUN["pn_p_fp"].extend(PN_residual_FP_P)
+        RUN["pn_s_fp"].extend(PN_residual_FP_S)
+
+    # === Populate Picks
+    RUN["PICKS"].add(rand_num_selection, PN_P_picks_model, PN_P_widths_model,
+                     PN_P_amplitude_model, 'P', 'pred', 'PN')
+    RUN["PICKS"].add(rand_num_selection, PN_P_picks_label, PN_P_widths_label,
+                     PN_P_amplitude_label, 'P', 'ref', 'PN')
+    RUN["PICKS"].add(rand_num_selection, PN_S_picks_model, PN_S_widths_model,
+                     PN_S_amplitude_model, 'S', 'pred', 'PN')
+    RUN["PICKS"].add(rand_num_selection, PN_S_picks_label, PN_S_widths_label,
+                     PN_S_amplitude_label, 'S', 'ref', 'PN')
+
+    # ------------------------------------------------------------
+    # ----------------- PLOTS
+
+    if (RUN["figureidx"]+1) <= args.nplots and DKPN_sample["X"] is not None:
+        assert RUN["thr_p"] == RUN["thr_s"]
+        PLOTS.submit(
+                EV.create_AL_plots,
+                RUN["dir"] / (
+                    "Prediction_Example_%s_%s_%d.pdf" % (
+                        DKPN_gen_name, PN_gen_name, RUN["figureidx"])),
+                PN_sample["X"],
+                PN_sample["y"],
+                DKPN_sample["X"],
+                PN_pred,
+                DKPN_pred,
+                PN_P_picks_label,    # The groundtruth IDX
+                PN_S_picks_label,    # The groundtruth IDX
+                PN_P_picks_model,    # The PN model picks IDX
+                PN_S_picks_model,    # The PN model picks IDX
+                DKPN_P_picks_model,  # The DKPN model picks IDX
+                DKPN_S_picks_model,  # The DKPN model picks IDX
+                detect_thr=RUN["thr_p"],
+                fig_title=FIGURE_TITLE)
+    #
+    RUN["figureidx"] += 1
+
+
+def __store_scores__(args, stats_dict_P, stats_dict_S, scores_path, pickle_path):
+    """ SCORES_*.txt and results_*.pickle of one picker """
+    (P_f1, P_precision, P_recall) = EV.calculate_scores(stats_dict_P)
+    (S_f1, S_precision, S_recall) = EV.calculate_scores(stats_dict_S)
+
+    with open(str(scores_path), "w") as OUT:
+        OUT.write(("samples:  %d"+os.linesep*2) % args.test_samples)
+        #
+        for vv, kk in stats_dict_P.items():
+            vv = "P_"+vv
+            OUT.write(("%7s:  %7d"+os.linesep) % (vv, kk))
+        #
+        OUT.write(os.linesep)
+        OUT.write(("P_f1:         %4.2f"+os.linesep) % P_f1)
+        OUT.write(("P_precision:  %4.2f"+os.linesep) % P_precision)
+        OUT.write(("P_recall:     %4.2f"+os.linesep*2) % P_recall)
+        #
+        for vv, kk in stats_dict_S.items():
+            vv = "S_"+vv
+            OUT.write(("%7s:  %7d"+os.linesep) % (vv, kk))
+        #
+        OUT.write(os.linesep)
+        OUT.write(("S_f1:         %4.2f"+os.linesep) % S_f1)
+        OUT.write(("S_precision:  %4.2f"+os.linesep) % S_precision)
+        OUT.write(("S_recall:     %4.2f"+os.linesep*2) % S_recall)
+
+    # CREATE dictionary to disk
+    res_dict = {}
+    res_dict['samples'] = args.test_samples
+    #
+    res_dict.update({"P_"+kk: vv for kk, vv in stats_dict_P.items()})
+    res_dict["P_f1"] = P_f1
+    res_dict["P_precision"] = P_precision
+    res_dict["P_recall"] = P_recall
+    #
+    res_dict.update({"S_"+kk: vv for kk, vv in stats_dict_S.items()})
+    res_dict["S_f1"] = S_f1
+    res_dict["S_precision"] = S_precision
+    res_dict["S_recall"] = S_recall
+
+    # SAVE dictionary to disk
+    with open(str(pickle_path), 'wb') as file:
+        pickle.dump(res_dict, file)
+
+
+def __store_run__(args, PLOTS, RUN, DKPN_gen_name, PN_gen_name):
+    """ Scores, metrics, residuals, picks and figure of one RUN """
+    STORE_DIR_RESULTS = RUN["dir"]
+
+    # ------------------------------------------
+    # ------- FINAL STATISTICS ON DKPN
+    __store_scores__(args, RUN["DKPN_P"].stats, RUN["DKPN_S"].stats,
+                     STORE_DIR_RESULTS / ("SCORES_%s.txt" % DKPN_gen_name),
+                     STORE_DIR_RESULTS / 'results_DKPN.pickle')
+
+    # ------------------------------------------
+    # ------- FINAL STATISTICS ON PN
+    __store_scores__(args, RUN["PN_P"].stats, RUN["PN_S"].stats,
+                     STORE_DIR_RESULTS / ("SCORES_%s.txt" % PN_gen_name),
+                     STORE_DIR_RESULTS / 'results_PN.pickle')
+
+    # SAVE RESIDUALS HISTOGRAMS - DKPN / PN  (mergeable `EV.PickMetrics`)
+    with open(str(STORE_DIR_RESULTS / 'METRICS.pickle'), 'wb') as file:
+        pickle.dump({kk: RUN[kk] for kk in ("DKPN_P", "DKPN_S", "PN_P", "PN_S")}, file)
+
+    # SAVE RESIDUALS - DKPN / PN  (numpy array of seconds)
+    if args.store_residuals:
+        for (kk, name) in (("dkpn_p_tp", 'DKPN_TP_P_residuals.pickle'),
+                           ("dkpn_s_tp", 'DKPN_TP_S_residuals.pickle'),
+                           ("dkpn_p_fp", 'DKPN_FP_P_residuals.pickle'),
+                           ("dkpn_s_fp", 'DKPN_FP_S_residuals.pickle'),
+                           ("pn_p_tp", 'PN_TP_P_residuals.pickle'),
+                           ("pn_s_tp", 'PN_TP_S_residuals.pickle'),
+                           ("pn_p_fp", 'PN_FP_P_residuals.pickle'),
+                           ("pn_s_fp", 'PN_FP_S_residuals.pickle')):
+            with open(str(STORE_DIR_RESULTS / name), 'wb') as file:
+                pickle.dump(np.array(RUN[kk])*0.01, file)
+
+    # =============================================================================
+
+    # STOREPICK (Parquet / CSV): the last chunk of picks
+    RUN["PICKS"].close()
+
+    # TP residuals
+    PLOTS.submit(EV.create_residuals_plot_compare,
+                 STORE_DIR_RESULTS / "Residuals_P_S_comparison_DKPN_PN.pdf",
+                 RUN["DKPN_P"].tp, RUN["DKPN_S"].tp,
+                 RUN["PN_P"].tp, RUN["PN_S"].tp,
+                 binwidth=0.025)
+
+    # Store PARAMETER
+    with open(str(STORE_DIR_RESULTS / "CALL_ARGS.py"), "w") as OUT:
+        OUT.write("ARGS=%s" % args)
+
+
+def __score_chunk__(args, PLOTS, RUN, trace_idx, y, DKPN_pred, PN_pred,
+                    inputs, titles, DKPN_gen_name, PN_gen_name):
+    """ `__score_sample__` on N stored samples at once, with the same
+        results: TRACE_IDX (N, ) generator items, Y / DKPN_PRED / PN_PRED
+        (N, 3, time) arrays where the smoothed traces are written back.
+        INPUTS (X, Xpn) and TITLES of the first samples, for the plots """
+    ntr = len(trace_idx)
+    PICKS = []
+    for (picker, pred) in (("DKPN", DKPN_pred), ("PN", PN_pred)):
+        for (ph, phase, thr, delta) in (
+                    (0, "P", RUN["thr_p"], args.truepositive_p),
+                    (1, "S", RUN["thr_s"], args.truepositive_s)):
+            # As trace by trace: the PN labels are smoothed once more
+            (*model, pred[:, ph]) = EV.extract_picks_batch(pred[:, ph], thr=thr)
+            (*label, y[:, ph]) = EV.extract_picks_batch(y[:, ph], thr=thr)
+            PICKS.append((picker, phase, "pred", model))
+            PICKS.append((picker, phase, "ref", label))
+
+            (residual_TP, residual_FP) = RUN["%s_%s" % (picker, phase)].compare_batch(
+                                EV.pad_picks(model[0], offsets=model[3]),
+                                EV.pad_picks(label[0], offsets=label[3]),
+                                thr=delta)
+            if args.store_residuals:
+                RUN["%s_%s_tp" % (picker.lower(), phase.lower())].extend(residual_TP)
+                RUN["%s_%s_fp" % (picker.lower(), phase.lower())].extend(residual_FP)
+
+    # === Populate Picks: same rows order as sample by sample
+    (position, columns, codes) = ([], [[], [], []], {kk: [] for kk in PickAccumulator.CATEGORIES})
+    for (picker, phase, label, (peaks, widths, ampl, offsets)) in PICKS:
+        position.append(np.repeat(np.arange(ntr), np.diff(offsets)))
+        for (cc, vv) in zip(columns, (peaks, widths, ampl)):
+            cc.append(vv)
+        for (kk, vv) in (("phase", phase), ("label", label), ("picker", picker)):
+            codes[kk].append(np.full(len(peaks), PickAccumulator.CATEGORIES[kk].index(vv)))
+    order = np.argsort(np.concatenate(position), kind="stable")
+    RUN["PICKS"].add_batch(np.asarray(trace_idx)[np.concatenate(position)[order]],
+                           *[np.concatenate(cc)[order] for cc in columns],
+                           {kk: np.concatenate(vv)[order] for (kk, vv) in codes.items()})
+
+    # ------------------------------------------------------------
+    # ----------------- PLOTS
+
+    def _trace_picks_(picker, phase, label, kk):
+        for (_picker, _phase, _label, (peaks, _, _, offsets)) in PICKS:
+            if (_picker, _phase, _label) == (picker, phase, label):
+                return peaks[offsets[kk]:offsets[kk+1]]
+
+    for kk in range(min(ntr, len(titles))):
+        if (RUN["figureidx"]+kk+1) > args.nplots:
+            break
+        assert RUN["thr_p"] == RUN["thr_s"]
+        PLOTS.submit(
+                EV.create_AL_plots,
+                RUN["dir"] / (
+                    "Prediction_Example_%s_%s_%d.pdf" % (
+                        DKPN_gen_name, PN_gen_name, RUN["figureidx"]+kk)),
+                inputs[1][kk],
+                y[kk],
+                inputs[0][kk],
+                PN_pred[kk],
+                DKPN_pred[kk],
+                _trace_picks_("PN", "P", "ref", kk),     # The groundtruth IDX
+                _trace_picks_("PN", "S", "ref", kk),     # The groundtruth IDX
+                _trace_picks_("PN", "P", "pred", kk),    # The PN model picks IDX
+                _trace_picks_("PN", "S", "pred", kk),    # The PN model picks IDX
+                _trace_picks_("DKPN", "P", "pred", kk),  # The DKPN model picks IDX
+                _trace_picks_("DKPN", "S", "pred", kk),  # The DKPN model picks IDX
+                detect_thr=RUN["thr_p"],
+                fig_title=titles[kk])
+    #
+    RUN["figureidx"] += ntr
+
+
+def evaluate_store(args, store, runs_thresholds, PLOTS,
+                   DKPN_gen_name="TEST_DKPN", PN_gen_name="TEST_PN",
+                   chunk_size=500):
+    """ `evaluate_selection` of the predictions in a `PredictionStore`:
+        no models, no dataset, only the post-processing, vectorized over
+        CHUNK_SIZE samples at once. Returns the RUN dictionaries.
+    """
+    print("Working with:  %s + %s  (stored predictions)" % (DKPN_gen_name, PN_gen_name))
+    RUNS = [__new_run__(args, thr_p, thr_s, store_dir)
+            for (thr_p, thr_s, store_dir) in runs_thresholds]
+    if store.ninputs < args.nplots:
+        print("... inputs stored for %d plots only" % store.ninputs)
+    index = np.asarray(store.arrays["index"])
+
+    for start in tqdm(range(0, len(store), chunk_size)):
+        stop = min(start + chunk_size, len(store))
+        y = np.array(store.arrays["y"][start:stop])
+        DKPN_pred = np.array(store.arrays["DKPN"][start:stop])
+        PN_pred = np.array(store.arrays["PN"][start:stop])
+
+        # Inputs (and titles) of the plotted samples only
+        ninputs = max(0, min(stop, store.ninputs, args.nplots) - start)
+        inputs = (None, None)
+        if ninputs:
+            inputs = (np.array(store.arrays["X"][start:start+ninputs]),
+                      np.array(store.arrays["Xpn"][start:start+ninputs]))
+        titles = [__figure_title__(args, store.metadata.loc[ii])
+                  if store.metadata is not None else None
+                  for ii in index[start:start+ninputs]]
+
+        # The same predictions are scored at every threshold
+        for RUN in RUNS:
+            __score_chunk__(args, PLOTS, RUN, index[start:stop],
+                            y.copy(), DKPN_pred.copy(), PN_pred.copy(),
+                            inputs, titles, DKPN_gen_name, PN_gen_name)
+
+    for RUN in RUNS:
+        __store_run__(args, PLOTS, RUN, DKPN_gen_name, PN_gen_name)
+    return RUNS
+
+
+def evaluate_selection(args, dkpn, pn, pn_model_path, generator, rnidx,
+                       runs_thresholds, PLOTS,
+                       DKPN_gen_name="TEST_DKPN", PN_gen_name="TEST_PN"):
+    """ Score DKPN and PN on the first ARGS.test_samples items RNIDX of
+        GENERATOR, at every threshold of RUNS_THRESHOLDS, storing the
+        results in their folders (the figures go to the `EV.PlotPool`
+        PLOTS). With ARGS.prediction_store the predictions are stored,
+        or `evaluate_store` re-scores them if already there (better
+        checked before loading models and dataset, see
+        `stored_predictions`). Returns the RUN dictionaries.
+    """
+    (STORE_DIR_PREDICTIONS, STORED) = stored_predictions(
+                                args, pn_model_path, split=DKPN_gen_name)
+    if STORED is not None:
+        # Same models and selection: only the post-processing is redone
+        print("Loading PREDICTIONS from:  %s" % STORE_DIR_PREDICTIONS)
+        return evaluate_store(args, STORED, runs_thresholds, PLOTS,
+                              DKPN_gen_name=DKPN_gen_name,
+                              PN_gen_name=PN_gen_name)
+
+    print("Working with:  %s + %s" % (DKPN_gen_name, PN_gen_name))
+    RUNS = [__new_run__(args, thr_p, thr_s, store_dir)
+            for (thr_p, thr_s, store_dir) in runs_thresholds]
+
+    # Station, event and distance of the samples, for the figure titles
+    if args.nplots > 0:
+        METATABLE = metadata_table(generator.dataset.metadata,
+                                   rnidx[:args.test_samples])
+
+    # Windows are augmented by the DataLoader workers, both pickers
+    # predict a whole batch at once: here we get one sample at a time
+    PREDICTIONS = predict_selection(
+                    dkpn, pn, generator, rnidx[:args.test_samples],
+                    batch_size=args.eval_batch_size,
+                    num_workers=args.num_workers,
+                    random_seed=args.random_seed)
+    if STORE_DIR_PREDICTIONS:
+        print("Storing PREDICTIONS in:  %s" % STORE_DIR_PREDICTIONS)
+        PREDICTIONS = store_predictions(
+                    PREDICTIONS, STORE_DIR_PREDICTIONS,
+                    rnidx[:args.test_samples], keep_inputs=args.nplots,
+                    metadata=(METATABLE.loc[rnidx[:min(args.nplots, args.test_samples)]]
+                              if args.nplots > 0 else None),
+                    info={"dkpn_model_name": args.dkpn_model_name,
+                              "pn_model_name": args.pn_model_name,
+                              "dataset_name": args.dataset_name,
+                              "dataset_size": args.dataset_size,
+                              "split": DKPN_gen_name,
+                              "random_seed": args.random_seed})
+
+    for (xx, DKPN_sample, DKPN_pred, PN_pred) in tqdm(PREDICTIONS,
+                                                      total=args.test_samples):
+        rand_num_selection = rnidx[xx]
+
+        FIGURE_TITLE = None
+        if any((RUN["figureidx"]+1) <= args.nplots for RUN in RUNS):
+            FIGURE_TITLE = __figure_title__(args, METATABLE.loc[rand_num_selection])
+
+        # The same predictions are scored at every threshold.
+        # Equal window for PN (Xorig of DKPN, without the fp_stab samples),
+        # sharing the labels array with DKPN as always
+        for RUN in RUNS:
+            _DKPN_sample = {"X": DKPN_sample["X"],
+                            "y": DKPN_sample["y"].copy()}
+            _PN_sample = {"X": DKPN_sample["Xpn"],
+                          "y": _DKPN_sample["y"]}
+            __score_sample__(args, PLOTS, RUN, rand_num_selection,
+                             _DKPN_sample, _PN_sample,
+                             DKPN_pred.copy(), PN_pred.copy(),
+                             FIGURE_TITLE, DKPN_gen_name, PN_gen_name)
+
+    for RUN in RUNS:
+        __store_run__(args, PLOTS, RUN, DKPN_gen_name, PN_gen_name)
+    return RUNS
@@ -0,0 +1,170 @@
+from pathlib import Path
+
+import torch
+from torch.ao.quantization import get_default_qconfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from dkpn.core import DKPN, FusedDKPN
+
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+except ImportError:
+    # torch < 1.13 still uses the qconfig_dict API
+    get_default_qconfig_mapping = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+def export_onnx(dkpn, file_path, opset_version=13, fused=True):
+    """ Export the DKPN network to an ONNX file.
+        The graph takes a 'X' input of shape (batch, in_channels, in_samples)
+        with dynamic batch, and returns the softmax 'probs' output.
+        If FUSED, the BN-folded network (`FusedDKPN`) is exported.
+    """
+    file_path = Path(file_path)
+    if fused:
+        net = FusedDKPN(dkpn).cpu()
+    else:
+        net = dkpn
+    training = net.training
+    net.eval()
+
+    example_input = torch.zeros(1, dkpn.in_channels, dkpn.in_samples)
+    with torch.no_grad():
+        torch.onnx.export(net, example_input, str(file_path),
+                          input_names=["X"],
+                          output_names=["probs"],
+                          dynamic_axes={"X": {0: "batch"},
+                                        "probs": {0: "batch"}},
+                          opset_version=opset_version)
+    net.train(training)
+    return file_path
+
+
+class DKPN_ONNX(DKPN):
+    """ DKPN picker whose forward pass runs on ONNX Runtime (CPU).
+        It keeps the full DKPN annotate/classify flow (CFs pre-processing,
+        window normalization, picking): only the network evaluation is
+        delegated to the ONNX session.
+        The ONNX file must come from `export_onnx`.
+        Remember to set the CFs parameters with `set_dkpn_parameter` if the
+        exported model used non-default ones.
+    """
+
+    def __init__(self, onnx_path, intra_op_threads=1, inter_op_threads=1,
+                 **kwargs):
+        if ort is None:
+            raise ImportError("The 'onnxruntime' package is needed for DKPN_ONNX")
+        super().__init__(**kwargs)
+        self.onnx_path = str(onnx_path)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = intra_op_threads
+        sess_options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(
+                            self.onnx_path, sess_options,
+                            providers=["CPUExecutionProvider"])
+        self.eval()
+
+    @classmethod
+    def from_dkpn(cls, dkpn, onnx_path, intra_op_threads=1,
+                  inter_op_threads=1):
+        """ Export DKPN to ONNX_PATH and return the ONNX-backed picker
+            with the same model and CFs parameters """
+        export_onnx(dkpn, onnx_path)
+        model = cls(onnx_path, intra_op_threads=intra_op_threads,
+                    inter_op_threads=inter_op_threads,
+                    **dkpn.get_model_args())
+        model.set_dkpn_parameter(dkpn.get_defaults())
+        return model
+
+    def forward(self, x, logits=False):
+        if logits:
+            raise ValueError("The ONNX graph returns only the probabilities!")
+        probs = self.session.run(["probs"],
+                                 {"X": x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(probs).to(x.device)
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+def quantize_dkpn(dkpn, calibration_batches, backend="fbgemm",
+                  max_batches=None):
+    """ Post-training static int8 quantization of the DKPN network.
+        The BN-folded network (`FusedDKPN`) is quantized with FX graph
+        mode: weights and activations go to int8, with the activation
+        ranges observed over CALIBRATION_BATCHES (an iterable of input
+        tensors or of generator batches with a "X" key, e.g. a
+        DataLoader over the `TrainHelp` dev generator).
+        Dynamic quantization is not offered: PyTorch only provides dynamic
+        kernels for Linear/RNN layers, and DKPN is convolutional only.
+        Returns the quantized (CPU) module.
+    """
+    torch.backends.quantized.engine = backend
+    net = FusedDKPN(dkpn).cpu().eval()
+    example_input = torch.zeros(1, dkpn.in_channels, dkpn.in_samples)
+
+    if get_default_qconfig_mapping is not None:
+        prepared = prepare_fx(net, get_default_qconfig_mapping(backend),
+                              (example_input, ))
+    else:
+        prepared = prepare_fx(net, {"": get_default_qconfig(backend)})
+
+    with torch.no_grad():
+        for _nb, batch in enumerate(calibration_batches):
+            if max_batches and _nb >= max_batches:
+                break
+            if isinstance(batch, dict):
+                batch = batch["X"]
+            prepared(batch.cpu())
+
+    return convert_fx(prepared)
+
+
+class DKPN_Quantized(DKPN):
+    """ DKPN picker whose forward pass runs the int8 network returned by
+        `quantize_dkpn` (or its TorchScript file).
+        As for `DKPN_ONNX`, the CFs pre-processing and the whole
+        annotate/classify flow are the ones of DKPN. Inference on CPU only.
+    """
+
+    def __init__(self, quantized_net, backend="fbgemm", **kwargs):
+        super().__init__(**kwargs)
+        torch.backends.quantized.engine = backend
+        if isinstance(quantized_net, (str, Path)):
+            quantized_net = torch.jit.load(str(quantized_net))
+        self.quantized_net = quantized_net
+        self.eval()
+
+    @classmethod
+    def from_dkpn(cls, dkpn, calibration_batches, backend="fbgemm",
+                  max_batches=None):
+        """ Quantize DKPN and return the int8 picker with the same model
+            and CFs parameters """
+        model = cls(quantize_dkpn(dkpn, calibration_batches,
+                                  backend=backend, max_batches=max_batches),
+                    backend=backend, **dkpn.get_model_args())
+        model.set_dkpn_parameter(dkpn.get_defaults())
+        return model
+
+    def save_quantized(self, file_path):
+        """ Store the int8 network as TorchScript """
+        torch.jit.save(torch.jit.script(self.quantized_net), str(file_path))
+
+    def forward(self, x, logits=False):
+        if logits:
+            raise ValueError("The quantized network returns only the probabilities!")
+        with torch.no_grad():
+            probs = self.quantized_net(x.detach().cpu())
+        return probs.to(x.device)
@@ -0,0 +1,219 @@
+import re
+import json
+import glob
+import traceback
+import multiprocessing
+from queue import Empty
+from pathlib import Path
+
+import torch
+
+import dkpn.eval_utils as EV
+import dkpn.evaluate as dkeval
+from dkpn.train import select_database_and_size
+
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+# Session mode: many (models x TEST datasets x thresholds) evaluations
+# in a few long-lived processes, keeping datasets and models loaded.
+#
+# The manifest (JSON):
+#   {
+#    "models": ["models_v0412_paper_sb4/*/*.pt"],
+#    "datasets": ["INSTANCE", "ETHZ", "PNW", "AQUILA"],
+#    "thresholds": ["0.1", "0.2", "0.5"],
+#    "output": ".",
+#    "store_folder": "Rnd_{seed}/Results_{train}_{test}_{size}",
+#    "options": {"test_samples": 5000, "nplots": 100}
+#   }
+# MODELS are glob patterns of the DKPN_* and PN_* checkpoints ('*.pt'
+# files or their folders) as named by the training scripts: the two
+# pickers with the same train dataset, size and seed are evaluated
+# together on every TEST dataset (of their size). THRESHOLDS as the
+# '-t' option (one STORE_FOLDER_<thr> folder each), without them the
+# '-x/-y' OPTIONS thresholds go in STORE_FOLDER. OPTIONS are the ones of
+# LoadEvaluate_DKPN.py (long names), STORE_FOLDER is formatted with
+# train, test, size and seed, inside OUTPUT.
+
+MODEL_NAME_REGEX = re.compile(
+        r"^(?P<picker>DKPN|PN)_TrainDataset_(?P<train>[^_]+)_Size_(?P<size>[^_]+)_Rnd_(?P<seed>\d+)")
+
+SESSION_STORE_FOLDER = "Rnd_{seed}/Results_{train}_{test}_{size}"
+
+
+def __model_key__(model_path):
+    """ (picker, train dataset, size, seed) of a checkpoint name, or None """
+    match = MODEL_NAME_REGEX.match(Path(model_path).name)
+    if not match:
+        return None
+    return (match.group("picker"), match.group("train"),
+            match.group("size"), int(match.group("seed")))
+
+
+def read_manifest(manifest_path):
+    with open(str(manifest_path), "r") as IN:
+        return json.load(IN)
+
+
+def model_pairs(patterns):
+    """ {(train, size, seed): {"DKPN": path, "PN": path}} of the
+        checkpoints matching PATTERNS (only complete pairs) """
+    found = {}
+    for pattern in patterns:
+        for model_path in sorted(glob.glob(pattern)):
+            key = __model_key__(model_path)
+            if key is None:
+                print("Not a DKPN / PN checkpoint name, skipped:  %s" % model_path)
+                continue
+            found.setdefault(key[1:], {})[key[0]] = model_path
+
+    pairs = {}
+    for (key, pickers) in sorted(found.items()):
+        if len(pickers) < 2:
+            print("Missing the %s twin of %s, skipped" % (
+                        "PN" if "DKPN" in pickers else "DKPN",
+                        list(pickers.values())[0]))
+            continue
+        pairs[key] = pickers
+    return pairs
+
+
+def session_jobs(manifest):
+    """ One job per models pair: the LoadEvaluate_DKPN.py ARGS of
+        each TEST dataset, the models are loaded once per job """
+    parser = dkeval.evaluation_parser()
+    output = Path(manifest.get("output", "."))
+    store_folder = manifest.get("store_folder", SESSION_STORE_FOLDER)
+
+    jobs = []
+    for ((train, size, seed), pickers) in model_pairs(manifest["models"]).items():
+        job = {"dkpn": pickers["DKPN"], "pn": pickers["PN"], "runs": []}
+        for test in manifest.get("datasets", [train]):
+            args = parser.parse_args(["-k", pickers["DKPN"], "-p", pickers["PN"]])
+            for (kk, vv) in manifest.get("options", {}).items():
+                if not hasattr(args, kk):
+                    raise ValueError("Unknown evaluation option:  %s" % kk)
+                setattr(args, kk, vv)
+            args.dataset_name = test
+            args.dataset_size = size
+            args.thresholds = manifest.get("thresholds", args.thresholds)
+            args.store_folder = str(output / store_folder.format(
+                                        train=train, test=test, size=size, seed=seed))
+            job["runs"].append(args)
+        jobs.append(job)
+    return jobs
+
+
+def __session_worker__(worker_id, device, queue, results, plot_workers):
+    """ Evaluate the jobs of QUEUE until None. The TEST datasets stay
+        loaded for the following jobs, the models for all the datasets
+        of their job. Both are loaded only when needed: the runs found
+        in the prediction store are only re-scored """
+    # Forked before any CUDA / data (see `EV.PlotPool`)
+    PLOTS = EV.PlotPool(processes=plot_workers)
+    DATASETS = {}
+
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        try:
+            PN_MODEL_PATH = dkeval.pn_checkpoint(job["pn"])
+        except Exception:
+            for args in job["runs"]:
+                results.put((worker_id, args.store_folder, traceback.format_exc()))
+            continue
+
+        (mydkpn, mypn) = (None, None)
+        for args in job["runs"]:
+            try:
+                (STORE_DIR_PREDICTIONS, STORED) = dkeval.stored_predictions(
+                                                        args, PN_MODEL_PATH)
+                if STORED is not None:
+                    print("Loading PREDICTIONS from:  %s" % STORE_DIR_PREDICTIONS)
+                    dkeval.evaluate_store(args, STORED,
+                                          dkeval.threshold_runs(args), PLOTS)
+                    results.put((worker_id, args.store_folder, None))
+                    continue
+
+                if mydkpn is None:
+                    (mydkpn, mypn) = dkeval.load_pickers(
+                                        job["dkpn"], PN_MODEL_PATH, device=device)
+                key = (args.dataset_name, args.dataset_size, args.random_seed)
+                if key not in DATASETS:
+                    DATASETS[key] = select_database_and_size(
+                                        args.dataset_name, args.dataset_size,
+                                        RANDOM_SEED=args.random_seed)
+                (_, _, test_generator_dkpn) = dkeval.eval_generators(
+                                                    mydkpn, *DATASETS[key])
+                rnidx = dkeval.selection_indices(args.test_samples, args.random_seed)
+                dkeval.evaluate_selection(args, mydkpn, mypn, PN_MODEL_PATH,
+                                          test_generator_dkpn, rnidx,
+                                          dkeval.threshold_runs(args), PLOTS)
+                results.put((worker_id, args.store_folder, None))
+            except Exception:
+                results.put((worker_id, args.store_folder, traceback.format_exc()))
+
+        del mydkpn, mypn
+        if device.startswith("cuda"):
+            torch.cuda.empty_cache()
+
+    results.put((worker_id, None, PLOTS.close()))
+
+
+def run_session(manifest, workers=1, devices=None, plot_workers=2):
+    """ Schedule the jobs of MANIFEST over WORKERS processes, placed
+        round-robin on DEVICES (all the GPUs, or the CPU, by default).
+        Returns {results folder: None or the error traceback} """
+    jobs = session_jobs(manifest)
+    if not devices:
+        devices = (["cuda:%d" % xx for xx in range(torch.cuda.device_count())]
+                   if torch.cuda.is_available() else ["cpu"])
+    workers = max(1, min(workers, len(jobs)))
+    print("Session:  %d models pairs, %d evaluations, %d workers on %s" % (
+                len(jobs), sum(len(job["runs"]) for job in jobs),
+                workers, devices))
+
+    # Spawned: nothing of CUDA, datasets or models is inherited
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    results = context.Queue()
+    for job in jobs:
+        queue.put(job)
+    for _ in range(workers):
+        queue.put(None)
+
+    processes = [context.Process(target=__session_worker__,
+                                 args=(xx, devices[xx % len(devices)], queue,
+                                       results, plot_workers))
+                 for xx in range(workers)]
+    for proc in processes:
+        proc.start()
+
+    SESSION = {}
+    running = workers
+    while running:
+        try:
+            (worker_id, folder, outcome) = results.get(timeout=60)
+        except Empty:
+            if not any(proc.is_alive() for proc in processes):
+                print("All the workers exited, %d evaluations missing" % (
+                        sum(len(job["runs"]) for job in jobs) - len(SESSION)))
+                break
+            continue
+        if folder is None:
+            print("Worker %d done (%d figures saved)" % (worker_id, outcome))
+            running -= 1
+        elif outcome is None:
+            print("Worker %d:  %s" % (worker_id, folder))
+            SESSION[folder] = None
+        else:
+            print("Worker %d FAILED:  %s" % (worker_id, folder))
+            print(outcome)
+            SESSION[folder] = outcome
+
+    for proc in processes:
+        proc.join()
+    return SESSION
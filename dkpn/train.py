@@ -1,10 +1,23 @@
 from tqdm import tqdm
 import os
+import json
+import hashlib
+import inspect
+import time
 import numpy as np
+import pandas as pd
 import copy
+import random
+import collections
+import types
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
-from torch.utils.data import DataLoader
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, Subset
+from torch.utils.data.distributed import DistributedSampler
 
 from pathlib import Path
 
@@ -12,7 +25,7 @@ import seisbench as sb
 import seisbench.data as sbd
 import seisbench.generate as sbg
 
-from dkpn.core import PreProc
+from dkpn.core import PreProc, StackedDKPN
 
  
 # ==================================================================
@@ -88,15 +101,39 @@ def __filter_sb_dataset__(indata, filter_for="INSTANCE"):
     return indata
 
 
+def __open_sb_dataset__(dataset_name):
+    """ Open the full SeisBench dataset. Every row is tagged with its
+        position ('dkpn_row'), so that the selected rows can be stored
+        in a split manifest (see `select_database_and_size`).
+    """
+    if dataset_name == "PNW":
+        dataset = sbd.WaveformDataset("/scratch/seisbench/datasets/pnw",
+                                      sampling_rate=100, cache="trace")
+    elif dataset_name == "AQUILA":
+        dataset = sbd.WaveformDataset("/scratch/seisbench/datasets/aq2009counts",
+                                      sampling_rate=100.0, cache="trace")
+    elif dataset_name == "ETHZ":
+        dataset = sbd.ETHZ(sampling_rate=100, cache="trace")
+    elif dataset_name == "INSTANCE":
+        dataset = sbd.InstanceCounts(sampling_rate=100, cache="trace")
+    elif dataset_name == "SCEDC":
+        dataset = sbd.SCEDC(sampling_rate=100, cache="trace")
+    else:
+        raise ValueError("Not a valid DATASET NAME!")
+    dataset.metadata["dkpn_row"] = np.arange(len(dataset.metadata))
+    return dataset
+
+
 def __select_database_and_size_PNW__(dataset_size, filtering=False,
                                      use_biggest_anyway=True,
                                      RANDOM_SEED=42,
                                      train_perc_size=0.60,
                                      dev_perc_size=0.30,
-                                     test_perc_size=0.10):
+                                     test_perc_size=0.10,
+                                     dataset_train=None):
 
-    dataset_train = sbd.WaveformDataset("/scratch/seisbench/datasets/pnw",
-                                        sampling_rate=100, cache="trace")
+    if dataset_train is None:
+        dataset_train = __open_sb_dataset__("PNW")
     dataset_train = __add_split_column__(dataset_train,
                                          TRAIN_PERC=train_perc_size,
                                          DEV_PERC=dev_perc_size,
@@ -118,10 +155,11 @@ def __select_database_and_size_AQUILA__(dataset_size, filtering=False,
                                         RANDOM_SEED=42,
                                         train_perc_size=0.60,
                                         dev_perc_size=0.10,
-                                        test_perc_size=0.30):
+                                        test_perc_size=0.30,
+                                        dataset_train=None):
 
-    dataset_train = sbd.WaveformDataset("/scratch/seisbench/datasets/aq2009counts",
-                                        sampling_rate=100.0, cache="trace")
+    if dataset_train is None:
+        dataset_train = __open_sb_dataset__("AQUILA")
     dataset_train = __add_split_column__(dataset_train,
                                          TRAIN_PERC=train_perc_size,
                                          DEV_PERC=dev_perc_size,
@@ -140,9 +178,11 @@ def __select_database_and_size_AQUILA__(dataset_size, filtering=False,
 
 def __select_database_and_size_ETHZ__(dataset_size, filtering=False,
                                       use_biggest_anyway=True,
-                                      RANDOM_SEED=42):
+                                      RANDOM_SEED=42,
+                                      dataset_train=None):
 
-    dataset_train = sbd.ETHZ(sampling_rate=100, cache="trace")
+    if dataset_train is None:
+        dataset_train = __open_sb_dataset__("ETHZ")
 
     # FILTER
     if filtering:
@@ -194,9 +234,11 @@ def __select_database_and_size_ETHZ__(dataset_size, filtering=False,
 
 
 def __select_database_and_size_INSTANCE__(dataset_size, filtering=False,
-                                          RANDOM_SEED=42):
+                                          RANDOM_SEED=42,
+                                          dataset_train=None):
 
-    dataset_train = sbd.InstanceCounts(sampling_rate=100, cache="trace")
+    if dataset_train is None:
+        dataset_train = __open_sb_dataset__("INSTANCE")
 
     # FILTER
     if filtering:
@@ -258,9 +300,11 @@ def __select_database_and_size_INSTANCE__(dataset_size, filtering=False,
 
 
 def __select_database_and_size_SCEDC__(dataset_size, filtering=False,
-                                       RANDOM_SEED=42):
+                                       RANDOM_SEED=42,
+                                       dataset_train=None):
 
-    dataset_train = sbd.SCEDC(sampling_rate=100, cache="trace")
+    if dataset_train is None:
+        dataset_train = __open_sb_dataset__("SCEDC")
 
     # FILTER
     if filtering:
@@ -320,45 +364,101 @@ def __select_database_and_size_SCEDC__(dataset_size, filtering=False,
     return (_train, _dev, _test)
 
 
-def select_database_and_size(dataset_name, dataset_size, RANDOM_SEED=42):
-    """ Big Switch for selection of dataset and sample numbers """
+def __split_manifest_path__(folder, dataset_name, dataset_size,
+                            RANDOM_SEED, select_fn, dataset):
+    """ Manifest file of a selection: the key covers dataset, size, seed,
+        the selection/filtering code and a fingerprint of the metadata """
+    _hash = hashlib.sha1()
+    for xx in (dataset_name, dataset_size.lower(), str(RANDOM_SEED),
+               inspect.getsource(select_fn),
+               inspect.getsource(__filter_sb_dataset__),
+               inspect.getsource(__add_split_column__),
+               str(len(dataset.metadata))):
+        _hash.update(xx.encode())
+    if "trace_name" in dataset.metadata.columns:
+        _hash.update(pd.util.hash_pandas_object(
+                        dataset.metadata["trace_name"], index=False).values.tobytes())
+    return Path(folder) / ("SPLITS_%s_%s_Rnd_%d_%s.npz" % (
+                    dataset_name, dataset_size.upper(), RANDOM_SEED,
+                    _hash.hexdigest()[:16]))
+
+
+def __apply_split_manifest__(dataset, manifest):
+    """ Rebuild the (TRAIN, DEV, TEST) splits of DATASET, as freshly
+        opened by `__open_sb_dataset__`, from the stored row positions """
+    _split = np.full(len(dataset.metadata), "", dtype=object)
+    _index = np.zeros(len(dataset.metadata), dtype=np.int64)
+    with np.load(str(manifest)) as npz:
+        for kk in ("train", "dev", "test"):
+            _split[npz[kk]] = kk
+            _index[npz[kk]] = npz[kk + "_index"]
+    dataset.metadata["split"] = _split
+    dataset.filter(_split != "", inplace=True)
+    dataset.metadata.reset_index(inplace=True)
+    # same index as after the original filtering
+    dataset.metadata.index = _index[_split != ""]
+    return dataset.train_dev_test()
+
+
+def select_database_and_size(dataset_name, dataset_size, RANDOM_SEED=42,
+                             split_cache=True):
+    """ Big Switch for selection of dataset and sample numbers.
+        With SPLIT_CACHE (True: 'dkpn_splits' in the SeisBench cache,
+        or a folder path) the rows selected for every split are stored
+        in a manifest (.npz), and the next calls with the same dataset,
+        size and seed skip the filtering and the splitting.
+    """
 
     print("Selecting DATASET from:  %s" % sb.cache_root)
     print("Selecting DATASET NAME:  %s" % dataset_name.upper())
     print("Selecting DATASET SIZE:  %s" % dataset_size.upper())
 
     # ===========> DATASET
+    # (name, selection, dataset opened)
     if dataset_name.upper() == "ETHZ":
-        (_train, _dev, _test) = __select_database_and_size_ETHZ__(
-                                                    dataset_size.lower(),
-                                                    filtering=True,
-                                                    RANDOM_SEED=RANDOM_SEED)
-
+        (select_fn, open_name) = (__select_database_and_size_ETHZ__, "ETHZ")
     elif dataset_name.upper() == "INSTANCE":
-        (_train, _dev, _test) = __select_database_and_size_INSTANCE__(
-                                                    dataset_size.lower(),
-                                                    filtering=True,
-                                                    RANDOM_SEED=RANDOM_SEED)
-
+        (select_fn, open_name) = (__select_database_and_size_INSTANCE__, "INSTANCE")
     elif dataset_name.upper() == "SCEDC":
-        (_train, _dev, _test) = __select_database_and_size_INSTANCE__(
-                                                    dataset_size.lower(),
-                                                    filtering=True,
-                                                    RANDOM_SEED=RANDOM_SEED)
+        (select_fn, open_name) = (__select_database_and_size_INSTANCE__, "INSTANCE")
     elif dataset_name.upper() == "PNW":
-        (_train, _dev, _test) = __select_database_and_size_PNW__(
-                                                    dataset_size.lower(),
-                                                    filtering=True,
-                                                    RANDOM_SEED=RANDOM_SEED)
+        (select_fn, open_name) = (__select_database_and_size_PNW__, "PNW")
     elif dataset_name.upper() == "AQUILA":
-        (_train, _dev, _test) = __select_database_and_size_AQUILA__(
-                                                    dataset_size.lower(),
-                                                    filtering=True,
-                                                    RANDOM_SEED=RANDOM_SEED)
-
+        (select_fn, open_name) = (__select_database_and_size_AQUILA__, "AQUILA")
     else:
         raise ValueError("Not a valid DATASET NAME!")
 
+    dataset = __open_sb_dataset__(open_name)
+
+    manifest = None
+    if split_cache:
+        if split_cache is True:
+            split_cache = Path(sb.cache_root) / "dkpn_splits"
+        manifest = __split_manifest_path__(split_cache, dataset_name.upper(),
+                                           dataset_size, RANDOM_SEED,
+                                           select_fn, dataset)
+        if manifest.is_file():
+            print("Loading SPLITS from:  %s" % manifest)
+            return __apply_split_manifest__(dataset, manifest)
+
+    (_train, _dev, _test) = select_fn(dataset_size.lower(),
+                                      filtering=True,
+                                      RANDOM_SEED=RANDOM_SEED,
+                                      dataset_train=dataset)
+
+    if manifest:
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        _tmp = manifest.with_name(manifest.stem + "_tmp%d.npz" % os.getpid())
+        np.savez(str(_tmp),
+                 train=_train.metadata["dkpn_row"].values,
+                 train_index=_train.metadata.index.values,
+                 dev=_dev.metadata["dkpn_row"].values,
+                 dev_index=_dev.metadata.index.values,
+                 test=_test.metadata["dkpn_row"].values,
+                 test_index=_test.metadata.index.values)
+        os.replace(str(_tmp), str(manifest))
+        print("Storing SPLITS in:  %s" % manifest)
+
     return (_train, _dev, _test)
 
 
@@ -391,6 +491,660 @@ def early_stop_criteria(trainl, trainl_batch,
     #
     return (False, "null", 0)
 
+
+def seed_worker_stream(wid):
+    """ DataLoader `worker_init_fn`: every worker gets its own NumPy (and
+        `random`) stream, so that the `RandomWindow` offsets are not
+        replayed identically by all the workers.
+        Inside a worker `torch.initial_seed()` is BASE_SEED + WID, where
+        BASE_SEED is drawn at every epoch from the loader `generator`:
+        with a seeded one (see `loader_generator`) the streams are
+        distinct per worker and per epoch, and reproducible.
+    """
+    (_np_seed, _py_seed) = np.random.SeedSequence(
+                                    torch.initial_seed()).generate_state(2)
+    np.random.seed(_np_seed)
+    random.seed(int(_py_seed))
+
+
+def loader_generator(seed, *streams):
+    """ Seeded `torch.Generator` for a DataLoader (shuffling and workers'
+        base seed). Extra STREAMS integers (e.g. the rank) give
+        independent generators for the same SEED.
+    """
+    _seed = np.random.SeedSequence([seed, ] + list(streams)).generate_state(
+                                                    1, dtype=np.uint64)[0]
+    return torch.Generator().manual_seed(int(_seed))
+
+
+def loader_kwargs(num_workers=0, prefetch_factor=2,
+                  persistent_workers=False, pin_memory=False):
+    """ DataLoader keyword arguments of a loader configuration
+        (`prefetch_factor` and `persistent_workers` need workers) """
+    outdict = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        outdict["prefetch_factor"] = prefetch_factor
+        outdict["persistent_workers"] = persistent_workers
+    return outdict
+
+
+def __available_memory__():
+    """ Available physical memory in bytes (Linux), None if unknown """
+    try:
+        with open("/proc/meminfo", "r") as IN:
+            for line in IN:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def __worker_extra_rss__():
+    """ Estimated private memory (bytes) of a DataLoader worker: peak
+        resident set of the terminated child processes in excess of the
+        parent one (the forked pages are shared until written)
+    """
+    try:
+        import resource
+        return max(0, (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss -
+                       resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024)
+    except (ImportError, OSError):
+        return 0
+
+
+def probe_loader_config(dataset, batch_size, config, nbatches=20,
+                        worker_init_fn=None, random_seed=42):
+    """ Throughput of one DataLoader CONFIG (see `loader_kwargs`) over
+        the first NBATCHES batches of DATASET (after a warm-up batch,
+        which includes the workers' start-up).
+        Returns (samples/s, estimated memory in bytes): the in-flight
+        batches plus the private memory of every worker.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                        worker_init_fn=worker_init_fn,
+                        generator=loader_generator(random_seed),
+                        **loader_kwargs(**config))
+    _iter = iter(loader)
+    batch = next(_iter)
+    _batch_bytes = sum(vv.element_size() * vv.nelement()
+                       for vv in batch.values() if torch.is_tensor(vv))
+    _nsmp = 0
+    _t0 = time.perf_counter()
+    for _ in range(nbatches):
+        try:
+            batch = next(_iter)
+        except StopIteration:
+            break
+        _nsmp += batch["X"].shape[0]
+    _time = time.perf_counter() - _t0
+    del _iter, loader   # joins the workers
+
+    _inflight = max(1, config["num_workers"] * config["prefetch_factor"])
+    if config["pin_memory"]:
+        _inflight *= 2
+    _memory = (_inflight * _batch_bytes +
+               config["num_workers"] * __worker_extra_rss__())
+    return (_nsmp / max(_time, 1e-9), _memory)
+
+
+def autotune_loader_config(dataset, batch_size, workers=(2, 4, 8, 16, 24, 32),
+                           prefetch=(2, 4, 8), pin_memory=None,
+                           nbatches=20, memory_fraction=0.5,
+                           worker_init_fn=None, random_seed=42):
+    """ Pick the fastest DataLoader configuration for DATASET that fits
+        in MEMORY_FRACTION of the available memory, in two short probes:
+        first the number of WORKERS (capped at the CPU count), then the
+        PREFETCH factor and the memory pinning for the best one
+        (PIN_MEMORY None means 'try it if CUDA is available').
+        Workers are always kept alive across epochs.
+        Returns (configuration dict, list of (configuration, samples/s,
+        memory bytes) probes).
+    """
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    _budget = __available_memory__()
+    if _budget:
+        _budget *= memory_fraction
+    _max_workers = os.cpu_count() or 1
+
+    probes = []
+
+    def _probe_(cfg):
+        (_sps, _mem) = probe_loader_config(
+                            dataset, batch_size, cfg, nbatches=nbatches,
+                            worker_init_fn=worker_init_fn,
+                            random_seed=random_seed)
+        probes.append((cfg, _sps, _mem))
+        print("Loader probe:  workers %2d  prefetch %2d  pin %-5s  "
+              "%9.1f samples/s  %8.1f MB" % (
+                cfg["num_workers"], cfg["prefetch_factor"],
+                cfg["pin_memory"], _sps, _mem / 1024**2))
+        if _budget and _mem > _budget:
+            return -1.0
+        return _sps
+
+    def _best_(cands):
+        _scores = [_probe_(cc) for cc in cands]
+        if max(_scores) < 0:
+            return None
+        return cands[int(np.argmax(_scores))]
+
+    _base = {"prefetch_factor": 2, "persistent_workers": True,
+             "pin_memory": False}
+    best = _best_([dict(_base, num_workers=ww) for ww in
+                   sorted(set(min(ww, _max_workers) for ww in workers))])
+    if best is None:
+        # Nothing fits: smallest in-memory footprint
+        best = dict(_base, num_workers=0, persistent_workers=False)
+        return (best, probes)
+
+    _pins = (False, True) if pin_memory else (False, )
+    best = _best_([dict(best, prefetch_factor=pf, pin_memory=pm)
+                   for pf in prefetch for pm in _pins]) or best
+    return (best, probes)
+
+
+class MemmapWindows(Dataset):
+    """ Frozen copy of the augmented windows of a generator, stored as
+        '*.npy' memory maps in FOLDER (see `materialize_generator`).
+        Items are dicts with the 'X' and 'y' keys (plus 'teacher',
+        the teacher logits, if stored) like the SeisBench generators:
+        the keys written last, listed in 'WINDOWS_INFO.json'.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        if (self.folder / "WINDOWS_INFO.json").is_file():
+            with open(str(self.folder / "WINDOWS_INFO.json"), "r") as IN:
+                self.keys = json.load(IN)["keys"]
+        else:
+            self.keys = [kk for kk in ("X", "y", "teacher")
+                         if (self.folder / (kk + ".npy")).is_file()]
+        self.arrays = {kk: np.load(str(self.folder / (kk + ".npy")),
+                                   mmap_mode="r") for kk in self.keys}
+
+    def __len__(self):
+        return self.arrays["X"].shape[0]
+
+    def __getitem__(self, idx):
+        return {kk: np.asarray(self.arrays[kk][idx], dtype=np.float32)
+                for kk in self.keys}
+
+
+def materialize_generator(generator, folder, teacher=None,
+                          batch_size=128, num_workers=24, random_seed=42):
+    """ Run the augmentations of GENERATOR once and store the resulting
+        windows ('X', 'y') as memory-mapped arrays in FOLDER.
+        If a TEACHER model is given, its logits on the same windows are
+        stored as well ('teacher', float16), so that they are computed
+        only once and not at every epoch, otherwise the ones of a previous
+        call are deleted (never served with other windows).
+        Returns the `MemmapWindows` dataset.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for name in ("WINDOWS_INFO.json", "teacher.npy"):
+        if (folder / name).is_file():
+            os.remove(str(folder / name))
+    loader = DataLoader(generator, batch_size=batch_size,
+                        shuffle=False, num_workers=num_workers,
+                        worker_init_fn=seed_worker_stream,
+                        generator=loader_generator(random_seed))
+    arrays = {}
+    if teacher is not None:
+        _training = teacher.training
+        teacher.eval()
+
+    idx = 0
+    for batch in tqdm(loader):
+        nsmp = batch["X"].shape[0]
+        if not arrays:
+            arrays["X"] = np.lib.format.open_memmap(
+                                str(folder / "X.npy"), mode="w+",
+                                dtype=np.float32,
+                                shape=(len(generator), ) + tuple(batch["X"].shape[1:]))
+            arrays["y"] = np.lib.format.open_memmap(
+                                str(folder / "y.npy"), mode="w+",
+                                dtype=np.float32,
+                                shape=(len(generator), ) + tuple(batch["y"].shape[1:]))
+            if teacher is not None:
+                arrays["teacher"] = np.lib.format.open_memmap(
+                                str(folder / "teacher.npy"), mode="w+",
+                                dtype=np.float16,
+                                shape=(len(generator), ) + tuple(batch["y"].shape[1:]))
+        #
+        arrays["X"][idx:idx+nsmp] = batch["X"].numpy()
+        arrays["y"][idx:idx+nsmp] = batch["y"].numpy()
+        if teacher is not None:
+            with torch.no_grad():
+                _logits = teacher(batch["X"].to(teacher.device), logits=True)
+            arrays["teacher"][idx:idx+nsmp] = _logits.cpu().numpy()
+        idx += nsmp
+
+    for vv in arrays.values():
+        vv.flush()
+    _keys = list(arrays.keys())
+    del arrays
+    if teacher is not None:
+        teacher.train(_training)
+    with open(str(folder / "WINDOWS_INFO.json"), "w") as OUT:
+        json.dump({"keys": _keys, "samples": idx}, OUT, indent=4)
+    #
+    return MemmapWindows(folder)
+
+
+def print_train_metrics(batch_id, loss_val, current, size, name=None):
+    """ Default metrics sink of the training loops (NAME is given only
+        by the multi-model trainers) """
+    if name:
+        print(f"{name} loss: {loss_val:>7f}  [{current:>5d}/{size:>5d}]")
+    else:
+        print(f"loss: {loss_val:>7f}  [{current:>5d}/{size:>5d}]")
+
+
+class TimedDataset(Dataset):
+    """ Wrap a generator: every item gets the 'fetch_time' key, the
+        seconds spent (in the worker) to read and augment it """
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __len__(self):
+        return len(self.generator)
+
+    def __getitem__(self, idx):
+        _t0 = time.perf_counter()
+        item = dict(self.generator[idx])
+        item["fetch_time"] = time.perf_counter() - _t0
+        return item
+
+
+class TrainTimer(object):
+    """ Per-batch wall-clock breakdown of the training loops:
+        data wait (time blocked on the DataLoader), host-to-device copy,
+        forward, backward and optimizer step. On CUDA the device is
+        synchronized at every mark, so timings are exact but the
+        training is slightly slower: enable it for diagnosis.
+        Worker busy time comes from the 'fetch_time' of `TimedDataset`;
+        the worker utilization is busy time / (workers * epoch time).
+        If PROFILE_DIR is given, a `torch.profiler` trace of
+        PROFILE_STEPS batches (after PROFILE_WAIT + 1 warm-up ones) is
+        written there (TensorBoard / Chrome trace format).
+    """
+
+    PHASES = ("data_wait", "h2d", "forward", "backward", "step")
+
+    def __init__(self, device, num_workers=0, profile_dir=None,
+                 profile_wait=5, profile_steps=10):
+        self.device = torch.device(device)
+        self.sync = (self.device.type == "cuda")
+        self.num_workers = num_workers
+        self.records = []
+        self.epochs = []
+        self.epoch = 0
+        self.__batch__ = None
+        self.__last__ = None
+        self.profiler = None
+        self.profile_steps = 0
+        if profile_dir:
+            import torch.profiler as tprof
+            self.profile_steps = profile_wait + 1 + profile_steps
+            self.profiler = tprof.profile(
+                    schedule=tprof.schedule(wait=profile_wait, warmup=1,
+                                            active=profile_steps, repeat=1),
+                    on_trace_ready=tprof.tensorboard_trace_handler(
+                                                        str(profile_dir)),
+                    record_shapes=True)
+            self.profiler.start()
+        self.__profiled__ = 0
+
+    def __now__(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start_epoch(self):
+        self.epoch += 1
+        self.__epoch_t0__ = self.__last__ = self.__now__()
+        self.__epoch_first__ = len(self.records)
+
+    def tick(self, phase):
+        """ Close PHASE: the time since the previous mark is assigned to
+            it (phases never marked are merged into the next one) """
+        _now = self.__now__()
+        if self.__batch__ is None:
+            self.__batch__ = dict.fromkeys(self.PHASES, 0.0)
+        self.__batch__[phase] += _now - self.__last__
+        self.__last__ = _now
+
+    def end_batch(self, batch):
+        self.tick("step")
+        _rec = self.__batch__
+        _rec["epoch"] = self.epoch
+        _rec["batch"] = len(self.records) - self.__epoch_first__
+        _rec["samples"] = int(batch["X"].shape[0])
+        if "fetch_time" in batch:
+            _rec["worker_busy"] = float(batch["fetch_time"].sum())
+        else:
+            _rec["worker_busy"] = float("nan")
+        self.records.append(_rec)
+        self.__batch__ = None
+
+        if self.profiler is not None:
+            self.profiler.step()
+            self.__profiled__ += 1
+            if self.__profiled__ >= self.profile_steps:
+                self.profiler.stop()
+                self.profiler = None
+
+    def end_epoch(self):
+        _wall = self.__now__() - self.__epoch_t0__
+        _recs = self.records[self.__epoch_first__:]
+        outdict = {"epoch": self.epoch, "batches": len(_recs),
+                   "samples": sum(rr["samples"] for rr in _recs),
+                   "time": _wall}
+        outdict["samples_per_sec"] = outdict["samples"] / max(_wall, 1e-9)
+        for ph in self.PHASES:
+            _tot = sum(rr[ph] for rr in _recs)
+            outdict[ph + "_ms"] = 1000.0 * _tot / max(len(_recs), 1)
+            outdict[ph + "_fraction"] = _tot / max(_wall, 1e-9)
+        _busy = sum(rr["worker_busy"] for rr in _recs)
+        outdict["worker_utilization"] = (
+                _busy / (max(self.num_workers, 1) * max(_wall, 1e-9)))
+        self.epochs.append(outdict)
+        return outdict
+
+    def store(self, dir_path, name="TRAIN_TIMING"):
+        """ Write the per-batch records (NAME.csv) and the per-epoch
+            summary (NAME.json) in DIR_PATH """
+        dir_path = Path(dir_path)
+        _cols = ("epoch", "batch", "samples") + self.PHASES + ("worker_busy", )
+        with open(str(dir_path / (name + ".csv")), "w") as OUT:
+            OUT.write(", ".join(cc.upper() for cc in _cols)+os.linesep)
+            for rr in self.records:
+                OUT.write(("%d, %d, %d" + ", %.6f" * (len(_cols) - 3) +
+                           os.linesep) % tuple(rr[cc] for cc in _cols))
+        with open(str(dir_path / (name + ".json")), "w") as OUT:
+            json.dump({"device": str(self.device),
+                       "num_workers": self.num_workers,
+                       "epochs": self.epochs}, OUT, indent=4)
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+
+def run_train_epoch(loader, step_fn, optimizer, device,
+                    sync_every=5, metrics_sink=print_train_metrics,
+                    timer=None):
+    """ One training epoch over LOADER.
+        STEP_FN(batch) returns the (loss to optimize, loss to log) pair.
+        The logged losses are stored detached in a preallocated buffer on
+        DEVICE, so that no autograd graph outlives its batch and the host
+        waits for the device only every SYNC_EVERY batches (when the
+        METRICS_SINK is called) and once at the end of the epoch
+        (SYNC_EVERY=0 means never during the epoch).
+        An optional `TrainTimer` records the per-batch timings.
+        Returns (last batch loss, list of batch losses).
+    """
+    size = len(loader.dataset)
+    loss_buffer = torch.zeros(len(loader), device=device)
+    nbatches = 0
+    if timer:
+        timer.start_epoch()
+    for batch_id, batch in enumerate(loader):
+        if timer:
+            timer.tick("data_wait")
+        (loss, log_loss) = step_fn(batch)
+        if timer:
+            timer.tick("forward")
+
+        # Backpropagation
+        optimizer.zero_grad()
+        loss.backward()
+        if timer:
+            timer.tick("backward")
+        optimizer.step()
+        if timer:
+            timer.end_batch(batch)
+
+        loss_buffer[batch_id] = log_loss.detach()
+        nbatches = batch_id + 1
+
+        if sync_every and batch_id % sync_every == 0 and metrics_sink:
+            metrics_sink(batch_id, loss_buffer[batch_id].item(),
+                         batch_id * batch["X"].shape[0], size)
+
+    train_loss_batches = loss_buffer[:nbatches].tolist()
+    if timer:
+        timer.end_epoch()
+    return (train_loss_batches[-1], train_loss_batches)
+
+
+def __cpu_copy__(obj):
+    """ Recursive CPU copy of the tensors in (nested) dicts/lists """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {kk: __cpu_copy__(vv) for kk, vv in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(__cpu_copy__(vv) for vv in obj)
+    return copy.deepcopy(obj)
+
+
+def __numpy_rng_state__():
+    """ NumPy global RNG state with plain python types (no arrays),
+        so that `torch.load` does not need to unpickle numpy objects """
+    (_name, _keys, _pos, _has_gauss, _gauss) = np.random.get_state()
+    return (_name, _keys.tolist(), int(_pos), int(_has_gauss), float(_gauss))
+
+
+def __rng_states__(loaders=None):
+    """ Python, NumPy, torch (CPU and CUDA) RNG states of this process,
+        plus the `generator` states of the LOADERS ({name: DataLoader}) """
+    return {"rng_python": random.getstate(),
+            "rng_numpy": __numpy_rng_state__(),
+            "rng_torch": torch.get_rng_state(),
+            "rng_cuda": (torch.cuda.get_rng_state_all()
+                         if torch.cuda.is_available() else None),
+            "rng_loaders": {kk: ll.generator.get_state()
+                            for (kk, ll) in (loaders or {}).items()
+                            if ll is not None and ll.generator is not None}}
+
+
+def __set_rng_states__(state, loaders=None):
+    """ Restore the `__rng_states__` STATE """
+    random.setstate(state["rng_python"])
+    (_name, _keys, _pos, _has_gauss, _gauss) = state["rng_numpy"]
+    np.random.set_state((_name, np.array(_keys, dtype=np.uint32),
+                         _pos, _has_gauss, _gauss))
+    torch.set_rng_state(state["rng_torch"])
+    if state["rng_cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["rng_cuda"])
+    for (kk, ll) in (loaders or {}).items():
+        if (kk in state.get("rng_loaders", {}) and
+           ll is not None and ll.generator is not None):
+            ll.generator.set_state(state["rng_loaders"][kk])
+
+
+class CheckpointRing(object):
+    """ Keep the weights (`state_dict`) of the last SIZE epochs for the
+        early-stop rollback.
+        Without FOLDER the snapshots stay in memory as CPU tensors,
+        otherwise they are written to FOLDER by a background thread, and
+        the full training state (model, optimizer, loss history and RNG
+        states) can be stored at the end of every epoch to resume an
+        interrupted run (`save_state` / `load_state`).
+        If not WRITER (e.g. the non-master ranks of a distributed run),
+        FOLDER is only read to resume and the snapshots stay in memory.
+    """
+
+    def __init__(self, size, folder=None, writer=True):
+        self.size = size
+        self.folder = Path(folder) if folder else None
+        self.writer = writer
+        self.ring = collections.OrderedDict()  # epoch: state_dict or file
+        self.jobs = {}
+        self.stale = []  # files out of the ring, removed once unreferenced
+        self.executor = None
+        if self.folder and self.writer:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __weights_file__(self, epoch):
+        return self.folder / ("weights_epoch_%04d.pt" % epoch)
+
+    def __wait__(self, epoch):
+        if epoch in self.jobs:
+            self.jobs.pop(epoch).result()
+
+    def push(self, epoch, model):
+        """ Snapshot the MODEL weights at EPOCH """
+        self.push_state(epoch, model.state_dict())
+
+    def push_state(self, epoch, state):
+        """ Snapshot a `state_dict` at EPOCH """
+        state = __cpu_copy__(state)
+        if self.folder and self.writer:
+            _file = self.__weights_file__(epoch)
+            self.jobs[epoch] = self.executor.submit(torch.save, state,
+                                                    str(_file))
+            self.ring[epoch] = _file
+        else:
+            self.ring[epoch] = state
+        #
+        while len(self.ring) > self.size:
+            (_old_epoch, _old) = self.ring.popitem(last=False)
+            if isinstance(_old, Path) and self.writer:
+                self.__wait__(_old_epoch)
+                self.stale.append(_old)
+
+    def get(self, epoch):
+        """ Return the `state_dict` stored for EPOCH """
+        _state = self.ring[epoch]
+        if isinstance(_state, Path):
+            self.__wait__(epoch)
+            _state = torch.load(str(_state), map_location="cpu")
+        return _state
+
+    def restore(self, model, step_back):
+        """ Load into MODEL the weights of STEP_BACK epochs before
+            the last one pushed """
+        _epoch = list(self.ring.keys())[-step_back-1]
+        model.load_state_dict(self.get(_epoch))
+        return _epoch
+
+    def save_state(self, epoch, model, optimizer, history, loaders=None):
+        """ Store the full training state after the completed EPOCH
+            (the number of epochs done). HISTORY is the tuple of the
+            loss lists returned by the `train_me*` methods.
+            LOADERS ({name: DataLoader}) have their `generator` state
+            stored too: shuffling and workers' base seeds go on from there.
+        """
+        if not self.folder:
+            return
+        _rng = self.__get_rng__(loaders)
+        if not self.writer:
+            return
+        state = dict({"epoch": epoch,
+                      "model": __cpu_copy__(model.state_dict()),
+                      "optimizer": __cpu_copy__(optimizer.state_dict()),
+                      "history": copy.deepcopy(history),
+                      "ring": list(self.ring.keys())}, **_rng)
+
+        def _write_(state, path, stale):
+            torch.save(state, str(path) + ".tmp")
+            os.replace(str(path) + ".tmp", str(path))
+            for _old in stale:
+                _old.unlink(missing_ok=True)
+
+        # Same single worker of the weights: files are complete in order
+        self.__wait__("state")
+        (_stale, self.stale) = (self.stale, [])
+        self.jobs["state"] = self.executor.submit(
+                    _write_, state, self.folder / "training_state.pt", _stale)
+
+    def load_state(self, model, optimizer, loaders=None):
+        """ Restore MODEL, OPTIMIZER, ring and RNG states (also of the
+            LOADERS generators, see `save_state`) of an interrupted run.
+            Returns (completed epochs, history) or None if there is
+            nothing to resume.
+        """
+        if not self.folder:
+            raise ValueError("A checkpoint folder is needed to resume!")
+        _file = self.folder / "training_state.pt"
+        if not self.__resumable__(_file):
+            return None
+        state = torch.load(str(_file), map_location="cpu")
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        self.ring = collections.OrderedDict(
+                        (ee, self.__weights_file__(ee)) for ee in state["ring"])
+        self.__set_rng__(state, loaders)
+        return (state["epoch"], state["history"])
+
+    def __resumable__(self, state_file):
+        return state_file.is_file()
+
+    def __get_rng__(self, loaders):
+        return __rng_states__(loaders)
+
+    def __set_rng__(self, state, loaders):
+        __set_rng_states__(state, loaders)
+
+    def close(self):
+        """ Wait for the pending writes """
+        if self.executor:
+            for _key in list(self.jobs.keys()):
+                self.__wait__(_key)
+            self.executor.shutdown()
+            for _old in self.stale:
+                _old.unlink(missing_ok=True)
+            self.stale = []
+            self.executor = None
+
+
+class DistributedCheckpointRing(CheckpointRing):
+    """ `CheckpointRing` of a `torch.distributed` run: rank 0 writes
+        FOLDER, every rank resumes from it (shared filesystem) with its
+        own RNG states, gathered in 'rng_ranks' of the training state.
+        `save_state` and `load_state` must be called by all the ranks.
+    """
+
+    def __init__(self, size, folder=None):
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        super().__init__(size, folder=folder, writer=(self.rank == 0))
+
+    def __resumable__(self, state_file):
+        _found = [None] * self.world_size
+        dist.all_gather_object(_found, state_file.is_file())
+        if any(_found) and not all(_found):
+            raise RuntimeError(
+                    "The training state %s is visible on the ranks %s only: "
+                    "resuming needs a folder shared by all the ranks!" % (
+                        state_file, [rr for (rr, ff) in enumerate(_found) if ff]))
+        return all(_found)
+
+    def __get_rng__(self, loaders):
+        _states = [None] * self.world_size if self.writer else None
+        dist.gather_object(__rng_states__(loaders), _states, dst=0)
+        return {"rng_ranks": _states}
+
+    def __set_rng__(self, state, loaders):
+        _states = state.get("rng_ranks")
+        if _states is None or len(_states) != self.world_size:
+            raise ValueError("The training state has the RNG states of %s ranks, "
+                             "this run has %d!" % (
+                                len(_states) if _states else "no",
+                                self.world_size))
+        __set_rng_states__(_states[self.rank], loaders)
+
 # ==================================================================
 # ==================================================================
 # ==================================================================    
@@ -444,7 +1198,10 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
                 },
             batch_size=128,
             num_workers=24,
-            random_seed=42):
+            random_seed=42,
+            sync_every=5,
+            metrics_sink=print_train_metrics,
+            worker_seeding="stream"):
 
         """ Modulus to prepare and process the data """
         self.augmentations_par = augmentations_par
@@ -452,11 +1209,14 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
         self.dev_generator = sbg.GenericGenerator(dev_sb_data)
         self.test_generator = sbg.GenericGenerator(test_sb_data)
         self.random_seed = random_seed
+        self.worker_seeding = worker_seeding
+        self.sync_every = sync_every
+        self.metrics_sink = metrics_sink
+        self.timer = None
         self.train_loader, self.dev_loader, self.test_loader = None, None, None
 
         # ----------  0. Define query windows
         self.trainmod = dkpninstance
-        self.model_epochs_list = []
         self.augmentations_par["fp_stabilization"] = int(
                             self.trainmod.default_args["fp_stabilization"]*100.0)
 
@@ -469,18 +1229,94 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
         self.test_generator.add_augmentations(self.augmentations)
 
         # ---------  3. Create DATALOADER
-        self.train_loader = DataLoader(self.train_generator, batch_size=batch_size,
-                                       shuffle=True, num_workers=num_workers,
-                                       worker_init_fn=self.__worker_init_fn_seed__)
+        self.__build_loaders__(batch_size, {
+                                    "num_workers": num_workers,
+                                    "prefetch_factor": 2,
+                                    "persistent_workers": False,
+                                    "pin_memory": False})
+
+    def __build_loaders__(self, batch_size, config):
+        """ (Re)create TRAIN, DEV and TEST loaders with the CONFIG
+            loader configuration (see `loader_kwargs`) """
+        self.batch_size = batch_size
+        self.loader_config = dict(config)
+        self.train_loader = DataLoader(self.__train_dataset__(), batch_size=batch_size,
+                                       shuffle=True,
+                                       worker_init_fn=self.__worker_init_fn_seed__,
+                                       generator=loader_generator(self.random_seed),
+                                       **loader_kwargs(**config))
         self.dev_loader = DataLoader(self.dev_generator, batch_size=batch_size,
-                                     shuffle=True, num_workers=num_workers,
-                                     worker_init_fn=self.__worker_init_fn_seed__)
+                                     shuffle=True,
+                                     worker_init_fn=self.__worker_init_fn_seed__,
+                                     generator=loader_generator(self.random_seed),
+                                     **loader_kwargs(**config))
         self.test_loader = DataLoader(self.test_generator, batch_size=batch_size,
-                                      shuffle=False, num_workers=num_workers,
-                                      worker_init_fn=self.__worker_init_fn_seed__)
+                                      shuffle=False,
+                                      worker_init_fn=self.__worker_init_fn_seed__,
+                                      generator=loader_generator(self.random_seed),
+                                      **loader_kwargs(**config))
+
+    def __train_dataset__(self):
+        if self.timer:
+            return TimedDataset(self.train_generator)
+        return self.train_generator
+
+    def enable_timing(self, profile_dir=None, profile_wait=5,
+                      profile_steps=10):
+        """ Record the per-batch timings of the training loop (see
+            `TrainTimer`), optionally with a `torch.profiler` trace in
+            PROFILE_DIR. Use `store_timing` to write them out.
+        """
+        self.timer = TrainTimer(self.trainmod.device,
+                                num_workers=self.loader_config["num_workers"],
+                                profile_dir=profile_dir,
+                                profile_wait=profile_wait,
+                                profile_steps=profile_steps)
+        self.__build_loaders__(self.batch_size, self.loader_config)
+        return self.timer
+
+    def store_timing(self, dir_path):
+        """ Write TRAIN_TIMING.csv/.json in DIR_PATH (if timing enabled) """
+        if self.timer:
+            self.timer.close()
+            self.timer.store(dir_path)
+
+    def autotune_loaders(self, nbatches=20, memory_fraction=0.5, **kwargs):
+        """ Probe the TRAIN generator throughput over some DataLoader
+            configurations (workers, prefetch, memory pinning; see
+            `autotune_loader_config`), and recreate all the loaders with
+            the fastest one that fits in memory, with persistent workers.
+            Returns the chosen configuration.
+        """
+        (config, probes) = autotune_loader_config(
+                                self.train_generator, self.batch_size,
+                                nbatches=nbatches,
+                                memory_fraction=memory_fraction,
+                                worker_init_fn=self.__worker_init_fn_seed__,
+                                random_seed=self.random_seed, **kwargs)
+        print("Loader configuration:  %s" % config)
+        self.__build_loaders__(self.batch_size, config)
+        if self.timer:
+            self.timer.num_workers = config["num_workers"]
+        self.loader_probes = probes
+        return config
+
+    def store_loader_config(self, dir_path):
+        """ Write the loaders configuration (and the autotune probes, if
+            any) in DIR_PATH/LOADER_CONFIG.json """
+        outdict = dict(self.loader_config, batch_size=self.batch_size)
+        outdict["probes"] = [
+                dict(cfg, samples_per_sec=sps, memory_bytes=int(mem))
+                for (cfg, sps, mem) in getattr(self, "loader_probes", [])]
+        with open(str(Path(dir_path) / "LOADER_CONFIG.json"), "w") as OUT:
+            json.dump(outdict, OUT, indent=4)
 
     def __worker_init_fn_seed__(self, wid):
-        np.random.seed(self.random_seed)
+        if self.worker_seeding == "fixed":
+            # Old behavior: all the workers replay the same stream
+            np.random.seed(self.random_seed)
+        else:
+            seed_worker_stream(wid)
 
     def __worker_init_fn_full_seed__(self, wid):
         """ Just know, no chanche to modify RanomWindow seed number inside """
@@ -556,29 +1392,46 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
         h = h.mean()  # Mean over batch axis
         return -h
 
-    def __train_loop__(self, optimizer):
-        size = len(self.train_loader.dataset)
-        train_loss = 0
-        train_loss_batches = []
-        for batch_id, batch in enumerate(self.train_loader):
-            # Compute prediction and loss
-            pred = self.trainmod(batch["X"].to(
-                                        self.trainmod.device))
-            loss = self.__loss_fn__(pred, batch["y"].to(
-                                        self.trainmod.device))
-            train_loss_batches.append(loss.item())
-            train_loss += loss
-
-            # Backpropagation
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            if batch_id % 5 == 0:
-                loss_val, current = loss.item(), batch_id * batch["X"].shape[0]
-                print(f"loss: {loss_val:>7f}  [{current:>5d}/{size:>5d}]")
+    def __train_step__(self, batch):
+        (X, y) = (batch["X"].to(self.trainmod.device),
+                  batch["y"].to(self.trainmod.device))
+        if self.timer:
+            self.timer.tick("h2d")
+        # Compute prediction and loss
+        pred = self.trainmod(X)
+        loss = self.__loss_fn__(pred, y)
+        return (loss, loss)
 
-        return (loss.item(), train_loss_batches)
+    def __train_loop__(self, optimizer):
+        return run_train_epoch(self.train_loader, self.__train_step__,
+                               optimizer, self.trainmod.device,
+                               sync_every=self.sync_every,
+                               metrics_sink=self.metrics_sink,
+                               timer=self.timer)
+
+    def __checkpoint_ring__(self, size, folder):
+        return CheckpointRing(size, folder=folder)
+
+    def __resumed__(self, epochs):
+        """ Hook of the `train_me*` methods after a resume, with the
+            EPOCHS already done (per-epoch counters of the subclasses) """
+        pass
+
+    def freeze_dev(self, folder, batch_size=512):
+        """ Materialize the DEV split once (fixed windows, inputs and
+            labels memory-mapped in FOLDER) and evaluate it at every
+            epoch in large batches: the DEV loss costs only the inference
+            and it is not affected anymore by the random windowing.
+        """
+        print("Materializing DEV windows ... %s" % folder)
+        dev_data = materialize_generator(
+                        self.dev_generator, folder,
+                        batch_size=self.dev_loader.batch_size,
+                        num_workers=self.dev_loader.num_workers,
+                        random_seed=self.random_seed)
+        self.dev_loader = DataLoader(dev_data, batch_size=batch_size,
+                                     shuffle=False, num_workers=0)
+        return dev_data
 
     def __test_loop__(self):
 
@@ -608,9 +1461,14 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
                  # Train related
                  epochs=15,
                  optimizer_type="adam",
-                 learning_rate=1e-2):
+                 learning_rate=1e-2,
+                 checkpoint_folder=None,
+                 resume=False):
 
-        """ Daje """
+        """ Daje.
+            With a CHECKPOINT_FOLDER the training state is stored at every
+            epoch and, if RESUME, an interrupted run restarts from there.
+        """
 
         # Defining OPTIMIZER
         if optimizer_type.lower() in ("adam", "adm"):
@@ -624,7 +1482,19 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
         train_loss_epochs, train_loss_epochs_batches = [], []
         test_loss_epochs, test_loss_epochs_batches = [], []
 
-        for t in range(epochs):
+        ring = self.__checkpoint_ring__(0, checkpoint_folder)
+        start_epoch = 0
+        if resume:
+            _resumed = ring.load_state(self.trainmod, optim,
+                                       loaders={"train": self.train_loader,
+                                                "dev": self.dev_loader})
+            if _resumed:
+                (start_epoch, (train_loss_epochs, train_loss_epochs_batches,
+                               test_loss_epochs, test_loss_epochs_batches)) = _resumed
+                print("@@@ Resuming training after epoch  %d" % start_epoch)
+                self.__resumed__(start_epoch)
+
+        for t in range(start_epoch, epochs):
             print(f"Epoch {t+1}\n-------------------------------")
 
             (_train_loss, _train_loss_batches) = self.__train_loop__(
@@ -635,8 +1505,15 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
             (_test_loss, _test_loss_batches) = self.__test_loop__()
             test_loss_epochs.append(_test_loss)
             test_loss_epochs_batches.append(_test_loss_batches)
+
+            ring.save_state(t+1, self.trainmod, optim,
+                            (train_loss_epochs, train_loss_epochs_batches,
+                             test_loss_epochs, test_loss_epochs_batches),
+                            loaders={"train": self.train_loader,
+                                     "dev": self.dev_loader})
         #
-        self.__training_epochs__ = t+1
+        ring.close()
+        self.__training_epochs__ = epochs
         return (train_loss_epochs, train_loss_epochs_batches,
                 test_loss_epochs, test_loss_epochs_batches)
 
@@ -646,9 +1523,17 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
                 optimizer_type="adam",
                 learning_rate=1e-2,
                 patience=5,
-                delta=0.001):  # Threshold for minimum improvement
-
-        """ Daje """
+                delta=0.001,  # Threshold for minimum improvement
+                checkpoint_folder=None,
+                resume=False):
+
+        """ Daje.
+            The weights of the last PATIENCE+1 epochs are kept in a
+            `CheckpointRing` for the rollback: in memory (CPU), or in
+            CHECKPOINT_FOLDER together with the full training state.
+            If RESUME, an interrupted run restarts from the last epoch
+            stored in CHECKPOINT_FOLDER.
+        """
 
         # Defining OPTIMIZER
         if optimizer_type.lower() in ("adam", "adm"):
@@ -662,9 +1547,19 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
         train_loss_epochs, train_loss_epochs_batches = [], []
         test_loss_epochs, test_loss_epochs_batches = [], []
 
-        losses = []  # track losses for the last 'patience' epochs
-
-        for t in range(epochs):
+        ring = self.__checkpoint_ring__(patience + 1, checkpoint_folder)
+        start_epoch = 0
+        if resume:
+            _resumed = ring.load_state(self.trainmod, optim,
+                                       loaders={"train": self.train_loader,
+                                                "dev": self.dev_loader})
+            if _resumed:
+                (start_epoch, (train_loss_epochs, train_loss_epochs_batches,
+                               test_loss_epochs, test_loss_epochs_batches)) = _resumed
+                print("@@@ Resuming training after epoch  %d" % start_epoch)
+                self.__resumed__(start_epoch)
+
+        for t in range(start_epoch, epochs):
             print(f"Epoch {t+1}\n-------------------------------")
 
             (_train_loss, _train_loss_batches) = self.__train_loop__(
@@ -676,12 +1571,8 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
             test_loss_epochs.append(_test_loss)
             test_loss_epochs_batches.append(_test_loss_batches)
 
-            losses.append(_test_loss)
-
-            # Store model for HISTORY porpuses
-            self.model_epochs_list.append(
-                copy.deepcopy(
-                    self.trainmod))
+            # Store weights for HISTORY porpuses
+            ring.push(t, self.trainmod)
 
             # If we have more than '2*patience' epochs done,
             # we can start checking for early stopping
@@ -695,23 +1586,24 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
                 if _answer:
                     # Early stop triggered..pack everything
                     self.__training_epochs__ = (t+1) - _step_back
-                    self.trainmod = copy.deepcopy(
-                                        self.model_epochs_list[-_step_back-1])
-                    del self.model_epochs_list
+                    ring.restore(self.trainmod, _step_back)
+                    ring.close()
                     return (train_loss_epochs[:-_step_back],
                             train_loss_epochs_batches[:-_step_back],
                             test_loss_epochs[:-_step_back],
                             test_loss_epochs_batches[:-_step_back])
 
-                else:
-                    # Free unnecessary memory
-                    if len(self.model_epochs_list) > patience:
-                        del self.model_epochs_list[:-patience-1]
+            ring.save_state(t+1, self.trainmod, optim,
+                            (train_loss_epochs, train_loss_epochs_batches,
+                             test_loss_epochs, test_loss_epochs_batches),
+                            loaders={"train": self.train_loader,
+                                     "dev": self.dev_loader})
 
         # If here, we reached the maximum epochs provided by the user,
         # Return everything in full
         print("@@@ Reached the FULL  %d  epochs!" % epochs)
-        self.__training_epochs__ = t+1
+        ring.close()
+        self.__training_epochs__ = epochs
         return (train_loss_epochs, train_loss_epochs_batches,
                 test_loss_epochs, test_loss_epochs_batches)
 
@@ -729,7 +1621,11 @@ class TrainHelp_DomainKnowledgePhaseNet(object):
                 OUT.write(("    \"docstring\": \"%s\","+os.linesep) % docs)
                 OUT.write("    \"model_args\": {"+os.linesep)
                 OUT.write("        \"component_order\": \"ZNE\","+os.linesep)
-                OUT.write("        \"phases\": \"PSN\""+os.linesep)
+                OUT.write("        \"phases\": \"PSN\","+os.linesep)
+                OUT.write(("        \"depth\": %d,"+os.linesep) % self.trainmod.depth)
+                OUT.write(("        \"kernel_size\": %d,"+os.linesep) % self.trainmod.kernel_size)
+                OUT.write(("        \"stride\": %d,"+os.linesep) % self.trainmod.stride)
+                OUT.write(("        \"filters_root\": %d"+os.linesep) % self.trainmod.filters_root)
                 OUT.write("    },"+os.linesep)
                 OUT.write("    \"seisbench_requirement\": \"0.3.0\","+os.linesep)
                 OUT.write(("    \"version\": \"%s\","+os.linesep) % version)
@@ -821,7 +1717,10 @@ class TrainHelp_PhaseNet(object):
                 },
             batch_size=128,
             num_workers=24,
-            random_seed=42):
+            random_seed=42,
+            sync_every=5,
+            metrics_sink=print_train_metrics,
+            worker_seeding="stream"):
 
         """ Modulus to prepare and process the data """
         self.augmentations_par = augmentations_par
@@ -829,12 +1728,15 @@ class TrainHelp_PhaseNet(object):
         self.dev_generator = sbg.GenericGenerator(dev_sb_data)
         self.test_generator = sbg.GenericGenerator(test_sb_data)
         self.random_seed = random_seed
+        self.worker_seeding = worker_seeding
+        self.sync_every = sync_every
+        self.metrics_sink = metrics_sink
+        self.timer = None
         self.train_loader, self.dev_loader, self.test_loader = None, None, None
         self.__training_epochs__ = None
 
         # ----------  0. Define query windows
         self.trainmod = pninstance
-        self.model_epochs_list = []
 
         # ---------  1. Define augmentations
         self.augmentations = self.__define_augmentations__(**self.augmentations_par)
@@ -845,21 +1747,97 @@ class TrainHelp_PhaseNet(object):
         self.test_generator.add_augmentations(self.augmentations)
 
         # ---------  3. Create DATALOADER
-        self.train_loader = DataLoader(self.train_generator, batch_size=batch_size,
-                                       shuffle=True, num_workers=num_workers,
-                                       worker_init_fn=self.__worker_init_fn_seed__)
+        self.__build_loaders__(batch_size, {
+                                    "num_workers": num_workers,
+                                    "prefetch_factor": 2,
+                                    "persistent_workers": False,
+                                    "pin_memory": False})
+
+    def __build_loaders__(self, batch_size, config):
+        """ (Re)create TRAIN, DEV and TEST loaders with the CONFIG
+            loader configuration (see `loader_kwargs`) """
+        self.batch_size = batch_size
+        self.loader_config = dict(config)
+        self.train_loader = DataLoader(self.__train_dataset__(), batch_size=batch_size,
+                                       shuffle=True,
+                                       worker_init_fn=self.__worker_init_fn_seed__,
+                                       generator=loader_generator(self.random_seed),
+                                       **loader_kwargs(**config))
         self.dev_loader = DataLoader(self.dev_generator, batch_size=batch_size,
-                                     shuffle=True, num_workers=num_workers,
-                                     worker_init_fn=self.__worker_init_fn_seed__)
+                                     shuffle=True,
+                                     worker_init_fn=self.__worker_init_fn_seed__,
+                                     generator=loader_generator(self.random_seed),
+                                     **loader_kwargs(**config))
         self.test_loader = DataLoader(self.test_generator, batch_size=batch_size,
-                                      shuffle=False, num_workers=num_workers,
-                                      worker_init_fn=self.__worker_init_fn_seed__)
+                                      shuffle=False,
+                                      worker_init_fn=self.__worker_init_fn_seed__,
+                                      generator=loader_generator(self.random_seed),
+                                      **loader_kwargs(**config))
+
+    def __train_dataset__(self):
+        if self.timer:
+            return TimedDataset(self.train_generator)
+        return self.train_generator
+
+    def enable_timing(self, profile_dir=None, profile_wait=5,
+                      profile_steps=10):
+        """ Record the per-batch timings of the training loop (see
+            `TrainTimer`), optionally with a `torch.profiler` trace in
+            PROFILE_DIR. Use `store_timing` to write them out.
+        """
+        self.timer = TrainTimer(self.trainmod.device,
+                                num_workers=self.loader_config["num_workers"],
+                                profile_dir=profile_dir,
+                                profile_wait=profile_wait,
+                                profile_steps=profile_steps)
+        self.__build_loaders__(self.batch_size, self.loader_config)
+        return self.timer
+
+    def store_timing(self, dir_path):
+        """ Write TRAIN_TIMING.csv/.json in DIR_PATH (if timing enabled) """
+        if self.timer:
+            self.timer.close()
+            self.timer.store(dir_path)
+
+    def autotune_loaders(self, nbatches=20, memory_fraction=0.5, **kwargs):
+        """ Probe the TRAIN generator throughput over some DataLoader
+            configurations (workers, prefetch, memory pinning; see
+            `autotune_loader_config`), and recreate all the loaders with
+            the fastest one that fits in memory, with persistent workers.
+            Returns the chosen configuration.
+        """
+        (config, probes) = autotune_loader_config(
+                                self.train_generator, self.batch_size,
+                                nbatches=nbatches,
+                                memory_fraction=memory_fraction,
+                                worker_init_fn=self.__worker_init_fn_seed__,
+                                random_seed=self.random_seed, **kwargs)
+        print("Loader configuration:  %s" % config)
+        self.__build_loaders__(self.batch_size, config)
+        if self.timer:
+            self.timer.num_workers = config["num_workers"]
+        self.loader_probes = probes
+        return config
+
+    def store_loader_config(self, dir_path):
+        """ Write the loaders configuration (and the autotune probes, if
+            any) in DIR_PATH/LOADER_CONFIG.json """
+        outdict = dict(self.loader_config, batch_size=self.batch_size)
+        outdict["probes"] = [
+                dict(cfg, samples_per_sec=sps, memory_bytes=int(mem))
+                for (cfg, sps, mem) in getattr(self, "loader_probes", [])]
+        with open(str(Path(dir_path) / "LOADER_CONFIG.json"), "w") as OUT:
+            json.dump(outdict, OUT, indent=4)
 
     def set_random_seed(self, rndseed):
         self.random_seed = rndseed
 
     def __worker_init_fn_seed__(self, wid):
-        np.random.seed(self.random_seed)
+        if self.worker_seeding == "fixed":
+            # Old behavior: all the workers replay the same stream
+            np.random.seed(self.random_seed)
+        else:
+            seed_worker_stream(wid)
 
     def __worker_init_fn_full_seed__(self, wid):
         """ Just know, no chanche to modify RanomWindow seed number inside """
@@ -937,29 +1915,38 @@ class TrainHelp_PhaseNet(object):
         h = h.mean()  # Mean over batch axis
         return -h
 
-    def __train_loop__(self, optimizer):
-        size = len(self.train_loader.dataset)
-        train_loss = 0
-        train_loss_batches = []
-        for batch_id, batch in enumerate(self.train_loader):
-            # Compute prediction and loss
-            pred = self.trainmod(batch["X"].to(
-                                        self.trainmod.device))
-            loss = self.__loss_fn__(pred, batch["y"].to(
-                                        self.trainmod.device))
-            train_loss_batches.append(loss.item())
-            train_loss += loss
-
-            # Backpropagation
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            if batch_id % 5 == 0:
-                loss_val, current = loss.item(), batch_id * batch["X"].shape[0]
-                print(f"loss: {loss_val:>7f}  [{current:>5d}/{size:>5d}]")
+    def __train_step__(self, batch):
+        (X, y) = (batch["X"].to(self.trainmod.device),
+                  batch["y"].to(self.trainmod.device))
+        if self.timer:
+            self.timer.tick("h2d")
+        # Compute prediction and loss
+        pred = self.trainmod(X)
+        loss = self.__loss_fn__(pred, y)
+        return (loss, loss)
 
-        return (loss.item(), train_loss_batches)
+    def __train_loop__(self, optimizer):
+        return run_train_epoch(self.train_loader, self.__train_step__,
+                               optimizer, self.trainmod.device,
+                               sync_every=self.sync_every,
+                               metrics_sink=self.metrics_sink,
+                               timer=self.timer)
+
+    def freeze_dev(self, folder, batch_size=512):
+        """ Materialize the DEV split once (fixed windows, inputs and
+            labels memory-mapped in FOLDER) and evaluate it at every
+            epoch in large batches: the DEV loss costs only the inference
+            and it is not affected anymore by the random windowing.
+        """
+        print("Materializing DEV windows ... %s" % folder)
+        dev_data = materialize_generator(
+                        self.dev_generator, folder,
+                        batch_size=self.dev_loader.batch_size,
+                        num_workers=self.dev_loader.num_workers,
+                        random_seed=self.random_seed)
+        self.dev_loader = DataLoader(dev_data, batch_size=batch_size,
+                                     shuffle=False, num_workers=0)
+        return dev_data
 
     def __test_loop__(self):
 
@@ -989,9 +1976,14 @@ class TrainHelp_PhaseNet(object):
                  # Train related
                  epochs=15,
                  optimizer_type="adam",
-                 learning_rate=1e-2):
+                 learning_rate=1e-2,
+                 checkpoint_folder=None,
+                 resume=False):
 
-        """ Daje """
+        """ Daje.
+            With a CHECKPOINT_FOLDER the training state is stored at every
+            epoch and, if RESUME, an interrupted run restarts from there.
+        """
 
         # Defining OPTIMIZER
         if optimizer_type.lower() in ("adam", "adm"):
@@ -1005,7 +1997,18 @@ class TrainHelp_PhaseNet(object):
         train_loss_epochs, train_loss_epochs_batches = [], []
         test_loss_epochs, test_loss_epochs_batches = [], []
 
-        for t in range(epochs):
+        ring = CheckpointRing(0, folder=checkpoint_folder)
+        start_epoch = 0
+        if resume:
+            _resumed = ring.load_state(self.trainmod, optim,
+                                       loaders={"train": self.train_loader,
+                                                "dev": self.dev_loader})
+            if _resumed:
+                (start_epoch, (train_loss_epochs, train_loss_epochs_batches,
+                               test_loss_epochs, test_loss_epochs_batches)) = _resumed
+                print("@@@ Resuming training after epoch  %d" % start_epoch)
+
+        for t in range(start_epoch, epochs):
             print(f"Epoch {t+1}\n-------------------------------")
 
             (_train_loss, _train_loss_batches) = self.__train_loop__(
@@ -1016,8 +2019,15 @@ class TrainHelp_PhaseNet(object):
             (_test_loss, _test_loss_batches) = self.__test_loop__()
             test_loss_epochs.append(_test_loss)
             test_loss_epochs_batches.append(_test_loss_batches)
+
+            ring.save_state(t+1, self.trainmod, optim,
+                            (train_loss_epochs, train_loss_epochs_batches,
+                             test_loss_epochs, test_loss_epochs_batches),
+                            loaders={"train": self.train_loader,
+                                     "dev": self.dev_loader})
         #
-        self.__training_epochs__ = t+1
+        ring.close()
+        self.__training_epochs__ = epochs
         return (train_loss_epochs, train_loss_epochs_batches,
                 test_loss_epochs, test_loss_epochs_batches)
 
@@ -1027,9 +2037,17 @@ class TrainHelp_PhaseNet(object):
                 optimizer_type="adam",
                 learning_rate=1e-2,
                 patience=5,
-                delta=0.001):  # Threshold for minimum improvement
-
-        """ Daje """
+                delta=0.001,  # Threshold for minimum improvement
+                checkpoint_folder=None,
+                resume=False):
+
+        """ Daje.
+            The weights of the last PATIENCE+1 epochs are kept in a
+            `CheckpointRing` for the rollback: in memory (CPU), or in
+            CHECKPOINT_FOLDER together with the full training state.
+            If RESUME, an interrupted run restarts from the last epoch
+            stored in CHECKPOINT_FOLDER.
+        """
 
         # Defining OPTIMIZER
         if optimizer_type.lower() in ("adam", "adm"):
@@ -1043,9 +2061,18 @@ class TrainHelp_PhaseNet(object):
         train_loss_epochs, train_loss_epochs_batches = [], []
         test_loss_epochs, test_loss_epochs_batches = [], []
 
-        losses = []  # track losses for the last 'patience' epochs
-
-        for t in range(epochs):
+        ring = CheckpointRing(patience + 1, folder=checkpoint_folder)
+        start_epoch = 0
+        if resume:
+            _resumed = ring.load_state(self.trainmod, optim,
+                                       loaders={"train": self.train_loader,
+                                                "dev": self.dev_loader})
+            if _resumed:
+                (start_epoch, (train_loss_epochs, train_loss_epochs_batches,
+                               test_loss_epochs, test_loss_epochs_batches)) = _resumed
+                print("@@@ Resuming training after epoch  %d" % start_epoch)
+
+        for t in range(start_epoch, epochs):
             print(f"Epoch {t+1}\n-------------------------------")
 
             (_train_loss, _train_loss_batches) = self.__train_loop__(
@@ -1057,12 +2084,8 @@ class TrainHelp_PhaseNet(object):
             test_loss_epochs.append(_test_loss)
             test_loss_epochs_batches.append(_test_loss_batches)
 
-            losses.append(_test_loss)
-
-            # Store model for HISTORY porpuses
-            self.model_epochs_list.append(
-                copy.deepcopy(
-                    self.trainmod))
+            # Store weights for HISTORY porpuses
+            ring.push(t, self.trainmod)
 
             # If we have more than '2*patience' epochs done,
             # we can start checking for early stopping
@@ -1076,23 +2099,24 @@ class TrainHelp_PhaseNet(object):
                 if _answer:
                     # Early stop triggered..pack everything
                     self.__training_epochs__ = (t+1) - _step_back
-                    self.trainmod = copy.deepcopy(
-                                        self.model_epochs_list[-_step_back-1])
-                    del self.model_epochs_list
+                    ring.restore(self.trainmod, _step_back)
+                    ring.close()
                     return (train_loss_epochs[:-_step_back],
                             train_loss_epochs_batches[:-_step_back],
                             test_loss_epochs[:-_step_back],
                             test_loss_epochs_batches[:-_step_back])
 
-                else:
-                    # Free unnecessary memory
-                    if len(self.model_epochs_list) > patience:
-                        del self.model_epochs_list[:-patience-1]
+            ring.save_state(t+1, self.trainmod, optim,
+                            (train_loss_epochs, train_loss_epochs_batches,
+                             test_loss_epochs, test_loss_epochs_batches),
+                            loaders={"train": self.train_loader,
+                                     "dev": self.dev_loader})
 
         # If here, we reached the maximum epochs provided by the user,
         # Return everything in full
         print("@@@ Reached the FULL  %d  epochs!" % epochs)
-        self.__training_epochs__ = t+1
+        ring.close()
+        self.__training_epochs__ = epochs
         return (train_loss_epochs, train_loss_epochs_batches,
                 test_loss_epochs, test_loss_epochs_batches)
 
@@ -1137,3 +2161,633 @@ class TrainHelp_PhaseNet(object):
 
     def get_loader(self):
         return (self.train_loader, self.dev_loader, self.test_loader)
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+
+class TrainHelp_DistillDKPN(TrainHelp_DomainKnowledgePhaseNet):
+    """ Knowledge distillation of a pretrained DKPN TEACHER into a
+        (narrower) DKPN STUDENT, trained on the same CF inputs.
+        The student loss is a mix of the usual cross-entropy against the
+        probabilistic labels and of the temperature-scaled cross-entropy
+        against the teacher soft targets:
+
+            loss = ALPHA * T^2 * CE(teacher/T, student/T) + (1-ALPHA) * CE(labels, student)
+
+        If CACHE_FOLDER is given, the training windows and the teacher
+        logits are materialized once on disk (`materialize_generator`)
+        and re-drawn every REFRESH_EVERY epochs (0 = never); otherwise
+        the teacher runs on every training batch.
+        The DEV loss and the stored training losses are the plain label
+        cross-entropy, so they compare with `TrainHelp_DomainKnowledgePhaseNet`
+        runs and with the early-stop criteria.
+    """
+
+    def __init__(self, dkpninstance,
+                 train_sb_data, dev_sb_data, test_sb_data,
+                 teacher=None, alpha=0.5, temperature=2.0,
+                 cache_folder=None, refresh_every=0,
+                 **kwargs):
+        if teacher is None:
+            raise ValueError("A pretrained DKPN teacher is needed!")
+        if teacher.get_defaults() != dkpninstance.get_defaults():
+            raise ValueError("Teacher and student must share the CFs parameters!")
+        if teacher.in_samples != dkpninstance.in_samples:
+            raise ValueError("Teacher and student must share the input length!")
+
+        super().__init__(dkpninstance, train_sb_data, dev_sb_data,
+                         test_sb_data, **kwargs)
+        self.teacher = teacher.to(self.trainmod.device)
+        self.teacher.eval()
+        for pp in self.teacher.parameters():
+            pp.requires_grad = False
+
+        self.alpha = alpha
+        self.temperature = temperature
+        self.cache_folder = cache_folder
+        self.refresh_every = refresh_every
+        self.cache_loader = None
+        self.__distill_epoch__ = 0
+
+    def __distill_loss_fn__(self, y_logits, t_logits, eps=1e-5):
+        # vector cross entropy loss against the tempered teacher probs
+        T = self.temperature
+        h = F.softmax(t_logits / T, dim=1) * F.log_softmax(y_logits / T, dim=1)
+        h = h.mean(-1).sum(-1)
+        h = h.mean()
+        return -h * T * T
+
+    def __resumed__(self, epochs):
+        # Same refresh cadence and cached windows as without break
+        self.__distill_epoch__ = epochs
+
+    def __refresh_cache__(self):
+        print("Materializing TRAIN windows and TEACHER logits ... %s" %
+              self.cache_folder)
+        # Seeded by the epoch of the last refresh (also after a resume)
+        _epoch = (self.__distill_epoch__ -
+                  self.__distill_epoch__ % self.refresh_every
+                  if self.refresh_every else 0)
+        _cache = materialize_generator(
+                        self.train_generator, self.cache_folder,
+                        teacher=self.teacher,
+                        batch_size=self.train_loader.batch_size,
+                        num_workers=self.train_loader.num_workers,
+                        random_seed=self.random_seed + _epoch)
+        self.cache_loader = DataLoader(_cache,
+                                       batch_size=self.train_loader.batch_size,
+                                       shuffle=True, num_workers=0)
+
+    def __distill_step__(self, batch):
+        X = batch["X"].to(self.trainmod.device)
+        if "teacher" in batch:
+            t_logits = batch["teacher"].to(self.trainmod.device)
+        else:
+            with torch.no_grad():
+                t_logits = self.teacher(X, logits=True)
+
+        # Compute prediction and loss
+        y_logits = self.trainmod(X, logits=True)
+        hard_loss = self.__loss_fn__(
+                        F.softmax(y_logits, dim=1),
+                        batch["y"].to(self.trainmod.device))
+        soft_loss = self.__distill_loss_fn__(y_logits, t_logits)
+        loss = self.alpha * soft_loss + (1.0 - self.alpha) * hard_loss
+        return (loss, hard_loss)
+
+    def __train_loop__(self, optimizer):
+        if self.cache_folder:
+            if (self.cache_loader is None or (
+                    self.refresh_every and
+                    self.__distill_epoch__ % self.refresh_every == 0)):
+                self.__refresh_cache__()
+            loader = self.cache_loader
+        else:
+            loader = self.train_loader
+        self.__distill_epoch__ += 1
+
+        return run_train_epoch(loader, self.__distill_step__,
+                               optimizer, self.trainmod.device,
+                               sync_every=self.sync_every,
+                               metrics_sink=self.metrics_sink,
+                               timer=self.timer)
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+
+class TrainHelp_DKPN_PN(TrainHelp_DomainKnowledgePhaseNet):
+    """ Train a DKPN and a PhaseNet model on the SAME batches of a single
+        data pipeline (the DKPN one). DKPN gets the CFs 'X', PhaseNet the
+        raw window 'Xorig' (kept by the `sbg.Copy` augmentation) without
+        the 'fp_stabilization' samples and re-normalized, as in
+        `TrainHelp_PhaseNet`. Waveform reading and augmentations are
+        therefore paid once for the two models.
+        Each model keeps its own optimizer and early stopping; once a
+        model stops, only the other one is stepped.
+    """
+
+    def __init__(self, dkpninstance, pninstance,
+                 train_sb_data, dev_sb_data, test_sb_data,
+                 **kwargs):
+        super().__init__(dkpninstance, train_sb_data, dev_sb_data,
+                         test_sb_data, **kwargs)
+        self.pnmod = pninstance
+        self.fstab = self.augmentations_par["fp_stabilization"]
+        self.windowlength = self.augmentations_par["final_windowlength"]
+        self.__training_epochs__ = {}
+
+    def __pn_input__(self, Xorig):
+        x = Xorig[:, :, self.fstab:(self.fstab + self.windowlength)]
+        x = x - x.mean(dim=-1, keepdim=True)
+        x = x / (x.std(dim=-1, keepdim=True, unbiased=False) + 1e-10)
+        return x
+
+    def __joint_forward__(self, name, batch):
+        if name == "DKPN":
+            return self.trainmod(batch["X"].to(self.trainmod.device))
+        else:
+            return self.pnmod(self.__pn_input__(batch["Xorig"]).to(
+                                                        self.pnmod.device))
+
+    def get_models(self):
+        return {"DKPN": self.trainmod, "PN": self.pnmod}
+
+    def __joint_train_loop__(self, optimizers):
+        """ OPTIMIZERS is a {name: optimizer} dict of the models to step """
+        names = list(optimizers.keys())
+        size = len(self.train_loader.dataset)
+        loss_buffer = torch.zeros((len(self.train_loader), len(names)),
+                                  device=self.trainmod.device)
+        nbatches = 0
+        for batch_id, batch in enumerate(self.train_loader):
+            losses = [self.__loss_fn__(
+                            self.__joint_forward__(nn, batch),
+                            batch["y"].to(self.get_models()[nn].device))
+                      for nn in names]
+
+            # Backpropagation (disjoint graphs: one backward for all)
+            for nn in names:
+                optimizers[nn].zero_grad()
+            torch.stack([ll.to(loss_buffer.device) for ll in losses]).sum().backward()
+            for nn in names:
+                optimizers[nn].step()
+
+            for xx, ll in enumerate(losses):
+                loss_buffer[batch_id, xx] = ll.detach()
+            nbatches = batch_id + 1
+
+            if (self.sync_every and batch_id % self.sync_every == 0 and
+               self.metrics_sink):
+                for xx, nn in enumerate(names):
+                    self.metrics_sink(batch_id, loss_buffer[batch_id, xx].item(),
+                                      batch_id * batch["X"].shape[0], size,
+                                      name=nn)
+
+        outdict = {}
+        for xx, nn in enumerate(names):
+            _batches = loss_buffer[:nbatches, xx].tolist()
+            outdict[nn] = (_batches[-1], _batches)
+        return outdict
+
+    def __joint_test_loop__(self, names):
+        models = self.get_models()
+        test_loss_batches = {nn: [] for nn in names}
+        for nn in names:
+            models[nn].eval()
+
+        with torch.no_grad():
+            for batch in self.dev_loader:
+                for nn in names:
+                    pred = self.__joint_forward__(nn, batch)
+                    test_loss_batches[nn].append(self.__loss_fn__(
+                            pred, batch["y"].to(models[nn].device)).item())
+
+        outdict = {}
+        for nn in names:
+            models[nn].train()
+            _test_loss = np.mean(test_loss_batches[nn])
+            print(f"{nn} Dev. avg loss: {_test_loss:>8f}")
+            outdict[nn] = (_test_loss, test_loss_batches[nn])
+        print("")
+        return outdict
+
+    def train_me_joint(
+                self,
+                epochs=15,
+                optimizer_type="adam",
+                learning_rate=1e-2,
+                early_stop=False,
+                patience=5,
+                delta=0.001,
+                checkpoint_folder=None):
+
+        """ Train both models; with EARLY_STOP each one follows
+            `early_stop_criteria` and its own `CheckpointRing` rollback
+            (in CHECKPOINT_FOLDER/<name> if given, otherwise in memory).
+            Returns {name: (train_loss_epochs, train_loss_epochs_batches,
+                            dev_loss_epochs, dev_loss_epochs_batches)}
+            and sets `__training_epochs__` to a {name: epochs} dict.
+        """
+        models = self.get_models()
+
+        # Defining OPTIMIZERS
+        if optimizer_type.lower() in ("adam", "adm"):
+            optims = {nn: torch.optim.Adam(mm.parameters(), lr=learning_rate)
+                      for nn, mm in models.items()}
+        else:
+            raise ValueError("At the moment only the 'Adam' optimizer "
+                             "is supported!")
+
+        # ------------------------ GO
+        history = {nn: ([], [], [], []) for nn in models.keys()}
+        rings = {nn: CheckpointRing(
+                        patience + 1,
+                        folder=(Path(checkpoint_folder) / nn
+                                if checkpoint_folder else None))
+                 for nn in models.keys()}
+        active = list(models.keys())
+
+        for t in range(epochs):
+            print(f"Epoch {t+1}  {' '.join(active)}\n-------------------------------")
+
+            _train = self.__joint_train_loop__({nn: optims[nn] for nn in active})
+            _test = self.__joint_test_loop__(active)
+
+            for nn in list(active):
+                (trainl, trainl_batch, devl, devl_batch) = history[nn]
+                trainl.append(_train[nn][0])
+                trainl_batch.append(_train[nn][1])
+                devl.append(_test[nn][0])
+                devl_batch.append(_test[nn][1])
+
+                if not early_stop:
+                    continue
+
+                # Store weights for HISTORY porpuses
+                rings[nn].push(t, models[nn])
+
+                if t >= 2 * patience:
+                    print("%s  " % nn, end="")
+                    (_answer, _, _step_back) = early_stop_criteria(
+                                    trainl, trainl_batch, devl, devl_batch,
+                                    patience, delta)
+                    if _answer:
+                        # Early stop triggered..pack everything
+                        self.__training_epochs__[nn] = (t+1) - _step_back
+                        rings[nn].restore(models[nn], _step_back)
+                        rings[nn].close()
+                        history[nn] = tuple(hh[:-_step_back] for hh in history[nn])
+                        active.remove(nn)
+
+            if not active:
+                break
+
+        # The models still active reached the maximum epochs
+        for nn in active:
+            print("@@@ %s reached the FULL  %d  epochs!" % (nn, epochs))
+            rings[nn].close()
+            self.__training_epochs__[nn] = epochs
+        #
+        return history
+
+    def store_weigths_pn(self, dir_path, model_name, jsonstring, version="1"):
+        """ Store the PhaseNet model as `TrainHelp_PhaseNet` does """
+        TrainHelp_PhaseNet.store_weigths(
+                types.SimpleNamespace(trainmod=self.pnmod),
+                dir_path, model_name, jsonstring, version=version)
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+
+class TrainHelp_MultiSeedDKPN(TrainHelp_DomainKnowledgePhaseNet):
+    """ Train N DKPN replicas (different initializations, e.g. one per
+        seed) in a single process, over the same batches and with a
+        single batched forward/backward pass (`StackedDKPN`).
+        Every replica keeps its own loss history, early stopping and
+        `store_weigths` output. Adam works element-wise, so one Adam over
+        the stacked tensors is the same as one independent Adam per
+        replica; a replica that early-stops is rolled back and then held
+        fixed (weights and BatchNorm statistics) while the others go on.
+        The data split/augmentations are the same for all the replicas.
+    """
+
+    def __init__(self, dkpn_list,
+                 train_sb_data, dev_sb_data, test_sb_data,
+                 **kwargs):
+        super().__init__(dkpn_list[0], train_sb_data, dev_sb_data,
+                         test_sb_data, **kwargs)
+        self.stacked = StackedDKPN(dkpn_list)
+        self.nrep = len(dkpn_list)
+        self.__training_epochs__ = [None] * self.nrep
+
+    def __stacked_loss_fn__(self, y_pred, y_true, eps=1e-5):
+        # vector cross entropy loss, one value per replica
+        h = y_true.unsqueeze(1) * torch.log(y_pred + eps)
+        h = h.mean(-1).sum(-1)  # Mean along sample dimension and sum along pick dimension
+        h = h.mean(0)  # Mean over batch axis
+        return -h
+
+    def __hold_frozen__(self, frozen):
+        for k, state in frozen.items():
+            self.stacked.set_replica_state(k, state)
+
+    def __stacked_train_loop__(self, optimizer, frozen):
+        size = len(self.train_loader.dataset)
+        loss_buffer = torch.zeros((len(self.train_loader), self.nrep),
+                                  device=self.stacked.device)
+        nbatches = 0
+        for batch_id, batch in enumerate(self.train_loader):
+            # Compute prediction and loss
+            pred = self.stacked(batch["X"].to(self.stacked.device))
+            losses = self.__stacked_loss_fn__(pred, batch["y"].to(
+                                                    self.stacked.device))
+
+            # Backpropagation (replicas are independent: one backward)
+            optimizer.zero_grad()
+            losses.sum().backward()
+            optimizer.step()
+            self.__hold_frozen__(frozen)
+
+            loss_buffer[batch_id] = losses.detach()
+            nbatches = batch_id + 1
+
+            if (self.sync_every and batch_id % self.sync_every == 0 and
+               self.metrics_sink):
+                _losses = loss_buffer[batch_id].tolist()
+                for k in range(self.nrep):
+                    if k not in frozen:
+                        self.metrics_sink(batch_id, _losses[k],
+                                          batch_id * batch["X"].shape[0], size,
+                                          name="REPLICA_%d" % k)
+
+        _batches = loss_buffer[:nbatches].t().tolist()
+        return [(bb[-1], bb) for bb in _batches]
+
+    def __stacked_test_loop__(self):
+        self.stacked.eval()
+        test_loss_batches = []
+        with torch.no_grad():
+            for batch in self.dev_loader:
+                pred = self.stacked(batch["X"].to(self.stacked.device))
+                test_loss_batches.append(self.__stacked_loss_fn__(
+                                pred, batch["y"].to(self.stacked.device)))
+        self.stacked.train()
+
+        test_loss_batches = torch.stack(test_loss_batches).t().tolist()
+        outlist = []
+        for k, bb in enumerate(test_loss_batches):
+            outlist.append((np.mean(bb), bb))
+        print("Dev. avg loss: " + "  ".join(
+                        "%8f" % tt for (tt, _) in outlist) + "\n")
+        return outlist
+
+    def train_me_replicas(
+                self,
+                epochs=15,
+                optimizer_type="adam",
+                learning_rate=1e-2,
+                early_stop=False,
+                patience=5,
+                delta=0.001,
+                checkpoint_folder=None):
+
+        """ Train all the replicas; with EARLY_STOP each one follows
+            `early_stop_criteria` and its own `CheckpointRing` rollback
+            (in CHECKPOINT_FOLDER/REPLICA_<k> if given, otherwise in memory).
+            Returns a list (one item per replica) of
+                (train_loss_epochs, train_loss_epochs_batches,
+                 dev_loss_epochs, dev_loss_epochs_batches)
+            and sets `__training_epochs__` to the list of epochs.
+        """
+        # Defining OPTIMIZER
+        if optimizer_type.lower() in ("adam", "adm"):
+            optim = torch.optim.Adam(self.stacked.parameters(),
+                                     lr=learning_rate)
+        else:
+            raise ValueError("At the moment only the 'Adam' optimizer "
+                             "is supported!")
+
+        # ------------------------ GO
+        history = [([], [], [], []) for _ in range(self.nrep)]
+        rings = [CheckpointRing(
+                    patience + 1,
+                    folder=(Path(checkpoint_folder) / ("REPLICA_%d" % k)
+                            if checkpoint_folder else None))
+                 for k in range(self.nrep)]
+        frozen = {}  # replica: state_dict
+
+        for t in range(epochs):
+            print(f"Epoch {t+1}\n-------------------------------")
+
+            _train = self.__stacked_train_loop__(optim, frozen)
+            _test = self.__stacked_test_loop__()
+
+            for k in range(self.nrep):
+                if k in frozen:
+                    continue
+                (trainl, trainl_batch, devl, devl_batch) = history[k]
+                trainl.append(_train[k][0])
+                trainl_batch.append(_train[k][1])
+                devl.append(_test[k][0])
+                devl_batch.append(_test[k][1])
+
+                if not early_stop:
+                    continue
+
+                # Store weights for HISTORY porpuses
+                rings[k].push_state(t, self.stacked.get_replica_state(k))
+
+                if t >= 2 * patience:
+                    print("REPLICA_%d  " % k, end="")
+                    (_answer, _, _step_back) = early_stop_criteria(
+                                    trainl, trainl_batch, devl, devl_batch,
+                                    patience, delta)
+                    if _answer:
+                        # Early stop triggered..pack everything
+                        self.__training_epochs__[k] = (t+1) - _step_back
+                        _epoch = list(rings[k].ring.keys())[-_step_back-1]
+                        frozen[k] = rings[k].get(_epoch)
+                        rings[k].close()
+                        history[k] = tuple(hh[:-_step_back] for hh in history[k])
+            #
+            self.__hold_frozen__(frozen)
+            if len(frozen) == self.nrep:
+                break
+
+        # The replicas still active reached the maximum epochs
+        for k in range(self.nrep):
+            if k not in frozen:
+                print("@@@ REPLICA_%d reached the FULL  %d  epochs!" % (k, epochs))
+                rings[k].close()
+                self.__training_epochs__[k] = epochs
+        #
+        return history
+
+    def get_replica(self, k):
+        """ The K-th trained replica as a standalone DKPN """
+        return self.stacked.get_replica(k)
+
+    def store_weigths_replica(self, k, dir_path, model_name, jsonstring,
+                              version="1"):
+        """ Store the K-th replica as `TrainHelp_DomainKnowledgePhaseNet` does """
+        TrainHelp_DomainKnowledgePhaseNet.store_weigths(
+                types.SimpleNamespace(trainmod=self.get_replica(k)),
+                dir_path, model_name, jsonstring, version=version)
+
+# ==================================================================
+# ==================================================================
+# ==================================================================
+
+
+class TrainHelp_DistributedDKPN(TrainHelp_DomainKnowledgePhaseNet):
+    """ Data-parallel DKPN training with `torch.distributed`: one process
+        per rank, as launched by `torchrun` (several local processes, or
+        several nodes). The default 'gloo' backend runs on CPU-only boxes.
+        - every rank reads its own shard of the TRAIN and DEV splits
+          (`DistributedSampler`, TRAIN reshuffled at every epoch);
+        - gradients are all-reduced by `DistributedDataParallel`;
+        - the augmentations RNG of every (rank, worker, epoch) is an
+          independent stream derived from RANDOM_SEED (reproducible);
+        - TRAIN batch losses and DEV loss are averaged over the ranks, so
+          that all of them take the same early-stop decision;
+        - only rank 0 writes checkpoints and `store_weigths` files, with
+          the RNG states of every rank (`DistributedCheckpointRing`).
+        BATCH_SIZE is per rank: the global batch is BATCH_SIZE * WORLD_SIZE.
+    """
+
+    def __init__(self, dkpninstance,
+                 train_sb_data, dev_sb_data, test_sb_data,
+                 backend="gloo", **kwargs):
+        if not dist.is_initialized():
+            dist.init_process_group(backend=backend)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        super().__init__(dkpninstance, train_sb_data, dev_sb_data,
+                         test_sb_data, **kwargs)
+        self.__setup_distributed__()
+
+    def __setup_distributed__(self):
+        self.__dist_epoch__ = 0
+        if self.rank != 0:
+            self.metrics_sink = None
+        # gloo reduces CPU tensors, nccl only CUDA ones
+        if dist.get_backend() == "nccl":
+            self.reduce_device = self.trainmod.device
+        else:
+            self.reduce_device = torch.device("cpu")
+
+        if self.trainmod.device.type == "cpu":
+            self.ddpmod = DistributedDataParallel(self.trainmod)
+        else:
+            self.ddpmod = DistributedDataParallel(
+                                self.trainmod,
+                                device_ids=[self.trainmod.device.index])
+
+    def __build_loaders__(self, batch_size, config):
+        """ TRAIN and DEV loaders read the shard of this rank only """
+        super().__build_loaders__(batch_size, config)
+        self.train_loader = DataLoader(
+                    self.__train_dataset__(), batch_size=batch_size,
+                    sampler=DistributedSampler(self.train_generator,
+                                               shuffle=True,
+                                               seed=self.random_seed),
+                    worker_init_fn=self.__worker_init_fn_seed__,
+                    generator=loader_generator(self.random_seed, self.rank),
+                    **loader_kwargs(**config))
+        self.dev_loader = DataLoader(
+                    self.dev_generator, batch_size=batch_size,
+                    sampler=DistributedSampler(self.dev_generator,
+                                               shuffle=False),
+                    worker_init_fn=self.__worker_init_fn_seed__,
+                    generator=loader_generator(self.random_seed, self.rank),
+                    **loader_kwargs(**config))
+
+    def is_master(self):
+        return self.rank == 0
+
+    def __resumed__(self, epochs):
+        # DistributedSampler shuffles of the next epoch, as without break
+        self.__dist_epoch__ = epochs
+
+    def __all_reduce_mean__(self, values):
+        _values = torch.tensor(values, dtype=torch.float64,
+                               device=self.reduce_device)
+        dist.all_reduce(_values)
+        return (_values / self.world_size).tolist()
+
+    def __checkpoint_ring__(self, size, folder):
+        return DistributedCheckpointRing(size, folder=folder)
+
+    def freeze_dev(self, folder, batch_size=512):
+        """ Materialize the DEV shard of this rank in FOLDER/RANK_<rank> """
+        _shard = list(iter(self.dev_loader.sampler))
+        print("Materializing DEV windows ... %s  (rank %d)" % (folder, self.rank))
+        dev_data = materialize_generator(
+                        Subset(self.dev_generator, _shard),
+                        Path(folder) / ("RANK_%d" % self.rank),
+                        batch_size=self.dev_loader.batch_size,
+                        num_workers=self.dev_loader.num_workers,
+                        random_seed=self.random_seed + self.rank)
+        self.dev_loader = DataLoader(dev_data, batch_size=batch_size,
+                                     shuffle=False, num_workers=0)
+        return dev_data
+
+    def __train_step__(self, batch):
+        (X, y) = (batch["X"].to(self.trainmod.device),
+                  batch["y"].to(self.trainmod.device))
+        if self.timer:
+            self.timer.tick("h2d")
+        # Compute prediction and loss (gradients all-reduced by DDP)
+        pred = self.ddpmod(X)
+        loss = self.__loss_fn__(pred, y)
+        return (loss, loss)
+
+    def __train_loop__(self, optimizer):
+        self.train_loader.sampler.set_epoch(self.__dist_epoch__)
+        (_, _train_loss_batches) = super().__train_loop__(optimizer)
+        self.__dist_epoch__ += 1
+        # The shards have the same number of batches (DistributedSampler)
+        _train_loss_batches = self.__all_reduce_mean__(_train_loss_batches)
+        return (_train_loss_batches[-1], _train_loss_batches)
+
+    def __test_loop__(self):
+        # Same BatchNorm statistics on every rank (DDP broadcasts them
+        # from rank 0 only at the next training forward)
+        for bb in self.trainmod.buffers():
+            dist.broadcast(bb.data, 0)
+
+        self.trainmod.eval()
+        test_loss_batches = []
+        with torch.no_grad():
+            for batch in self.dev_loader:
+                pred = self.trainmod(batch["X"].to(
+                                self.trainmod.device))
+                test_loss_batches.append(self.__loss_fn__(
+                                pred, batch["y"].to(
+                                        self.trainmod.device)).item())
+        self.trainmod.train()
+
+        (_sum, _count) = self.__all_reduce_mean__(
+                            [np.sum(test_loss_batches), len(test_loss_batches)])
+        test_loss = _sum / _count
+        if self.is_master():
+            print(f"Dev. avg loss: {test_loss:>8f}\n")
+        return (test_loss, test_loss_batches)
+
+    def store_weigths(self, dir_path, model_name, jsonstring, version="1"):
+        """ Store the finals (rank 0 only) """
+        if self.is_master():
+            super().store_weigths(dir_path, model_name, jsonstring,
+                                  version=version)
+        if dist.is_initialized():
+            dist.barrier()
+
+    def finalize(self):
+        dist.barrier()
+        dist.destroy_process_group()